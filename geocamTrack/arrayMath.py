@@ -0,0 +1,69 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+NumPy versions of the geometry we do on positions, for working on many
+positions at once.
+"""
+
+import calendar
+import math
+
+import numpy as np
+
+from django.conf import settings
+
+# same flat-earth approximation as geocamUtil.geomath.calculateDiffMeters,
+# fine for the short distances between neighboring positions
+EARTH_RADIUS_METERS = 6371010
+DEG2RAD = math.pi / 180.0
+
+
+def diffMeters(lon0, lat0, lon1, lat1):
+    """
+    Returns the (east, north) displacement in meters from (lon0, lat0) to
+    (lon1, lat1).  Arguments can be scalars or arrays.
+    """
+    lat = 0.5 * (np.asarray(lat0) + np.asarray(lat1)) * DEG2RAD
+    east = np.cos(lat) * EARTH_RADIUS_METERS * (np.asarray(lon1) - np.asarray(lon0)) * DEG2RAD
+    north = EARTH_RADIUS_METERS * (np.asarray(lat1) - np.asarray(lat0)) * DEG2RAD
+    return east, north
+
+
+def distanceMeters(lon0, lat0, lon1, lat1):
+    east, north = diffMeters(lon0, lat0, lon1, lat1)
+    return np.hypot(east, north)
+
+
+def getFullCircle(units=None):
+    """ Returns 360 or 2 pi, depending on GEOCAM_TRACK_HEADING_UNITS """
+    if units is None:
+        units = settings.GEOCAM_TRACK_HEADING_UNITS
+    if units == 'degrees':
+        return 360.0
+    return 2 * math.pi
+
+
+def angleDiffDegrees(a, b, units=None):
+    """
+    Returns the absolute difference between headings a and b along the
+    shorter arc, in degrees.  a and b are in GEOCAM_TRACK_HEADING_UNITS
+    unless units is given.
+    """
+    fullCircle = getFullCircle(units)
+    diff = np.abs(np.mod(np.asarray(b, dtype=float) - np.asarray(a, dtype=float), fullCircle))
+    diff = np.minimum(diff, fullCircle - diff)
+    return diff * (360.0 / fullCircle)
+
+
+def datetimeToEpoch(dt):
+    """ Seconds since the epoch for a naive UTC (or aware) datetime, keeping microseconds """
+    return calendar.timegm(dt.utctimetuple()) + 1e-6 * dt.microsecond
+
+
+def toFloatArray(values):
+    """ Convert a sequence that may contain None to a float array with NaN for None """
+    return np.array([np.nan if v is None else v for v in values], dtype=float)
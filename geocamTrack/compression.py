@@ -0,0 +1,188 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Optional ingest-time compression of tracks.
+
+A vehicle that is parked or moving in a straight line at constant speed
+reports many fixes that add nothing to the track: they can be recovered
+by interpolating between their neighbors.  The TrackCompressor class
+stores a fix only when leaving it out would make interpolation between
+stored fixes miss some fix by more than a tolerance.
+
+It keeps the last stored fix (the anchor) and the fixes received since
+then.  When a new fix arrives, it checks that every held fix is within
+@meters of the position interpolated in time on the segment from the
+anchor to the new fix, and within @degrees in heading.  If so, the new
+fix is held too.  If not, the newest held fix is stored and becomes the
+anchor.  A fix is also stored when it is more than @seconds after the
+anchor.
+
+Segments are never longer than GEOCAM_TRACK_INTERPOLATE_MAX_METERS or
+GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS, so getInterpolatedPosition and
+FastPosition still interpolate between stored fixes and reproduce every
+received fix within the tolerance.
+
+Compression is configured per vehicle name in GEOCAM_TRACK_COMPRESSION.
+Compressor state lives in memory, so the newest fixes of a track are not
+stored until a later fix or flushCompressors() forces them out.  Enable
+compression only where all of a track's fixes are ingested by a single
+process, for example with the write-behind queue or the position listener.
+"""
+
+import atexit
+import threading
+
+import numpy as np
+
+from django.conf import settings
+
+from geocamTrack.arrayMath import distanceMeters, angleDiffDegrees, datetimeToEpoch, getFullCircle
+
+compressorsG = {}
+compressorsLockG = threading.Lock()
+
+
+class TrackCompressor(object):
+    def __init__(self, meters, degrees=None, seconds=None):
+        self.meters = meters
+        self.degrees = degrees
+        maxSeconds = settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS
+        if seconds is not None:
+            maxSeconds = min(seconds, maxSeconds)
+        self.maxSeconds = maxSeconds
+        self.maxMeters = settings.GEOCAM_TRACK_INTERPOLATE_MAX_METERS
+        self.anchor = None
+        self.held = []
+
+    def fits(self, fix):
+        """
+        True if the segment from the anchor to fix reproduces every held
+        fix within the tolerances.
+        """
+        anchor = self.anchor
+        t0 = datetimeToEpoch(anchor['timestamp'])
+        t1 = datetimeToEpoch(fix['timestamp'])
+        if t1 - t0 > self.maxSeconds:
+            return False
+        if distanceMeters(anchor['longitude'], anchor['latitude'],
+                          fix['longitude'], fix['latitude']) > self.maxMeters:
+            return False
+        if not self.held:
+            return True
+
+        times = np.array([datetimeToEpoch(h['timestamp']) for h in self.held])
+        if t1 > t0:
+            w = (times - t0) / (t1 - t0)
+        else:
+            w = np.zeros(len(times))
+        lons = anchor['longitude'] + w * (fix['longitude'] - anchor['longitude'])
+        lats = anchor['latitude'] + w * (fix['latitude'] - anchor['latitude'])
+        if np.any(distanceMeters(lons, lats,
+                                 [h['longitude'] for h in self.held],
+                                 [h['latitude'] for h in self.held]) > self.meters):
+            return False
+
+        if anchor.get('altitude') is not None and fix.get('altitude') is not None:
+            alts = anchor['altitude'] + w * (fix['altitude'] - anchor['altitude'])
+            heldAlts = np.array([h.get('altitude') for h in self.held], dtype=float)
+            with np.errstate(invalid='ignore'):
+                if np.any(np.abs(alts - heldAlts) > self.meters):
+                    return False
+
+        if (self.degrees is not None and
+                anchor.get('heading') is not None and fix.get('heading') is not None):
+            fullCircle = getFullCircle()
+            h0 = anchor['heading']
+            # interpolate heading along the shorter arc
+            dh = np.mod(fix['heading'] - h0 + fullCircle / 2, fullCircle) - fullCircle / 2
+            headings = h0 + w * dh
+            heldHeadings = np.array([h.get('heading') for h in self.held], dtype=float)
+            with np.errstate(invalid='ignore'):
+                if np.any(angleDiffDegrees(headings, heldHeadings) > self.degrees):
+                    return False
+        return True
+
+    def add(self, fix):
+        """
+        Add a fix, a dictionary of position field values.  Fixes must be
+        added in time order.  Returns the list of fixes to store now.
+        """
+        if self.anchor is None:
+            self.anchor = fix
+            return [fix]
+        if fix['timestamp'] <= self.anchor['timestamp']:
+            # late fix, store it as is
+            return [fix]
+        if self.fits(fix):
+            self.held.append(fix)
+            return []
+
+        result = []
+        if self.held:
+            self.anchor = self.held[-1]
+            self.held = []
+            result.append(self.anchor)
+            if self.fits(fix):
+                self.held.append(fix)
+                return result
+        self.anchor = fix
+        result.append(fix)
+        return result
+
+    def flush(self):
+        """ Return the newest held fix, if any, so it can be stored now """
+        if not self.held:
+            return []
+        self.anchor = self.held[-1]
+        self.held = []
+        return [self.anchor]
+
+
+def getCompressionSettings(track):
+    if not settings.GEOCAM_TRACK_COMPRESSION:
+        return None
+    vehicle = getattr(track, 'vehicle', None)
+    if vehicle is None:
+        return None
+    return settings.GEOCAM_TRACK_COMPRESSION.get(vehicle.name)
+
+
+def compressPositions(track, positionAttrs):
+    """
+    Run a batch of position field value dictionaries for a track through
+    its compressor.  Returns the ones to store, in time order.  If
+    compression is not configured for the track's vehicle, returns them all.
+    """
+    options = getCompressionSettings(track)
+    if not options:
+        return positionAttrs
+    positionAttrs = sorted(positionAttrs, key=lambda attrs: attrs['timestamp'])
+    with compressorsLockG:
+        if track.pk not in compressorsG:
+            compressorsG[track.pk] = (track, TrackCompressor(**options))
+        compressor = compressorsG[track.pk][1]
+        result = []
+        for attrs in positionAttrs:
+            result.extend(compressor.add(attrs))
+    return result
+
+
+def flushCompressors():
+    """
+    Store the fixes every compressor is holding back, so the stored tracks
+    are complete up to now.
+    """
+    from geocamTrack.positionIngest import storePastPositions, buildPosition, PAST_POSITION_MODEL
+
+    with compressorsLockG:
+        held = [(track, compressor.flush()) for track, compressor in compressorsG.itervalues()]
+    for track, fixes in held:
+        if fixes:
+            storePastPositions([buildPosition(PAST_POSITION_MODEL.get(), track, attrs) for attrs in fixes])
+
+
+atexit.register(flushCompressors)
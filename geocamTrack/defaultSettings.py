@@ -42,6 +42,75 @@ GEOCAM_TRACK_INTERPOLATE_MAX_METERS = 20
 GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS = 8 * 60 * 60
 GEOCAM_TRACK_CLOSEST_POSITION_MAX_DIFFERENCE_SECONDS = 120
 
+# Maximum number of positions written by a single bulk insert when storing
+# batches of incoming or imported positions.
+GEOCAM_TRACK_INGEST_BATCH_SIZE = 1000
+
+# Set GEOCAM_TRACK_WRITE_BEHIND to True to queue incoming positions in memory and
+# store them from a background thread, see geocamTrack.positionQueue.
+# Queued positions are flushed when BATCH_SIZE are waiting or after FLUSH_SECONDS.
+# When MAX_DEPTH positions are waiting, posting blocks for up to PUT_TIMEOUT_SECONDS
+# and then fails with status 503.
+GEOCAM_TRACK_WRITE_BEHIND = False
+GEOCAM_TRACK_WRITE_BEHIND_BATCH_SIZE = 1000
+GEOCAM_TRACK_WRITE_BEHIND_FLUSH_SECONDS = 1.0
+GEOCAM_TRACK_WRITE_BEHIND_MAX_DEPTH = 20000
+GEOCAM_TRACK_WRITE_BEHIND_PUT_TIMEOUT_SECONDS = 1.0
+
+# Ingest-time track compression, by vehicle name, see geocamTrack.compression.
+# A fix is stored only if interpolating between stored fixes would miss it by more
+# than 'meters' (or 'degrees' of heading), or 'seconds' have passed since the last one.
+# For example {'Robot': {'meters': 0.5, 'degrees': 5, 'seconds': 60}}
+GEOCAM_TRACK_COMPRESSION = {}
+
+# Process-wide cache of past positions for position lookups, see geocamTrack.positionCache.
+# Positions are cached per track in buckets of BUCKET_SECONDS, up to BYTES in total; 0 disables it.
+# Staleness is tracked with version numbers in the Django cache, so the cache is only used with a
+# backend shared between processes, such as memcached, never with the local memory or dummy backends.
+# 64 * 1024 * 1024 is a reasonable size once such a backend is configured.
+GEOCAM_TRACK_POSITION_CACHE_BYTES = 0
+GEOCAM_TRACK_POSITION_CACHE_BUCKET_SECONDS = 3600
+
+# Set GEOCAM_TRACK_POSITION_ROLLUP to True to keep a per-minute summary of each track's past
+# positions (see geocamTrack.positionRollup), and answer date, count and coverage queries from it.
+# After turning it on, fill in the existing positions with manage.py rebuildPositionRollup.
+GEOCAM_TRACK_POSITION_ROLLUP = False
+
+# Past positions store the number of their cell in a grid of SPATIAL_CELL_DEGREES, for bounding box
+# searches (see geocamTrack.spatialIndex).  A search looks up each cell separately when the box covers
+# at most SPATIAL_MAX_CELLS of them, and whole rows of cells otherwise.  Matching positions of a track
+# more than SPATIAL_SPAN_GAP_SECONDS apart are reported as separate time spans.
+GEOCAM_TRACK_SPATIAL_CELL_DEGREES = 0.01
+GEOCAM_TRACK_SPATIAL_MAX_CELLS = 2000
+GEOCAM_TRACK_SPATIAL_SPAN_GAP_SECONDS = 300
+
+# In-memory index of current positions for proximity queries, see geocamTrack.proximity.  Positions
+# are kept in cells of PROXIMITY_CELL_METERS.  The proximityChanged signal is sent when two tracks come
+# within, or move apart beyond, PROXIMITY_THRESHOLD_METERS (0 turns that off).  Processes that do not
+# save current positions themselves reload them from the database at most every
+# PROXIMITY_REFRESH_SECONDS, ignoring positions older than PROXIMITY_MAX_AGE_SECONDS.
+GEOCAM_TRACK_PROXIMITY = True
+GEOCAM_TRACK_PROXIMITY_CELL_METERS = 100
+GEOCAM_TRACK_PROXIMITY_THRESHOLD_METERS = 50
+GEOCAM_TRACK_PROXIMITY_REFRESH_SECONDS = 1
+GEOCAM_TRACK_PROXIMITY_MAX_AGE_SECONDS = 300
+
+# KML views stream their output (see geocamTrack.kmlStream).  The cached ones keep a copy of what they
+# stream and store it in the cache at the end, unless it is larger than this.
+GEOCAM_TRACK_STREAM_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# tracks.kml, track/<name> and the map json of a track take a tolerance query parameter in meters to
+# simplify the line (see geocamTrack.simplify).  Simplified lines are cached for this long; they are
+# also recomputed as soon as the track's positions change.
+GEOCAM_TRACK_SIMPLIFY_CACHE_SECONDS = 24 * 60 * 60
+
+# tracks.kml assembles each track line from fragments rendered per GEOCAM_TRACK_POSITION_CACHE_BUCKET_SECONDS
+# block and cached for this long, re-rendering only the blocks whose positions changed (see
+# geocamTrack.kmlBlocks).  Like the position cache, this requires a Django cache backend shared
+# between processes, and is not used with the local memory or dummy backends.
+GEOCAM_TRACK_KML_BLOCK_CACHE = False
+GEOCAM_TRACK_KML_BLOCK_CACHE_SECONDS = 7 * 24 * 60 * 60
+
 # All timestamps in geocamTrack data tables should always use the UTC
 # time zone.  GEOCAM_TRACK_OPS_TIME_ZONE is currently used only to
 # choose how to split up days in the daily track index. We split at
@@ -27,13 +27,25 @@ get.
 The FastPosition class should give correct interpolated positions even
 if you don't run timestamp queries in increasing order, but the
 performance could be very bad.
+
+The ArrayFastPosition class is for queries in arbitrary order.  It loads
+the positions of a track (or a time window of it) into NumPy arrays with
+a single values_list() query, finds bracketing positions with
+searchsorted, and interpolates any number of timestamps in one
+vectorized getInterpolatedPositions() call, using the position model's
+interpolateArrays().
 """
 
 import datetime
 
+import numpy as np
+
 from geocamUtil.loader import LazyGetModelByName
 from django.conf import settings
 
+from geocamTrack import positionCache
+from geocamTrack.arrayMath import distanceMeters, datetimeToEpoch, toFloatArray
+
 PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
 POSITION_CACHE_SIZE = 10000
 
@@ -51,6 +63,14 @@ class FastPosition(object):
         self.cacheMin = None
         self.cacheMax = None
         self.cacheIndex = None
+
+        # with the shared position cache, lookups start warm if another
+        # request already read the same part of the track
+        self.reader = None
+        if positionCache.isEnabled():
+            self.reader = positionCache.TrackPositionReader(track)
+            return
+
         self.globalMin = (self.baseQuery
                           .order_by('timestamp')
                           [:1][0].timestamp)
@@ -99,16 +119,21 @@ class FastPosition(object):
                 return self.cache[i], self.cache[i + 1]
 
     def getInterpolatedPosition(self, utcDt):
-        beforePos, afterPos = self.getBracketingPositions(utcDt)
+        if self.reader is not None:
+            beforePos, afterPos = self.reader.getBracketingPositions(utcDt)
+            if afterPos is not None and afterPos.timestamp == utcDt:
+                beforePos = afterPos
+        else:
+            beforePos, afterPos = self.getBracketingPositions(utcDt)
 
         # no bracketing values
-        if beforePos is None:
+        if beforePos is None or afterPos is None:
             return None
 
         # if the before value is an exact match
         if beforePos.timestamp == utcDt:
             return (PAST_POSITION_MODEL.get().getInterpolatedPosition
-                    (utcDt, 1, afterPos, 0, afterPos))
+                    (utcDt, 1, beforePos, 0, beforePos))
 
         afterDelta = timeDeltaTotalSeconds(afterPos.timestamp - utcDt)
         beforeDelta = timeDeltaTotalSeconds(utcDt - beforePos.timestamp)
@@ -123,3 +148,114 @@ class FastPosition(object):
         afterWeight = beforeDelta / delta
         return (PAST_POSITION_MODEL.get().getInterpolatedPosition
                 (utcDt, beforeWeight, beforePos, afterWeight, afterPos))
+
+
+class ArrayFastPosition(object):
+    """
+    Interpolate positions of a track at many timestamps, in any order.
+
+    If @start and @end are given, only the positions needed to
+    interpolate between them are loaded.  Timestamps outside the loaded
+    window are treated like timestamps outside the track.
+    """
+    def __init__(self, track, start=None, end=None):
+        self.track = track
+        self.model = PAST_POSITION_MODEL.get()
+        self.fields = ['latitude', 'longitude'] + self.model.getInterpolatedFields()
+
+        query = self.model.objects.filter(track=track).order_by('timestamp')
+        maxDelta = datetime.timedelta(seconds=settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS)
+        if start is not None:
+            query = query.filter(timestamp__gte=start - maxDelta)
+        if end is not None:
+            query = query.filter(timestamp__lte=end + maxDelta)
+        self.setRows(query.values_list('timestamp', *self.fields))
+
+    def setRows(self, rows):
+        """ Load (timestamp, field values...) rows, in timestamp order """
+        rows = list(rows)
+        self.epoch = np.array([datetimeToEpoch(row[0]) for row in rows], dtype=float)
+        self.arrays = dict((name, toFloatArray([row[i + 1] for row in rows]))
+                           for i, name in enumerate(self.fields))
+
+    def getBracketingIndices(self, epoch):
+        """
+        For an array of epoch times, return (before, after, valid) where
+        before and after index the bracketing positions and valid masks
+        the times that can be interpolated: bracketed by positions no more
+        than GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS and
+        GEOCAM_TRACK_INTERPOLATE_MAX_METERS apart.  An exact match has
+        before == after.
+        """
+        n = len(self.epoch)
+        before = np.searchsorted(self.epoch, epoch, side='right') - 1
+        after = np.searchsorted(self.epoch, epoch, side='left')
+        valid = (before >= 0) & (after < n)
+
+        # clip so invalid entries still index safely
+        before = np.clip(before, 0, max(n - 1, 0))
+        after = np.clip(after, 0, max(n - 1, 0))
+        if n == 0:
+            return before, after, valid
+
+        valid &= (self.epoch[after] - self.epoch[before]) <= settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS
+        lats = self.arrays['latitude']
+        lons = self.arrays['longitude']
+        valid &= (distanceMeters(lons[before], lats[before], lons[after], lats[after]) <=
+                  settings.GEOCAM_TRACK_INTERPOLATE_MAX_METERS)
+        return before, after, valid
+
+    def getInterpolatedPositions(self, timestamps):
+        """
+        Interpolate the track at each of @timestamps, which can be a
+        sequence of naive UTC datetimes or an array of epoch seconds, in
+        any order.  Returns a dictionary with an array per position field,
+        in the order of @timestamps, plus 'epoch' and a boolean 'valid'
+        array.  Fields are NaN where valid is False.
+        """
+        epoch = np.asarray(timestamps)
+        if epoch.dtype == object:
+            epoch = np.array([datetimeToEpoch(t) for t in timestamps], dtype=float)
+        epoch = epoch.astype(float)
+
+        before, after, valid = self.getBracketingIndices(epoch)
+        result = dict(epoch=epoch, valid=valid)
+        if len(self.epoch) == 0:
+            for name in self.fields:
+                result[name] = np.full(len(epoch), np.nan)
+            return result
+
+        span = self.epoch[after] - self.epoch[before]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(span > 0, (epoch - self.epoch[before]) / span, 0.0)
+        values = self.model.interpolateArrays(weight,
+                                              dict((name, self.arrays[name][before]) for name in self.fields),
+                                              dict((name, self.arrays[name][after]) for name in self.fields))
+        for name in self.fields:
+            result[name] = np.where(valid, values[name], np.nan)
+        return result
+
+    def getInterpolatedPositionList(self, utcDts):
+        """
+        Unsaved past positions interpolated at each of @utcDts, in the
+        same order, with None where there is no position.
+        """
+        values = self.getInterpolatedPositions(utcDts)
+        result = []
+        for i, utcDt in enumerate(utcDts):
+            if not values['valid'][i]:
+                result.append(None)
+                continue
+            position = self.model(track=self.track, timestamp=utcDt)
+            for name in self.fields:
+                value = values[name][i]
+                setattr(position, name, None if np.isnan(value) else float(value))
+            result.append(position)
+        return result
+
+    def getInterpolatedPosition(self, utcDt):
+        """
+        Same as FastPosition.getInterpolatedPosition: an unsaved past
+        position at @utcDt, or None.
+        """
+        return self.getInterpolatedPositionList([utcDt])[0]
@@ -6,64 +6,193 @@
 
 import datetime
 
+import numpy as np
+
 from geocamUtil.loader import LazyGetModelByName
 from django.conf import settings
 
+from geocamTrack.arrayMath import distanceMeters, angleDiffDegrees, datetimeToEpoch, toFloatArray
+from geocamTrack.positionIngest import storePastPositions
+
 PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
 
+# add_many() compares the last accepted position against windows of
+# following positions, starting with this many and doubling while
+# nothing in the window is accepted
+MIN_WINDOW = 16
+MAX_WINDOW = 4096
 
-class PositionFilter(object):
-    def __init__(self, distanceMeters, callback=lambda pos: pos.save()):
-        self.distanceMeters = distanceMeters
+
+def savePosition(pos):
+    pos.save()
+
+
+class TrackPositionFilter(object):
+    """
+    Base class for filters that accept a position when it is different
+    enough from the last accepted position on the same track.
+
+    The last accepted position is kept per track.  The first time a track
+    is seen, it is loaded with one query for the latest stored position
+    on that track.
+
+    When a sample is accepted, the @callback parameter is invoked with
+    the sample as an argument.  add_many() instead passes all the
+    accepted samples to @batchCallback at once; by default that stores
+    them with a bulk insert if @callback is the default save, and calls
+    @callback on each of them otherwise.
+    """
+    def __init__(self, callback=savePosition, batchCallback=None):
         self.callback = callback
+        if batchCallback is None:
+            if callback is savePosition:
+                batchCallback = storePastPositions
+            else:
+                batchCallback = lambda positions: [callback(pos) for pos in positions]
+        self.batchCallback = batchCallback
+        self.previousPositions = {}
 
-        pastPositions = PAST_POSITION_MODEL.get().objects.all().order_by('-timestamp')
-        if pastPositions.count():
-            self.previousPos = pastPositions[0]
-        else:
-            self.previousPos = None
+        # last accepted position on any track
+        self.previousPos = None
+
+    def getPrevious(self, trackId):
+        if trackId not in self.previousPositions:
+            self.previousPositions[trackId] = (PAST_POSITION_MODEL.get().objects
+                                               .filter(track_id=trackId)
+                                               .order_by('-timestamp')
+                                               .first())
+        return self.previousPositions[trackId]
+
+    def setPrevious(self, pos):
+        self.previousPositions[pos.track_id] = pos
+        self.previousPos = pos
+
+    def accept(self, prev, pos):
+        """ Return True if pos is different enough from prev """
+        raise NotImplementedError
+
+    def acceptMask(self, prev, arrays, start, end):
+        """
+        Vectorized accept(): return a boolean array telling which of the
+        positions start:end in arrays are different enough from prev.
+        """
+        raise NotImplementedError
 
     def add(self, pos):
-        if self.previousPos is None or pos.getDistance(self.previousPos) > self.distanceMeters:
+        prev = self.getPrevious(pos.track_id)
+        if prev is None or self.accept(prev, pos):
             self.callback(pos)
-            self.previousPos = pos
+            self.setPrevious(pos)
             return True
         else:
             return False
 
+    def add_many(self, positions):
+        """
+        Filter a list of positions, possibly for many tracks.  Gives the
+        same result as calling add() on each of them in order, but the
+        thresholds are evaluated on arrays.  Returns the accepted positions.
+        """
+        tracks = {}
+        order = []
+        for pos in positions:
+            if pos.track_id not in tracks:
+                tracks[pos.track_id] = []
+                order.append(pos.track_id)
+            tracks[pos.track_id].append(pos)
+
+        accepted = []
+        for trackId in order:
+            accepted.extend(self.filterTrack(trackId, tracks[trackId]))
+        if accepted:
+            self.batchCallback(accepted)
+        return accepted
+
+    def filterTrack(self, trackId, positions):
+        arrays = getPositionArrays(positions)
+        prev = self.getPrevious(trackId)
+        accepted = []
+        i = 0
+        n = len(positions)
+        if prev is None:
+            prev = positions[0]
+            accepted.append(prev)
+            i = 1
+
+        window = MIN_WINDOW
+        while i < n:
+            end = min(n, i + window)
+            hits = np.flatnonzero(self.acceptMask(prev, arrays, i, end))
+            if len(hits) == 0:
+                i = end
+                window = min(2 * window, MAX_WINDOW)
+                continue
+            prev = positions[i + hits[0]]
+            accepted.append(prev)
+            i += hits[0] + 1
+            window = MIN_WINDOW
 
-class FancyPositionFilter(object):
+        if accepted:
+            self.setPrevious(accepted[-1])
+        return accepted
+
+
+def getPositionArrays(positions):
+    return dict(longitude=np.array([pos.longitude for pos in positions], dtype=float),
+                latitude=np.array([pos.latitude for pos in positions], dtype=float),
+                heading=toFloatArray([getattr(pos, 'heading', None) for pos in positions]),
+                epoch=np.array([datetimeToEpoch(pos.timestamp) for pos in positions], dtype=float))
+
+
+class PositionFilter(TrackPositionFilter):
+    def __init__(self, distanceMeters, callback=savePosition, batchCallback=None):
+        super(PositionFilter, self).__init__(callback, batchCallback)
+        self.distanceMeters = distanceMeters
+
+    def accept(self, prev, pos):
+        return pos.getDistance(prev) > self.distanceMeters
+
+    def acceptMask(self, prev, arrays, start, end):
+        return distanceMeters(prev.longitude, prev.latitude,
+                              arrays['longitude'][start:end],
+                              arrays['latitude'][start:end]) > self.distanceMeters
+
+
+class FancyPositionFilter(TrackPositionFilter):
     """
     The add() method accepts the sample you pass it if it is distant
     from the previous pose in position (@meters parameter), heading
-    (@degrees parameter), or time (@seconds parameter).
+    (@degrees parameter), or time (@seconds parameter).  Headings are
+    in GEOCAM_TRACK_HEADING_UNITS and compared along the shorter arc.
 
     Any of the parameters can be None, in which case they are ignored.
-
-    When a sample is accepted, the @callback parameter is invoked with
-    the sample as an argument.
     """
-    def __init__(self, meters=None, degrees=None, seconds=None, callback=lambda pos: pos.save()):
+    def __init__(self, meters=None, degrees=None, seconds=None, callback=savePosition, batchCallback=None):
+        super(FancyPositionFilter, self).__init__(callback, batchCallback)
         self.meters = meters
         self.degrees = degrees
-        self.seconds = datetime.timedelta(seconds=seconds)
-        self.callback = callback
-
-        pastPositions = PAST_POSITION_MODEL.get().objects.all().order_by('-timestamp')
-        if pastPositions.count():
-            self.previousPos = pastPositions[0]
+        if seconds is not None:
+            self.seconds = datetime.timedelta(seconds=seconds)
         else:
-            self.previousPos = None
+            self.seconds = None
 
-    def add(self, pos):
-        prev = self.previousPos
-        accept = ((prev is None) or
-                  (self.seconds is not None and pos.timestamp - prev.timestamp > self.seconds) or
-                  (self.degrees is not None and abs(pos.heading - prev.heading) > self.degrees) or
-                  (self.meters is not None and pos.getDistance(prev) > self.meters))
-        if accept:
-            self.callback(pos)
-            self.previousPos = pos
-            return True
-        else:
-            return False
+    def accept(self, prev, pos):
+        return ((self.seconds is not None and pos.timestamp - prev.timestamp > self.seconds) or
+                (self.degrees is not None and pos.heading is not None and prev.heading is not None and
+                 angleDiffDegrees(prev.heading, pos.heading) > self.degrees) or
+                (self.meters is not None and pos.getDistance(prev) > self.meters))
+
+    def acceptMask(self, prev, arrays, start, end):
+        mask = np.zeros(end - start, dtype=bool)
+        if self.seconds is not None:
+            mask |= (arrays['epoch'][start:end] - datetimeToEpoch(prev.timestamp) >
+                     self.seconds.total_seconds())
+        if self.degrees is not None and prev.heading is not None:
+            with np.errstate(invalid='ignore'):
+                # NaN headings compare False
+                mask |= angleDiffDegrees(prev.heading, arrays['heading'][start:end]) > self.degrees
+        if self.meters is not None:
+            mask |= distanceMeters(prev.longitude, prev.latitude,
+                                   arrays['longitude'][start:end],
+                                   arrays['latitude'][start:end]) > self.meters
+        return mask
@@ -25,7 +25,7 @@ VEHICLE_MODEL = LazyGetModelByName(settings.XGDS_CORE_VEHICLE_MODEL)
 
 
 from django.forms.models import ModelChoiceField
-from django.forms import CharField
+from django.forms import CharField, FloatField, DateTimeField, Form, ValidationError
 
 
 class ImportTrackForm(AbstractImportVehicleForm):
@@ -48,3 +48,31 @@ class SearchPositionForm(SearchForm):
     class Meta:
         model = POSITION_MODEL.get()
         fields = POSITION_MODEL.get().getSearchFormFields()
+
+
+class PositionBboxForm(Form):
+    """
+    Bounding box and time range for spatialIndex.findTrackSpans.  The
+    vehicle field matches SearchPositionForm, so a position search can
+    pass its vehicle along.  If west is greater than east, the box
+    crosses the antimeridian.
+    """
+    west = FloatField(min_value=-180, max_value=180)
+    south = FloatField(min_value=-90, max_value=90)
+    east = FloatField(min_value=-180, max_value=180)
+    north = FloatField(min_value=-90, max_value=90)
+    start = DateTimeField()
+    end = DateTimeField()
+    gap = FloatField(required=False, min_value=0, help_text='seconds between positions that split a time span')
+    track__vehicle = ModelChoiceField(required=False, queryset=VEHICLE_MODEL.get().objects.filter(primary=True),
+                                      label=settings.XGDS_CORE_VEHICLE_MONIKER)
+
+    def clean(self):
+        cleaned_data = super(PositionBboxForm, self).clean()
+        if cleaned_data.get('south') is not None and cleaned_data.get('north') is not None:
+            if cleaned_data['south'] > cleaned_data['north']:
+                raise ValidationError('south must not be greater than north')
+        if cleaned_data.get('start') and cleaned_data.get('end'):
+            if cleaned_data['start'] > cleaned_data['end']:
+                raise ValidationError('start must not be after end')
+        return cleaned_data
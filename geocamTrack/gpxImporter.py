@@ -0,0 +1,162 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Streaming import of GPX tracks.
+
+The GPX file is parsed incrementally with iterparse, and each element
+is thrown away as soon as it has been read, so memory use stays flat no
+matter how large the file is.  Every <trkseg> of every <trk> is
+imported.  Positions are written with bulk inserts of
+GEOCAM_TRACK_INGEST_BATCH_SIZE rows, all inside one transaction.
+"""
+
+import datetime
+import logging
+import xml.etree.cElementTree as et
+
+import pytz
+from dateutil.parser import parse as dateparser
+
+from django.conf import settings
+from django.db import transaction
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.positionIngest import storePastPositions
+
+TRACK_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_TRACK_MODEL)
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+
+# log progress every this many points
+PROGRESS_INTERVAL = 10000
+
+
+def localName(tag):
+    """ strip the namespace from an element tag """
+    return tag.rsplit('}', 1)[-1]
+
+
+def getChildText(elem, name):
+    for child in elem:
+        if localName(child.tag) == name:
+            return child.text
+    return None
+
+
+def iterGpxTracks(f):
+    """
+    Parse a GPX file incrementally.  Yields ('track', name) at the start of
+    each <trk> (name is None if the track has no name) and ('point', dict)
+    for each <trkpt>.  Point dicts have lat, lon, ele and time, where time
+    is a naive UTC datetime or None.
+    """
+    stack = []
+    root = None
+    segment = None
+    trackStarted = False
+    for event, elem in et.iterparse(f, events=('start', 'end')):
+        tag = localName(elem.tag)
+        if event == 'start':
+            if root is None:
+                root = elem
+            if tag == 'trk':
+                trackStarted = False
+            elif tag == 'trkseg':
+                segment = elem
+            stack.append(tag)
+            continue
+
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if tag == 'name' and parent == 'trk' and not trackStarted:
+            trackStarted = True
+            yield 'track', elem.text
+        elif tag == 'trkpt':
+            if not trackStarted:
+                trackStarted = True
+                yield 'track', None
+            timeText = getChildText(elem, 'time')
+            if timeText:
+                time = dateparser(timeText)
+                if time.tzinfo is not None:
+                    time = time.astimezone(pytz.utc).replace(tzinfo=None)
+            else:
+                time = None
+            eleText = getChildText(elem, 'ele')
+            yield 'point', {'lat': float(elem.attrib['lat']),
+                            'lon': float(elem.attrib['lon']),
+                            'ele': float(eleText) if eleText else None,
+                            'time': time}
+            # throw away the point; parsed points would otherwise pile up in the tree
+            elem.clear()
+            if segment is not None:
+                del segment[:]
+        elif tag == 'trkseg':
+            segment = None
+        elif parent == 'gpx' and root is not None:
+            # done with a top-level trk or wpt
+            del root[:]
+
+
+def importGpxTracks(f, vehicle=None, progress=None):
+    """
+    Import every track in the GPX file f, creating one track model per
+    <trk> that has timestamped points.  Points without a time are skipped.
+    progress, if given, is called as progress(trackName, pointCount)
+    after each batch is stored.  Returns the new tracks.
+    """
+    pastModel = PAST_POSITION_MODEL.get()
+    batchSize = settings.GEOCAM_TRACK_INGEST_BATCH_SIZE
+    serverTimestamp = datetime.datetime.now(pytz.utc)
+
+    newTracks = []
+    trackName = None
+    track = None
+    batch = []
+    count = 0
+    skipped = 0
+
+    def flush():
+        storePastPositions(batch)
+        del batch[:]
+        if progress:
+            progress(track.name, count)
+
+    with transaction.atomic():
+        for kind, value in iterGpxTracks(f):
+            if kind == 'track':
+                if batch:
+                    flush()
+                trackName = value
+                track = None
+                continue
+
+            if value['time'] is None:
+                skipped += 1
+                continue
+            if track is None:
+                track = TRACK_MODEL.get().objects.create(name=trackName or 'GPX track %d' % (len(newTracks) + 1),
+                                                         vehicle=vehicle)
+                newTracks.append(track)
+                count = 0
+            batch.append(pastModel(track=track,
+                                   serverTimestamp=serverTimestamp,
+                                   timestamp=value['time'],
+                                   latitude=value['lat'],
+                                   longitude=value['lon'],
+                                   altitude=value['ele']))
+            count += 1
+            if len(batch) >= batchSize:
+                flush()
+            if count % PROGRESS_INTERVAL == 0:
+                logging.info('imported %d points into track %s', count, track.name)
+        if batch:
+            flush()
+
+    if skipped:
+        logging.warning('skipped %d GPX track points with no time', skipped)
+    return newTracks
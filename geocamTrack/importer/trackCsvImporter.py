@@ -28,6 +28,7 @@ from xgds_core.flightUtils import get_or_create_flight
 from xgds_core.importer import csvImporter
 
 from geocamTrack.trackUtil import get_or_create_track, get_next_available_track_name
+from geocamTrack.positionIngest import storePastPositions
 from geocamUtil.loader import LazyGetModelByName
 
 TRACK_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_TRACK_MODEL)
@@ -50,14 +51,17 @@ class TrackCsvImporter(csvImporter.CsvImporter):
          :param utm_zone: The name of the UTM zone, ie '10S'
          :param utm_south: True if the UTM zone is southern hemisphere.
          :param timezone_name: The name of the timezone, ie America/Los_Angeles
-         :param force: True to force import even if the data was already imported.  This will duplicate data.
+         :param force: True to force import even if the data was already imported.  Rows that are already stored
+                       are overwritten, since a track has one position per timestamp.
          :param replace: True to replace existing data.
          :return: the imported items
          """
         self.track = None
         self.utm = utm
         self.utm_zone = utm_zone
+        # stored positions are unique on (track, timestamp), so forcing a reimport means replacing
         self.replace = replace
+        self.overwrite = replace or force
         if self.utm:
             # convert northing easting to latitude longitude
             south = ''
@@ -87,62 +91,83 @@ class TrackCsvImporter(csvImporter.CsvImporter):
         else:
             raise Exception('Could not create track')
 
-    def update_row(self, row):
+    def pop_utm(self, row):
         """
-        Update the row, in this case converting utm to lat long if necessary
+        Remove the easting and northing from the row
         :param row:
-        :return:
+        :return: easting, northing
+        """
+        easting = None
+        if 'easting' in row:
+            easting = row['easting']
+            del row['easting']
+        elif 'east' in row:
+            easting = row['east']
+            del row['east']
+        elif 'longitude' in row:
+            easting = row['longitude']
+        northing = None
+        if 'northing' in row:
+            northing = row['northing']
+            del row['northing']
+        elif 'north' in row:
+            northing = row['north']
+            del row['north']
+        elif 'latitude' in row:
+            northing = row['latitude']
+        return easting, northing
+
+    def convert_utm_rows(self, rows):
+        """
+        Convert utm to lat long for many rows with a single projection call
+        :param rows:
+        :return: the rows
+        """
+        if not rows:
+            return rows
+        eastings, northings = zip(*[self.pop_utm(row) for row in rows])
+        longitudes, latitudes = self.projection(list(eastings), list(northings), inverse=True)
+        for row, longitude, latitude in zip(rows, longitudes, latitudes):
+            row['longitude'] = longitude
+            row['latitude'] = latitude
+        return rows
+
+    def load_csv(self):
         """
-        row = super(TrackCsvImporter, self).update_row(row)
-        if self.utm and self.projection:
-            easting = None
-            if 'easting' in row:
-                easting = row['easting']
-                del row['easting']
-            elif 'east' in row:
-                easting = row['east']
-                del row['east']
-            elif 'longitude' in row:
-                easting = row['longitude']
-            northing = None
-            if 'northing' in row:
-                northing = row['northing']
-                del row['northing']
-            elif 'north' in row:
-                northing = row['north']
-                del row['north']
-            elif 'latitude' in row:
-                northing = row['latitude']
-
-            row['longitude'], row['latitude'] = self.projection(easting, northing, inverse=True)
-        return row
+        Load the csv file.  The base class only stores rows with update_stored_data when replacing, and
+        inserts them otherwise; past positions are unique on (track, timestamp), so every import stores its
+        rows with update_stored_data here, which skips the rows that are already stored unless overwrite is
+        set.  Rerunning an import, or importing a file that overlaps stored data, is then harmless.
+        :return: the result of the base class load
+        """
+        replace = self.replace
+        self.replace = True
+        try:
+            return super(TrackCsvImporter, self).load_csv()
+        finally:
+            self.replace = replace
 
     def update_stored_data(self, the_model, rows):
         """
-        # search for matching data based on each row, and update it.
+        Store the rows, inserting the ones that are not stored yet.  Stored rows with the same track and
+        timestamp are overwritten if overwrite is set, and skipped otherwise.
+        Rows are handled in chunks: one query per chunk finds the stored rows for the chunk's timestamps,
+        one statement inserts the new ones and, when overwriting, one updates the rest.
         :param the_model: the model we are working with
         :param rows: the cleaned up rows
         :return:
         """
-        for row in rows:
-            # TODO right now we use timestamp.
-            found = the_model.objects.filter(timestamp=row['timestamp'])
-            if self.flight:
-                found = found.filter(track=self.flight.track)
-                if found.count() != 1:
-                    print "ERROR: DID NOT FIND MATCH FOR %s" % str(row['timestamp'])
-                else:
-                    item = found[0]
-                    for key, value in row.iteritems():
-                        setattr(item, key, value)
-                    print 'UPDATED: %s ' % str(item)
-                    item.save()
-
-
-
-
-
-
-
-
-
+        chunk_size = settings.GEOCAM_TRACK_INGEST_BATCH_SIZE
+        field_names = set(f.attname for f in the_model._meta.concrete_fields if not f.primary_key)
+        for start in xrange(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            if self.utm and self.projection:
+                self.convert_utm_rows(chunk)
+
+            positions = [the_model(**dict((key, value) for key, value in row.iteritems() if key in field_names))
+                         for row in chunk]
+            inserted = storePastPositions(positions, update=self.overwrite)
+            if self.overwrite:
+                print 'UPDATED: %d rows, INSERTED: %d rows' % (len(positions) - len(inserted), len(inserted))
+            else:
+                print 'SKIPPED: %d rows, INSERTED: %d rows' % (len(positions) - len(inserted), len(inserted))
@@ -15,18 +15,139 @@
 # specific language governing permissions and limitations under the License.
 # __END_LICENSE__
 
+import glob
+import multiprocessing
+import os
+import time
+import traceback
+
 import django
 django.setup()
 
+from django.db import connections
+
 import trackCsvImporter
 
 
+def close_connections():
+    """
+    Close database connections so a forked worker opens its own instead of sharing the parent's
+    """
+    for connection in connections.all():
+        connection.close()
+
+
+def get_input_files(opts):
+    """
+    :return: the sorted list of csv files selected by the directory or glob option
+    """
+    if opts.directory:
+        paths = glob.glob(os.path.join(opts.directory, '*.csv'))
+    else:
+        paths = glob.glob(opts.glob)
+    return sorted(p for p in paths if os.path.isfile(p))
+
+
+def make_importer(opts, input_path, flight_name=None, track_name=None):
+    return trackCsvImporter.TrackCsvImporter(opts.config, input_path, opts.vehicle, flight_name or opts.flight,
+                                             track_name=track_name or opts.track, utm=opts.utm,
+                                             utm_zone=opts.zone, utm_south=opts.south,
+                                             timezone_name=opts.timezone, force=opts.reload,
+                                             replace=opts.replace)
+
+
+def resolve_jobs(opts, input_paths):
+    """
+    Resolve the flight and track for every file, one file at a time in sorted order, so that
+    new flights and track names are assigned deterministically before any worker starts.
+    :return: list of (input_path, flight_name, track_name, error)
+    """
+    jobs = []
+    for input_path in input_paths:
+        try:
+            importer = make_importer(opts, input_path)
+            flight_name = importer.flight.name if importer.flight else None
+            jobs.append((input_path, flight_name, importer.track.name, None))
+        except Exception:
+            jobs.append((input_path, None, None, traceback.format_exc()))
+    return jobs
+
+
+def import_file(args):
+    """
+    Import one file in a worker process, with its flight and track already resolved.
+    :return: dictionary summarizing the import
+    """
+    opts, input_path, flight_name, track_name = args
+    start = time.time()
+    try:
+        importer = make_importer(opts, input_path, flight_name, track_name)
+        rows = len(importer.load_csv())
+        error = None
+    except Exception:
+        rows = 0
+        error = traceback.format_exc()
+    return {'path': input_path,
+            'track': track_name,
+            'rows': rows,
+            'seconds': time.time() - start,
+            'error': error}
+
+
+def import_files(opts, input_paths):
+    """
+    Import many files with a pool of worker processes.  Each worker is set up once and imports many files.
+    :return: list of result dictionaries, in input order
+    """
+    jobs = resolve_jobs(opts, input_paths)
+    results = {}
+    work = []
+    for input_path, flight_name, track_name, error in jobs:
+        if error:
+            results[input_path] = {'path': input_path, 'track': None, 'rows': 0, 'seconds': 0, 'error': error}
+        else:
+            work.append((opts, input_path, flight_name, track_name))
+
+    close_connections()
+    pool = multiprocessing.Pool(opts.workers, initializer=close_connections)
+    try:
+        for result in pool.imap_unordered(import_file, work):
+            results[result['path']] = result
+            print '%s: %s' % (result['path'], 'FAILED' if result['error'] else 'loaded %d' % result['rows'])
+    finally:
+        pool.close()
+        pool.join()
+    return [results[input_path] for input_path in input_paths]
+
+
+def print_summary(results, elapsed):
+    print
+    print '%-50s %-30s %10s %10s' % ('file', 'track', 'rows', 'seconds')
+    for result in results:
+        print '%-50s %-30s %10d %10.1f %s' % (os.path.basename(result['path']), result['track'] or '',
+                                               result['rows'], result['seconds'],
+                                               'FAILED' if result['error'] else '')
+    failures = [result for result in results if result['error']]
+    print
+    print 'loaded %d rows from %d files in %.1f seconds, %d failed' % (sum(result['rows'] for result in results),
+                                                                       len(results) - len(failures),
+                                                                       elapsed, len(failures))
+    for result in failures:
+        print
+        print 'FAILED: %s' % result['path']
+        print result['error']
+
+
 def main():
     import optparse
 
-    parser = optparse.OptionParser('usage: -c config -i input')
+    parser = optparse.OptionParser('usage: -c config (-i input | -d directory | -g glob)')
     parser.add_option('-c', '--config', help='path to config file (yaml)')
     parser.add_option('-i', '--input', help='path to csv file to import')
+    parser.add_option('-d', '--directory', help='import every csv file in this directory')
+    parser.add_option('-g', '--glob', help='import every csv file matching this pattern, ie "logs/*/gps*.csv"')
+    parser.add_option('-j', '--workers', type='int', default=multiprocessing.cpu_count(),
+                      help='number of worker processes when importing many files [%default]')
     parser.add_option('-v', '--vehicle', help='name of vehicle')
     parser.add_option('-f', '--flight', help='name of flight')
     parser.add_option('-t', '--track', help='name of track')
@@ -41,20 +162,26 @@ def main():
 
     if not opts.config:
         parser.error('config is required')
-    if not opts.input:
-        parser.error('input is required')
+    if len([o for o in (opts.input, opts.directory, opts.glob) if o]) != 1:
+        parser.error('exactly one of input, directory or glob is required')
 
     if opts.zone:
         opts.utm = True
     else:
         opts.utm = False
 
-    importer = trackCsvImporter.TrackCsvImporter(opts.config, opts.input, opts.vehicle, opts.flight,
-                                                 track_name=opts.track, utm=opts.utm, utm_zone=opts.zone,
-                                                 utm_south=opts.south, timezone_name=opts.timezone, force=opts.reload,
-                                                 replace=opts.replace)
-    result = importer.load_csv()
-    print 'loaded %d ' % len(result)
+    if opts.input:
+        importer = make_importer(opts, opts.input)
+        result = importer.load_csv()
+        print 'loaded %d ' % len(result)
+        return
+
+    input_paths = get_input_files(opts)
+    if not input_paths:
+        parser.error('no csv files found')
+    start = time.time()
+    results = import_files(opts, input_paths)
+    print_summary(results, time.time() - start)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,234 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Incremental KML for live tracks.
+
+Regenerating tracks.kml from the full position history every refresh
+costs time proportional to the length of each track, although only a
+few positions arrived since the last refresh.  Instead, the coordinates
+of each track are rendered in time blocks of
+GEOCAM_TRACK_POSITION_CACHE_BUCKET_SECONDS, the same buckets
+positionCache uses, and each rendered fragment is kept in the Django
+cache under the version of its bucket.  Storing, changing or deleting
+past positions bumps the versions of the buckets they fall in (see
+positionCache.invalidateTimes), so a refresh renders only the blocks
+that changed, usually just the open one, and reads the rest from the
+cache.  Fragments of blocks that were never rendered are rendered in
+one read per run of consecutive blocks.
+
+Blocks cut by the start or end of the requested time range are rendered
+from the database each time, and not cached.
+
+Versions are only trusted with a cache backend shared between processes
+(see positionCache.hasSharedCache), so fragments are not used with the
+local memory or dummy backends, whatever GEOCAM_TRACK_KML_BLOCK_CACHE says.
+"""
+
+import itertools
+from StringIO import StringIO
+
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Min, Max
+
+from geocamTrack.arrayMath import distanceMeters
+from geocamTrack.kmlStream import drainBuffer
+from geocamTrack.models import KML_LINE_BREAK, KML_LINE_END, PAST_POSITION_MODEL, \
+    hasPlainCoordinatesKml, getLineBreaks, formatCoordinatesKml
+from geocamTrack.positionCache import getBucket, getBucketMicros, getVersionKey, getVersions, hasSharedCache, \
+    toMicros, fromMicros
+
+FRAGMENT_KEY_PREFIX = 'geocamTrack.kmlBlocks'
+
+# blocks looked up in the cache at a time
+BLOCK_BATCH_SIZE = 500
+
+EMPTY_FRAGMENT = dict(count=0, first=None, last=None, text='')
+
+
+def isEnabled():
+    return settings.GEOCAM_TRACK_KML_BLOCK_CACHE and hasSharedCache()
+
+
+def canUseBlocks():
+    """ True if track lines can be assembled from fragments: past positions write their coordinates the standard way """
+    return isEnabled() and hasPlainCoordinatesKml(PAST_POSITION_MODEL.get())
+
+
+def renderFragment(lonLat, breakDist):
+    """
+    The KML coordinates of the positions of one block, an N x 2 array of
+    longitude, latitude, with the line breaks inside the block.  Returns a
+    dictionary with the count, first and last coordinates and text.
+    """
+    if not len(lonLat):
+        return EMPTY_FRAGMENT
+    starts = [0]
+    if breakDist is not None:
+        starts.extend(getLineBreaks(None, lonLat, breakDist))
+    starts.append(len(lonLat))
+    text = KML_LINE_BREAK.join(formatCoordinatesKml(lonLat[starts[i]:starts[i + 1]])
+                               for i in xrange(len(starts) - 1))
+    return dict(count=len(lonLat),
+                first=tuple(lonLat[0]),
+                last=tuple(lonLat[-1]),
+                text=text)
+
+
+def iterFragmentText(fragments, breakDist):
+    """ Join fragments into KML coordinates, breaking the line between fragments as within them """
+    last = None
+    for fragment in fragments:
+        if not fragment['count']:
+            continue
+        if last is not None and breakDist is not None:
+            dist = distanceMeters(last[0], last[1], fragment['first'][0], fragment['first'][1])
+            if dist > breakDist:
+                # start new line string
+                yield KML_LINE_BREAK
+        yield fragment['text']
+        last = fragment['last']
+
+
+def getFragmentKey(trackId, block, version):
+    return '%s.%s.%s.%s' % (FRAGMENT_KEY_PREFIX, trackId, block, version)
+
+
+def iterRangeFragments(track, startMicros, endMicros, breakDist):
+    """
+    Render the blocks from the one containing startMicros to the one
+    containing endMicros, inclusive, in one read of the positions between
+    them.  Generates (block, fragment), including empty blocks.
+    """
+    aware = settings.USE_TZ
+    rows = (track.getPositions()
+            .filter(timestamp__gte=fromMicros(startMicros, aware),
+                    timestamp__lte=fromMicros(endMicros, aware))
+            .order_by('timestamp')
+            .values_list('timestamp', 'longitude', 'latitude')
+            .iterator())
+    nextBlock = getBucket(startMicros)
+    for block, group in itertools.groupby(rows, key=lambda row: getBucket(toMicros(row[0]))):
+        for empty in xrange(nextBlock, block):
+            yield empty, EMPTY_FRAGMENT
+        lonLat = np.array([(row[1], row[2]) for row in group], dtype=float)
+        yield block, renderFragment(lonLat, breakDist)
+        nextBlock = block + 1
+    for empty in xrange(nextBlock, getBucket(endMicros) + 1):
+        yield empty, EMPTY_FRAGMENT
+
+
+def iterCachedFragments(track, firstBlock, lastBlock, breakDist):
+    """
+    Fragments of whole blocks firstBlock to lastBlock, inclusive, from the
+    cache where their version is current, rendering and caching the rest.
+    """
+    bucketMicros = getBucketMicros()
+    timeout = settings.GEOCAM_TRACK_KML_BLOCK_CACHE_SECONDS
+    for batchStart in xrange(firstBlock, lastBlock + 1, BLOCK_BATCH_SIZE):
+        blocks = range(batchStart, min(batchStart + BLOCK_BATCH_SIZE, lastBlock + 1))
+        versions = getVersions([getVersionKey(track.pk, block) for block in blocks])
+        keys = dict((block, getFragmentKey(track.pk, block, versions[getVersionKey(track.pk, block)]))
+                    for block in blocks)
+        cached = cache.get_many(keys.values())
+
+        i = 0
+        while i < len(blocks):
+            fragment = cached.get(keys[blocks[i]])
+            if fragment is not None:
+                yield fragment
+                i += 1
+                continue
+            # render the run of blocks that are not cached in one read
+            j = i
+            while j < len(blocks) and keys[blocks[j]] not in cached:
+                j += 1
+            for block, fragment in iterRangeFragments(track, blocks[i] * bucketMicros,
+                                                      blocks[j - 1] * bucketMicros + bucketMicros - 1,
+                                                      breakDist):
+                cache.set(keys[block], fragment, timeout)
+                yield fragment
+            i = j
+
+
+def getBounds(track, start=None, end=None):
+    """ (first, last) timestamp in microseconds of a track's positions between start and end, inclusive, or None """
+    positions = track.getPositions()
+    if start is not None:
+        positions = positions.filter(timestamp__gte=start)
+    if end is not None:
+        positions = positions.filter(timestamp__lte=end)
+    result = positions.aggregate(first=Min('timestamp'), last=Max('timestamp'))
+    if result['first'] is None:
+        return None
+    return toMicros(result['first']), toMicros(result['last'])
+
+
+def iterTrackFragments(track, start=None, end=None):
+    """ Fragments of a track's line between start and end, inclusive, in time order """
+    # read from the database, so positions stored by other processes are included
+    bounds = getBounds(track, start, end)
+    if bounds is None:
+        return
+    lo, hi = bounds
+
+    breakDist = settings.GEOCAM_TRACK_START_NEW_LINE_DISTANCE_METERS
+    bucketMicros = getBucketMicros()
+    firstBlock = getBucket(lo)
+    lastBlock = getBucket(hi)
+    firstWhole = firstBlock
+    lastWhole = lastBlock
+    if start is not None and toMicros(start) > firstBlock * bucketMicros:
+        firstWhole += 1
+    if end is not None and toMicros(end) < (lastBlock + 1) * bucketMicros - 1:
+        lastWhole -= 1
+
+    if firstWhole > lastWhole:
+        # no whole block, at most two cut ones
+        for _block, fragment in iterRangeFragments(track, lo, hi, breakDist):
+            yield fragment
+        return
+    if firstWhole > firstBlock:
+        for _block, fragment in iterRangeFragments(track, lo, firstWhole * bucketMicros - 1, breakDist):
+            yield fragment
+    for fragment in iterCachedFragments(track, firstWhole, lastWhole, breakDist):
+        yield fragment
+    if lastWhole < lastBlock:
+        for _block, fragment in iterRangeFragments(track, (lastWhole + 1) * bucketMicros, hi, breakDist):
+            yield fragment
+
+
+def iterTrackBlockKml(track, start=None, end=None, lineStyle=None, urlFn=None):
+    """
+    The KML of track.iterTrackKml for the positions between start and end,
+    inclusive, assembled from block fragments.  Nothing is generated for
+    fewer than two positions.
+    """
+    if lineStyle is None:
+        lineStyle = track.lineStyle
+    fragments = iterTrackFragments(track, start, end)
+    first = []
+    count = 0
+    for fragment in fragments:
+        first.append(fragment)
+        count += fragment['count']
+        if count >= 2:
+            break
+    if count < 2:
+        # kml LineString requires 2 or more positions
+        return
+
+    out = StringIO()
+    track.writeTrackKmlHeader(out, lineStyle, urlFn, False)
+    yield drainBuffer(out)
+    for text in iterFragmentText(itertools.chain(first, fragments),
+                                 settings.GEOCAM_TRACK_START_NEW_LINE_DISTANCE_METERS):
+        yield text
+    yield KML_LINE_END
+    yield "</Folder>\n"
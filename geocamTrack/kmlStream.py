@@ -0,0 +1,242 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Streaming KML responses.
+
+KML for a long track can run to tens of MB.  Rather than building the
+whole document in memory, views return a StreamingHttpResponse over a
+generator of KML chunks, written as positions are read from the
+database, so memory use is bounded by the chunk size and the first bytes
+go out before the last position is read.
+
+cache_page never caches streaming responses, so views that were cached
+use cacheStreamingPage instead: a cache hit is served as before, and on
+a miss the chunks are copied into the cache as they stream out, once the
+whole document has been sent.
+
+KML compresses about 10x.  Views decorated with compressedKmlPage answer
+with KMZ, a zip archive holding doc.kml, when the URL ends in .kmz or
+has format=kmz, and otherwise with gzip content-encoding for clients
+that accept it.  Both are compressed chunk by chunk as the KML streams.
+"""
+
+import struct
+import time
+import zlib
+from functools import wraps
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, StreamingHttpResponse
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import get_cache_key, learn_cache_key, patch_response_headers
+
+from geocamUtil.KmlUtil import wrapKml
+
+KML_CONTENT_TYPE = 'application/vnd.google-earth.kml+xml'
+KMZ_CONTENT_TYPE = 'application/vnd.google-earth.kmz'
+KML_BODY_MARKER = '<!-- geocamTrack.kmlStream body -->'
+
+# name of the KML file in a KMZ archive
+KMZ_DOC_NAME = 'doc.kml'
+KMZ_COMPRESSION_LEVEL = 6
+
+ZIP_LOCAL_HEADER = '<IHHHHHIIIHH'
+ZIP_DATA_DESCRIPTOR = '<IIII'
+ZIP_CENTRAL_HEADER = '<IHHHHHHIIIHHHHHII'
+ZIP_END_RECORD = '<IHHHHIIH'
+# general purpose flag: sizes and crc follow the data
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_VERSION = 20
+
+
+def drainBuffer(buf):
+    """ Return what was written to a StringIO buffer and empty it """
+    text = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return text
+
+
+def getKmlWrapper():
+    """ (head, tail) that wrapKml puts around a KML body """
+    head, tail = wrapKml(KML_BODY_MARKER).split(KML_BODY_MARKER, 1)
+    return head, tail
+
+
+def iterWrappedKml(chunks):
+    """ Wrap a generator of KML body chunks the way wrapKml wraps text """
+    head, tail = getKmlWrapper()
+    yield head
+    for chunk in chunks:
+        yield chunk
+    yield tail
+
+
+def iterChunks(writeFunctions):
+    """
+    Adapt functions that write KML to a file-like object into a generator
+    of chunks: each function is called with a buffer, which is drained
+    after it returns.
+    """
+    buf = StringIO()
+    for writeFunction in writeFunctions:
+        writeFunction(buf)
+        text = drainBuffer(buf)
+        if text:
+            yield text
+
+
+def getKmlResponse(chunks):
+    return StreamingHttpResponse(chunks, content_type=KML_CONTENT_TYPE)
+
+
+def iterTee(chunks, onComplete, maxBytes):
+    """
+    Pass chunks through, keeping a copy.  If all of them were passed
+    through and they add up to no more than maxBytes, call onComplete
+    with the full content.
+    """
+    copy = []
+    size = 0
+    for chunk in chunks:
+        if copy is not None:
+            size += len(chunk)
+            if size > maxBytes:
+                copy = None
+            else:
+                copy.append(chunk)
+        yield chunk
+    if copy is not None:
+        onComplete(''.join(copy))
+
+
+def cacheStreamingPage(timeout, cache_alias=None, key_prefix=None):
+    """
+    Like cache_page, for views that return a StreamingHttpResponse.  A
+    streamed response is cached once it has been sent in full, if it is
+    no larger than GEOCAM_TRACK_STREAM_CACHE_MAX_BYTES.
+    """
+    if cache_alias is None:
+        cache_alias = settings.CACHE_MIDDLEWARE_ALIAS
+    if key_prefix is None:
+        key_prefix = settings.CACHE_MIDDLEWARE_KEY_PREFIX
+
+    def decorator(viewFunc):
+        @wraps(viewFunc)
+        def wrapper(request, *args, **kwargs):
+            cache = caches[cache_alias]
+            if request.method not in ('GET', 'HEAD'):
+                return viewFunc(request, *args, **kwargs)
+
+            cacheKey = get_cache_key(request, key_prefix, 'GET', cache=cache)
+            if cacheKey is not None:
+                cached = cache.get(cacheKey)
+                if cached is not None:
+                    return cached
+
+            response = viewFunc(request, *args, **kwargs)
+            if not response.streaming or response.status_code != 200:
+                return response
+            patch_response_headers(response, timeout)
+
+            def store(content):
+                complete = HttpResponse(content, status=response.status_code)
+                for header, value in response.items():
+                    complete[header] = value
+                cache.set(learn_cache_key(request, complete, timeout, key_prefix, cache=cache),
+                          complete, timeout)
+
+            response.streaming_content = iterTee(response.streaming_content, store,
+                                                 settings.GEOCAM_TRACK_STREAM_CACHE_MAX_BYTES)
+            return response
+        return wrapper
+    return decorator
+
+
+def getDosDateTime(t=None):
+    """ (date, time) of the local time t, seconds since the epoch, in the MS-DOS format zip uses """
+    year, month, day, hour, minute, second = time.localtime(t)[:6]
+    year = max(year, 1980)
+    return (((year - 1980) << 9) | (month << 5) | day,
+            (hour << 11) | (minute << 5) | (second // 2))
+
+
+def iterKmz(chunks, name=KMZ_DOC_NAME):
+    """
+    Zip KML chunks into a KMZ archive holding one deflated file, as a
+    generator of chunks.  The crc and sizes go in a data descriptor after
+    the file data, so nothing is buffered beyond what zlib holds.  Without
+    zip64, the KML must be less than 4 GB.
+    """
+    dosDate, dosTime = getDosDateTime()
+    header = struct.pack(ZIP_LOCAL_HEADER, 0x04034b50, ZIP_VERSION, ZIP_FLAG_DATA_DESCRIPTOR,
+                         zlib.DEFLATED, dosTime, dosDate, 0, 0, 0, len(name), 0) + name
+    yield header
+
+    compressor = zlib.compressobj(KMZ_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    compressedSize = 0
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        data = compressor.compress(chunk)
+        if data:
+            compressedSize += len(data)
+            yield data
+    data = compressor.flush()
+    compressedSize += len(data)
+    crc &= 0xffffffff
+
+    descriptor = struct.pack(ZIP_DATA_DESCRIPTOR, 0x08074b50, crc, compressedSize, size)
+    central = struct.pack(ZIP_CENTRAL_HEADER, 0x02014b50, ZIP_VERSION, ZIP_VERSION, ZIP_FLAG_DATA_DESCRIPTOR,
+                          zlib.DEFLATED, dosTime, dosDate, crc, compressedSize, size, len(name),
+                          0, 0, 0, 0, 0, 0) + name
+    end = struct.pack(ZIP_END_RECORD, 0x06054b50, 0, 0, 1, 1, len(central),
+                      len(header) + compressedSize + len(descriptor), 0)
+    yield data + descriptor + central + end
+
+
+def isKmzRequest(request):
+    """ KMZ is asked for with a URL ending in .kmz or format=kmz """
+    return request.path.endswith('.kmz') or request.GET.get('format') == 'kmz'
+
+
+def getKmzResponse(response):
+    """ Turn a KML response, streaming or not, into a streaming KMZ response with the same headers """
+    if response.streaming:
+        chunks = response.streaming_content
+    else:
+        chunks = [response.content]
+    kmz = StreamingHttpResponse(iterKmz(chunks), content_type=KMZ_CONTENT_TYPE, status=response.status_code)
+    for header, value in response.items():
+        if header.lower() not in ('content-type', 'content-length'):
+            kmz[header] = value
+    return kmz
+
+
+def compressedKmlPage(viewFunc):
+    """
+    Compress the KML a view returns: as KMZ if isKmzRequest, otherwise
+    with gzip content-encoding if the client accepts it.  Put it below
+    cacheStreamingPage, so the compressed response is what gets cached.
+    """
+    gzipMiddleware = GZipMiddleware()
+
+    @wraps(viewFunc)
+    def wrapper(request, *args, **kwargs):
+        response = viewFunc(request, *args, **kwargs)
+        if response.status_code != 200 or not response.get('Content-Type', '').startswith(KML_CONTENT_TYPE):
+            return response
+        if isKmzRequest(request):
+            return getKmzResponse(response)
+        return gzipMiddleware.process_response(request, response)
+    return wrapper
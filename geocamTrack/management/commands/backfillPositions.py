@@ -0,0 +1,49 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Fill in the position of every asset of an AbstractTrackedAsset model that
+has not been looked up yet, instead of leaving it to getPosition() one
+asset at a time.  Safe to interrupt and run again.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.models import AbstractTrackedAsset
+from geocamTrack.timeAlign import backfillTrackedAssetPositions
+
+
+class Command(BaseCommand):
+    help = 'Look up positions for tracked assets that do not have one yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model',
+                            help='the tracked asset model, ie xgds_image.ImageSet')
+        parser.add_argument('--chunkSize', type=int, default=settings.GEOCAM_TRACK_INGEST_BATCH_SIZE,
+                            help='assets to resolve per bulk update')
+        parser.add_argument('--maxSeconds', type=float,
+                            default=settings.GEOCAM_TRACK_CLOSEST_POSITION_MAX_DIFFERENCE_SECONDS,
+                            help='largest time difference between an asset and its position')
+
+    def handle(self, *args, **options):
+        try:
+            model = LazyGetModelByName(options['model']).get()
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not issubclass(model, AbstractTrackedAsset) or model._meta.abstract:
+            raise CommandError('%s is not a concrete AbstractTrackedAsset model' % options['model'])
+
+        def progress(count, seconds):
+            self.stdout.write('%d assets in %.1f seconds (%.0f/s)' % (count, seconds, count / max(seconds, 1e-6)))
+
+        count = backfillTrackedAssetPositions(model,
+                                              chunkSize=options['chunkSize'],
+                                              maxSeconds=options['maxSeconds'],
+                                              progress=progress)
+        self.stdout.write('resolved %d assets' % count)
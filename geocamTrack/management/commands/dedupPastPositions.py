@@ -0,0 +1,62 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Delete duplicate past positions, so the unique (track, timestamp)
+constraint can be added to an existing table.  Of each set of positions
+with the same track and timestamp, the most recently stored one (highest
+primary key) is kept.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.positionIngest import getTimestampKey
+from geocamTrack.positionCache import invalidateTimes
+
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+
+
+class Command(BaseCommand):
+    help = 'Delete past positions that repeat the track and timestamp of another position'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dryRun', action='store_true', default=False,
+                            help='count duplicates without deleting them')
+
+    def handle(self, *args, **options):
+        model = PAST_POSITION_MODEL.get()
+        batchSize = settings.GEOCAM_TRACK_INGEST_BATCH_SIZE
+        groups = list(model.objects
+                      .values('track_id', 'timestamp')
+                      .annotate(count=Count('pk'), keep=Max('pk'))
+                      .filter(count__gt=1)
+                      .values_list('track_id', 'timestamp', 'keep'))
+
+        deleted = 0
+        for start in xrange(0, len(groups), batchSize):
+            chunk = groups[start:start + batchSize]
+            keep = dict(((trackId, getTimestampKey(timestamp)), pk) for trackId, timestamp, pk in chunk)
+            rows = (model.objects
+                    .filter(track_id__in=set(trackId for trackId, _t, _pk in chunk),
+                            timestamp__in=set(timestamp for _id, timestamp, _pk in chunk))
+                    .values_list('pk', 'track_id', 'timestamp'))
+            extra = [(pk, trackId, timestamp) for pk, trackId, timestamp in rows
+                     if keep.get((trackId, getTimestampKey(timestamp)), pk) != pk]
+            deleted += len(extra)
+            if not options['dryRun']:
+                with transaction.atomic():
+                    model.objects.filter(pk__in=[pk for pk, _id, _t in extra]).delete()
+                invalidateTimes((trackId, timestamp) for _pk, trackId, timestamp in extra)
+
+        if options['dryRun']:
+            self.stdout.write('%d duplicate positions in %d groups' % (deleted, len(groups)))
+        else:
+            self.stdout.write('deleted %d duplicate positions in %d groups' % (deleted, len(groups)))
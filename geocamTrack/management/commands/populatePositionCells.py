@@ -0,0 +1,60 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Fill in the spatial grid cell (see geocamTrack.spatialIndex) of past
+positions stored before the cell column existed.  Positions are read in
+primary key order in chunks, and each chunk is written with one bulk
+update in its own transaction, so the command can be interrupted and run
+again.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.spatialIndex import getCell
+from geocamTrack.trackUtil import bulk_update_rows
+
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+
+
+class Command(BaseCommand):
+    help = 'Fill in the spatial grid cell of past positions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='renumber every position, e.g. after changing GEOCAM_TRACK_SPATIAL_CELL_DEGREES')
+        parser.add_argument('--chunkSize', type=int, default=settings.GEOCAM_TRACK_INGEST_BATCH_SIZE,
+                            help='positions per bulk update')
+
+    def handle(self, *args, **options):
+        model = PAST_POSITION_MODEL.get()
+        positions = model.objects.order_by('pk')
+        if not options['all']:
+            positions = positions.filter(cell__isnull=True)
+
+        startTime = time.time()
+        count = 0
+        lastPk = None
+        while True:
+            query = positions
+            if lastPk is not None:
+                query = query.filter(pk__gt=lastPk)
+            rows = list(query.values_list('pk', 'latitude', 'longitude')[:options['chunkSize']])
+            if not rows:
+                break
+            lastPk = rows[-1][0]
+            with transaction.atomic():
+                bulk_update_rows(model, dict((pk, dict(cell=getCell(latitude, longitude)))
+                                             for pk, latitude, longitude in rows))
+            count += len(rows)
+            self.stdout.write('%d positions, %.0f per second' % (count, count / (time.time() - startTime)))
+        self.stdout.write('filled in the cell of %d positions' % count)
@@ -0,0 +1,56 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Rebuild the per-minute position rollups (see geocamTrack.positionRollup)
+from the past positions, for all tracks or the named ones.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack import positionRollup
+
+TRACK_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_TRACK_MODEL)
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-minute position rollups from the past positions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('track', nargs='*',
+                            help='names of the tracks to rebuild; all tracks if none are given')
+
+    def handle(self, *args, **options):
+        if options['track']:
+            trackIds = list(TRACK_MODEL.get().objects
+                            .filter(name__in=options['track'])
+                            .values_list('pk', flat=True))
+        else:
+            trackIds = list(PAST_POSITION_MODEL.get().objects
+                            .order_by('track')
+                            .values_list('track', flat=True)
+                            .distinct())
+            # rollups of tracks that no longer have positions
+            (positionRollup.ROLLUP_MODEL.get().objects
+             .exclude(track_id__in=trackIds)
+             .delete())
+
+        startTime = time.time()
+        total = 0
+        for trackId in trackIds:
+            if trackId is None:
+                continue
+            count = positionRollup.rebuildRollups(trackId)
+            total += count
+            self.stdout.write('track %s: %d minutes' % (trackId, count))
+        self.stdout.write('rebuilt %d minutes of %d tracks in %.1f seconds'
+                          % (total, len(trackIds), time.time() - startTime))
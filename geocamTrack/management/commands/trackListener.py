@@ -0,0 +1,187 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Listen for binary position frames (see geocamTrack.positionFrame) on UDP
+and/or TCP and store them, without going through the web server.
+
+Frames are decoded in batches and stored with
+positionIngest.ingestPositions(), the same path postPosition uses, so
+current positions are updated and broadcast as usual.  Positions go to
+the active flight's track for each vehicle.
+"""
+
+import logging
+import select
+import socket
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, DatabaseError
+
+from geocamTrack import positionIngest
+from geocamTrack.positionFrame import decodeFrames, splitFrames
+
+# largest UDP datagram we read
+MAX_DATAGRAM_SIZE = 65535
+
+
+class Command(BaseCommand):
+    help = 'Listen for binary position frames on UDP and/or TCP and store them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0',
+                            help='address to listen on')
+        parser.add_argument('--udp', type=int, default=None,
+                            help='UDP port to listen on')
+        parser.add_argument('--tcp', type=int, default=None,
+                            help='TCP port to listen on')
+        parser.add_argument('--batchSize', type=int, default=1000,
+                            help='store positions once this many are waiting')
+        parser.add_argument('--flushSeconds', type=float, default=0.5,
+                            help='store positions at least this often')
+
+    def handle(self, *args, **options):
+        if options['udp'] is None and options['tcp'] is None:
+            raise CommandError('specify --udp and/or --tcp')
+        listener = PositionListener(options['host'],
+                                    udpPort=options['udp'],
+                                    tcpPort=options['tcp'],
+                                    batchSize=options['batchSize'],
+                                    flushSeconds=options['flushSeconds'])
+        try:
+            listener.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+
+
+class PositionListener(object):
+    def __init__(self, host, udpPort=None, tcpPort=None, batchSize=1000, flushSeconds=0.5):
+        self.batchSize = batchSize
+        self.flushSeconds = flushSeconds
+        self.udpSocket = None
+        self.tcpSocket = None
+        # tcp client socket -> bytes of a partial frame
+        self.clients = {}
+        self.pending = []
+        self.pendingSince = None
+        # after a failed flush, pending frames are not stored again before this time
+        self.retryTime = None
+        self.storedCount = 0
+        self.errorCount = 0
+
+        if udpPort is not None:
+            self.udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.udpSocket.bind((host, udpPort))
+            logging.info('listening for position frames on udp %s:%s', host, udpPort)
+        if tcpPort is not None:
+            self.tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.tcpSocket.bind((host, tcpPort))
+            self.tcpSocket.listen(16)
+            logging.info('listening for position frames on tcp %s:%s', host, tcpPort)
+
+    def getSockets(self):
+        sockets = self.clients.keys()
+        if self.udpSocket is not None:
+            sockets.append(self.udpSocket)
+        if self.tcpSocket is not None:
+            sockets.append(self.tcpSocket)
+        return sockets
+
+    def getTimeout(self):
+        if self.pendingSince is None:
+            return None
+        return max(0, self.pendingSince + self.flushSeconds - time.time())
+
+    def addFrames(self, data):
+        if not data:
+            return
+        if self.pendingSince is None:
+            self.pendingSince = time.time()
+        self.pending.extend(decodeFrames(data))
+
+    def readUdp(self):
+        data = self.udpSocket.recv(MAX_DATAGRAM_SIZE)
+        frames, extra = splitFrames(data)
+        if extra:
+            logging.warning('dropping %d bytes of a partial frame from a udp datagram', len(extra))
+        self.addFrames(frames)
+
+    def acceptTcp(self):
+        client, address = self.tcpSocket.accept()
+        logging.info('tcp position client connected from %s:%s', *address)
+        self.clients[client] = ''
+
+    def readTcp(self, client):
+        try:
+            data = client.recv(MAX_DATAGRAM_SIZE)
+        except socket.error as e:
+            logging.warning('tcp client error: %s', e)
+            data = ''
+        if not data:
+            if self.clients[client]:
+                logging.warning('tcp client closed with %d bytes of a partial frame',
+                                len(self.clients[client]))
+            del self.clients[client]
+            client.close()
+            return
+        frames, extra = splitFrames(self.clients[client] + data)
+        self.clients[client] = extra
+        self.addFrames(frames)
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending = self.pending
+        entries = [(vehicleId, None, attrs) for vehicleId, attrs in pending]
+        self.pending = []
+        self.pendingSince = None
+
+        close_old_connections()
+        try:
+            statuses = positionIngest.ingestPositions(entries)
+        except DatabaseError:
+            # nothing was stored; keep the frames and try again after flushSeconds
+            logging.exception('could not store %d positions, will retry', len(entries))
+            self.pending = pending + self.pending
+            self.pendingSince = time.time()
+            self.retryTime = self.pendingSince + self.flushSeconds
+            return
+        self.retryTime = None
+        errors = {}
+        for status in statuses:
+            if status['status'] == 'error':
+                errors[status['message']] = errors.get(status['message'], 0) + 1
+        for message, count in errors.iteritems():
+            logging.warning('could not store %d positions: %s', count, message)
+        self.errorCount += sum(errors.itervalues())
+        self.storedCount += len(statuses) - sum(errors.itervalues())
+
+    def run(self):
+        while True:
+            readable, _w, _x = select.select(self.getSockets(), [], [], self.getTimeout())
+            for sock in readable:
+                if sock is self.udpSocket:
+                    self.readUdp()
+                elif sock is self.tcpSocket:
+                    self.acceptTcp()
+                else:
+                    self.readTcp(sock)
+            if not self.pending or (self.retryTime is not None and time.time() < self.retryTime):
+                continue
+            if len(self.pending) >= self.batchSize or self.getTimeout() == 0:
+                self.flush()
+
+    def close(self):
+        self.flush()
+        for sock in self.getSockets():
+            sock.close()
+        self.clients = {}
+        logging.info('stored %d positions, %d errors', self.storedCount, self.errorCount)
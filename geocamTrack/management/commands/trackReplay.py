@@ -0,0 +1,95 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Test client for the trackListener command: replay positions from a csv
+file as binary position frames.
+
+The csv file needs a header row with the columns vehicle, timestamp,
+latitude and longitude, and optionally altitude and heading.  vehicle is
+the vehicle id and timestamp is ISO 8601; naive times are taken as UTC.
+"""
+
+import csv
+import socket
+import time
+
+import iso8601
+import pytz
+
+from django.core.management.base import BaseCommand, CommandError
+
+from geocamTrack.positionFrame import packFrame
+
+
+def readFrames(path):
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            timestamp = iso8601.parse_date(row['timestamp'], default_timezone=pytz.utc)
+            timestamp = timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+            altitude = row.get('altitude')
+            heading = row.get('heading')
+            yield timestamp, packFrame(int(row['vehicle']),
+                                       timestamp,
+                                       float(row['latitude']),
+                                       float(row['longitude']),
+                                       float(altitude) if altitude else None,
+                                       float(heading) if heading else None)
+
+
+class Command(BaseCommand):
+    help = 'Replay a csv file of positions to trackListener as binary frames'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path',
+                            help='csv file to replay')
+        parser.add_argument('--host', default='127.0.0.1',
+                            help='trackListener host')
+        parser.add_argument('--udp', type=int, default=None,
+                            help='send to this UDP port')
+        parser.add_argument('--tcp', type=int, default=None,
+                            help='send to this TCP port')
+        parser.add_argument('--framesPerPacket', type=int, default=1,
+                            help='frames to send in each UDP datagram or TCP write')
+        parser.add_argument('--speed', type=float, default=0,
+                            help='replay at this multiple of the recorded rate; 0 sends as fast as possible')
+
+    def handle(self, *args, **options):
+        if (options['udp'] is None) == (options['tcp'] is None):
+            raise CommandError('specify one of --udp or --tcp')
+        if options['udp'] is not None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((options['host'], options['udp']))
+        else:
+            sock = socket.create_connection((options['host'], options['tcp']))
+
+        speed = options['speed']
+        startTime = time.time()
+        firstTimestamp = None
+        packet = []
+        count = 0
+        try:
+            for timestamp, frame in readFrames(options['path']):
+                if speed:
+                    if firstTimestamp is None:
+                        firstTimestamp = timestamp
+                    delay = ((timestamp - firstTimestamp).total_seconds() / speed -
+                             (time.time() - startTime))
+                    if delay > 0:
+                        if packet:
+                            sock.sendall(''.join(packet))
+                            packet = []
+                        time.sleep(delay)
+                packet.append(frame)
+                count += 1
+                if len(packet) >= options['framesPerPacket']:
+                    sock.sendall(''.join(packet))
+                    packet = []
+            if packet:
+                sock.sendall(''.join(packet))
+        finally:
+            sock.close()
+        self.stdout.write('sent %d frames in %.1f seconds' % (count, time.time() - startTime))
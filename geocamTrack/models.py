@@ -4,18 +4,21 @@
 # All rights reserved.
 # __END_LICENSE__
 
+import bisect
 import calendar
 import datetime
-import logging
+import itertools
 from math import pi, cos, sin
 import urllib
 import pytz
 import json
+from StringIO import StringIO
 
+import numpy as np
 
 from django.core.urlresolvers import reverse
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.conf import settings
 from django.utils import timezone
@@ -30,6 +33,11 @@ from geocamUtil.datetimeJsonEncoder import DatetimeJsonEncoder
 from geocamUtil.usng import usng
 from xgds_core.models import SearchableModel, HasVehicle, HasFlight, downsample_queryset, BroadcastMixin
 
+from geocamTrack import positionCache, positionRollup, orientation, spatialIndex, proximity, simplify
+from geocamTrack.arrayMath import distanceMeters, toFloatArray
+from geocamTrack.positionCache import invalidateTimes
+from geocamTrack.kmlStream import drainBuffer
+
 if settings.XGDS_CORE_REDIS:
     from xgds_core.redisUtil import publishRedisSSE
 
@@ -39,6 +47,40 @@ latestRequestG = None
 POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_POSITION_MODEL)
 PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
 
+# streamed KML is handed out in chunks of about this many bytes, see kmlStream
+KML_CHUNK_BYTES = 64 * 1024
+# positions read at a time by AbstractTrack.iterTrackKmlFromRows
+KML_ROW_CHUNK_SIZE = 5000
+
+KML_LINE_BREAK = """
+      </coordinates>
+    </LineString>
+    <LineString>
+      <tessellate>1</tessellate>
+      <coordinates>
+"""
+
+KML_LINE_END = """
+      </coordinates>
+    </LineString>
+  </MultiGeometry>
+</Placemark>
+"""
+
+KML_ANIMATED_PLACEMARK = """        <Placemark>
+            <TimeSpan>
+                <begin>%04d-%02d-%02dT%02d:%02d:%02d%s</begin>
+                <end>%04d-%02d-%02dT%02d:%02d:%02d%s</end>
+            </TimeSpan>
+            <styleUrl>#%s</styleUrl>
+            <gx:balloonVisibility>1</gx:balloonVisibility>
+            <Point>
+                <coordinates>%.6f,%.6f,0
+                </coordinates>
+            </Point>
+        </Placemark>
+"""
+
 
 def getModClass(name):
     """converts 'app_name.ModelName' to ['stuff.module', 'ClassName']"""
@@ -149,6 +191,49 @@ def timeDeltaTotalSeconds(delta):
     return 86400 * delta.days + delta.seconds + 1e-6 * delta.microseconds
 
 
+def iterPositions(positions):
+    """ Iterate a queryset without caching its rows, or any other sequence of positions """
+    if isinstance(positions, models.QuerySet):
+        return positions.iterator()
+    return iter(positions)
+
+
+def hasPlainCoordinatesKml(model):
+    """ True if a position model writes KML coordinates the way AbstractResourcePosition does """
+    return getattr(model.writeCoordinatesKml, '__func__', None) is AbstractResourcePosition.writeCoordinatesKml.__func__
+
+
+def iterCoordinateChunks(positions, chunkSize):
+    """ Read a queryset of positions once, as (timestamps, N x 2 array of longitude, latitude) chunks """
+    rows = positions.values_list('timestamp', 'longitude', 'latitude').iterator()
+    while True:
+        chunk = list(itertools.islice(rows, chunkSize))
+        if not chunk:
+            return
+        yield ([row[0] for row in chunk],
+               np.array([(row[1], row[2]) for row in chunk], dtype=float))
+
+
+def getLineBreaks(lastLonLat, lonLat, breakDist):
+    """
+    Indices of the coordinates in lonLat that are more than breakDist
+    meters from the one before, lastLonLat for the first if given.
+    """
+    if lastLonLat is not None:
+        points = np.vstack((lastLonLat, lonLat))
+        offset = 0
+    else:
+        points = lonLat
+        offset = 1
+    dist = distanceMeters(points[:-1, 0], points[:-1, 1], points[1:, 0], points[1:, 1])
+    return (np.nonzero(dist > breakDist)[0] + offset).tolist()
+
+
+def formatCoordinatesKml(lonLat):
+    """ The text writeCoordinatesKml writes for each row of an N x 2 longitude, latitude array """
+    return ('%.6f,%.6f,0\n' * len(lonLat)) % tuple(lonLat.ravel())
+
+
 def getTimeSpinner(timestamp):
     secondSinceEpoch = calendar.timegm(timestamp.timetuple())
     index = int(secondSinceEpoch) % 4
@@ -159,6 +244,18 @@ def posixTimestampFromDatetime(dt):
     return calendar.timegm(dt.timetuple())
 
 
+def getCurrentPositionPk(model, trackId):
+    """
+    Primary key of the current position row of a track.  Read each time
+    rather than remembered, since the row can be deleted and created
+    again, by another process too.
+    """
+    return (model.objects
+            .filter(track_id=trackId)
+            .values_list('pk', flat=True)
+            .first())
+
+
 def getKmlUrl(trackName=None,
               recent=False, cached=False,
               startTime=None, endTime=None,
@@ -396,8 +493,11 @@ class AbstractTrack(SearchableModel, UuidModel, HasVehicle, HasFlight):
         out.write("        <open>0</open>\n")
 
         #         out.write('      <visibility>1</visibility>\n')
-        numPositions = len(positions) - 1
-        for i, pos in enumerate(positions):
+        # each placemark ends when the next one begins, so look one position ahead
+        positions = iter(positions)
+        pos = next(positions, None)
+        while pos is not None:
+            nextpos = next(positions, None)
             # start new line string
             out.write("        <Placemark>\n")
             out.write("            <TimeSpan>\n")
@@ -407,8 +507,7 @@ class AbstractTrack(SearchableModel, UuidModel, HasVehicle, HasFlight):
             out.write("                <begin>%04d-%02d-%02dT%02d:%02d:%02d%s</begin>\n" %
                       (begin.year, begin.month, begin.day,
                        begin.hour, begin.minute, begin.second, tzoffset))
-            if i < numPositions:
-                nextpos = positions[i + 1]
+            if nextpos is not None:
                 end = pytz.utc.localize(nextpos.timestamp).astimezone(self.getTimezone())
                 # end = self.getTimezone().localize(nextpos.timestamp)
             else:
@@ -427,21 +526,72 @@ class AbstractTrack(SearchableModel, UuidModel, HasVehicle, HasFlight):
             out.write("                </coordinates>\n")
             out.write("            </Point>\n")
             out.write("        </Placemark>\n")
+            pos = nextpos
         out.write("        </Folder>\n")
 
-    def writeTrackKml(self, out, positions=None, lineStyle=None, urlFn=None, animated=False):
+    def writeTrackKml(self, out, positions=None, lineStyle=None, urlFn=None, animated=False, tolerance=None):
+        for chunk in self.iterTrackKml(positions, lineStyle, urlFn, animated, tolerance):
+            out.write(chunk)
+
+    def iterTrackKml(self, positions=None, lineStyle=None, urlFn=None, animated=False, tolerance=None,
+                     cacheSimplified=True):
+        """
+        Generate the KML of writeTrackKml in chunks of about
+        KML_CHUNK_BYTES, reading positions with iterator() so they are
+        never all in memory.  Nothing is generated for fewer than two
+        positions.  For a queryset of a position model with the standard
+        writeCoordinatesKml, see iterTrackKmlFromRows.  With a tolerance
+        in meters, a queryset of positions is simplified first, see
+        iterSimplifiedTrackKml.
+        """
         if positions is None:
             positions = self.getPositions()
         if lineStyle is None:
             lineStyle = self.lineStyle
-
-        n = positions.count()
-        if n == 0:
+        if tolerance and isinstance(positions, models.QuerySet):
+            for chunk in self.iterSimplifiedTrackKml(positions, lineStyle, urlFn, animated, tolerance,
+                                                     cacheSimplified):
+                yield chunk
+            return
+        if isinstance(positions, models.QuerySet) and hasPlainCoordinatesKml(positions.model):
+            for chunk in self.iterTrackKmlFromRows(positions, lineStyle, urlFn, animated):
+                yield chunk
             return
 
-        if n < 2:
+        positionIter = iterPositions(positions)
+        first = list(itertools.islice(positionIter, 2))
+        if len(first) < 2:
             # kml LineString requires 2 or more positions
             return
+
+        out = StringIO()
+        self.writeTrackKmlHeader(out, lineStyle, urlFn, animated)
+        yield drainBuffer(out)
+
+        lastPos = None
+        breakDist = settings.GEOCAM_TRACK_START_NEW_LINE_DISTANCE_METERS
+        for pos in itertools.chain(first, positionIter):
+            if lastPos and breakDist is not None:
+                diff = geomath.calculateDiffMeters([lastPos.longitude, lastPos.latitude],
+                                                   [pos.longitude, pos.latitude])
+                dist = geomath.getLength(diff)
+                if dist > breakDist:
+                    # start new line string
+                    out.write(KML_LINE_BREAK)
+            pos.writeCoordinatesKml(out)
+            lastPos = pos
+            if out.tell() >= KML_CHUNK_BYTES:
+                yield drainBuffer(out)
+
+        out.write(KML_LINE_END)
+        yield drainBuffer(out)
+        if animated:
+            self.writeAnimatedPlacemarks(out, iterPositions(positions))
+            yield drainBuffer(out)
+        out.write("</Folder>\n")
+        yield drainBuffer(out)
+
+    def writeTrackKmlHeader(self, out, lineStyle, urlFn, animated):
         out.write("<Folder>\n")
         out.write("""
 <Placemark>
@@ -464,66 +614,235 @@ class AbstractTrack(SearchableModel, UuidModel, HasVehicle, HasFlight):
       <tessellate>1</tessellate>
       <coordinates>
 """)
-        lastPos = None
+
+    def iterTrackKmlFromRows(self, positions, lineStyle, urlFn, animated):
+        """
+        Same output as iterTrackKml, from a read of (timestamp, longitude,
+        latitude) rows instead of model instances.  Rows are read in chunks
+        of KML_ROW_CHUNK_SIZE; in each chunk the line breaks of
+        GEOCAM_TRACK_START_NEW_LINE_DISTANCE_METERS are found with one
+        vectorized distance calculation and the coordinates are formatted
+        with one string operation.  For animated output the rows are read
+        a second time, in chunks as well, for the placemarks, so memory
+        stays bounded by the chunk size however long the track is.
+        """
+        chunks = iterCoordinateChunks(positions, KML_ROW_CHUNK_SIZE)
+        chunk = next(chunks, None)
+        if chunk is None or len(chunk[0]) < 2:
+            # kml LineString requires 2 or more positions
+            return
+
+        out = StringIO()
+        self.writeTrackKmlHeader(out, lineStyle, urlFn, animated)
+        yield drainBuffer(out)
+
         breakDist = settings.GEOCAM_TRACK_START_NEW_LINE_DISTANCE_METERS
-        for pos in positions:
-            if lastPos and breakDist is not None:
-                diff = geomath.calculateDiffMeters([lastPos.longitude, lastPos.latitude],
-                                                   [pos.longitude, pos.latitude])
-                dist = geomath.getLength(diff)
-                if dist > breakDist:
+        lastLonLat = None
+        while chunk is not None:
+            times, lonLat = chunk
+            starts = [0]
+            if breakDist is not None:
+                starts.extend(getLineBreaks(lastLonLat, lonLat, breakDist))
+            starts.append(len(lonLat))
+            for i in xrange(len(starts) - 1):
+                if i > 0:
                     # start new line string
-                    out.write("""
-      </coordinates>
-    </LineString>
-    <LineString>
-      <tessellate>1</tessellate>
-      <coordinates>
-""")
-            pos.writeCoordinatesKml(out)
-            lastPos = pos
+                    out.write(KML_LINE_BREAK)
+                out.write(formatCoordinatesKml(lonLat[starts[i]:starts[i + 1]]))
+            yield drainBuffer(out)
 
-        out.write("""
-      </coordinates>
-    </LineString>
-  </MultiGeometry>
-</Placemark>
-""")
+            lastLonLat = lonLat[-1]
+            chunk = next(chunks, None)
+
+        out.write(KML_LINE_END)
+        yield drainBuffer(out)
         if animated:
-            self.writeAnimatedPlacemarks(out, list(positions))
-        out.write("</Folder>\n")
+            for text in self.iterAnimatedPlacemarksFromRows(iterCoordinateChunks(positions, KML_ROW_CHUNK_SIZE),
+                                                            self.getFirstIconStyle(positions)):
+                yield text
+        yield "</Folder>\n"
 
-    def getInterpolatedPosition(self, utcDt):
-        positions = PAST_POSITION_MODEL.get().objects.filter(track=self)
+    def iterSimplifiedTrackKml(self, positions, lineStyle, urlFn, animated, tolerance, useCache=True):
+        """
+        Like iterTrackKmlFromRows, for the line simplified to within
+        tolerance meters by simplify.getSimplifiedTrack, which caches it.
+        Animated output has placemarks for the kept positions only.
+        """
+        segments = simplify.getSimplifiedTrack(self, tolerance, positions, useCache)
+        if sum(len(times) for times, _rows in segments) < 2:
+            # kml LineString requires 2 or more positions
+            return
+        fields = list(positions.model.coords_array_order())
+        chunks = [(times, simplify.getLonLatArray(rows, fields)) for times, rows in segments]
+
+        out = StringIO()
+        self.writeTrackKmlHeader(out, lineStyle, urlFn, animated)
+        for i, (_times, lonLat) in enumerate(chunks):
+            if i > 0:
+                # start new line string
+                out.write(KML_LINE_BREAK)
+            out.write(formatCoordinatesKml(lonLat))
+        out.write(KML_LINE_END)
+        yield drainBuffer(out)
+        if animated:
+            for text in self.iterAnimatedPlacemarksFromRows(chunks, self.getFirstIconStyle(positions)):
+                yield text
+        yield "</Folder>\n"
 
-        # get closest position after utcDt
-        afterPositions = positions.filter(timestamp__gte=utcDt).order_by('timestamp')
-        if afterPositions.count():
-            afterPos = afterPositions[0]
-        else:
-            return None
-        afterDelta = timeDeltaTotalSeconds(afterPos.timestamp - utcDt)
+    def getFirstIconStyle(self, positions):
+        """ getIconStyle for the first of a queryset of positions, which is only read if the track has no icon style """
+        if self.iconStyle is not None:
+            return self.getIconStyle(None)
+        return self.getIconStyle(positions.first())
+
+    def iterAnimatedPlacemarksFromRows(self, chunks, iconStyle):
+        """ The output of writeAnimatedPlacemarks, from (timestamps, coordinates) chunks """
+        tz = self.getTimezone()
+        rows = ((timestamp, lonLat[0], lonLat[1])
+                for times, coords in chunks
+                for timestamp, lonLat in itertools.izip(times, coords))
+        out = StringIO()
+        out.write("    <Folder>\n")
+        out.write("        <name>Trajectory</name>\n")
+        out.write("        <open>0</open>\n")
+        row = next(rows, None)
+        while row is not None:
+            nextRow = next(rows, None)
+            begin = pytz.utc.localize(row[0]).astimezone(tz)
+            tzoffset = begin.strftime('%z')
+            tzoffset = tzoffset[0:-2] + ":00"
+            if nextRow is not None:
+                end = pytz.utc.localize(nextRow[0]).astimezone(tz)
+            else:
+                end = begin
+            out.write(KML_ANIMATED_PLACEMARK %
+                      (begin.year, begin.month, begin.day, begin.hour, begin.minute, begin.second, tzoffset,
+                       end.year, end.month, end.day, end.hour, end.minute, end.second, tzoffset,
+                       iconStyle.pk, row[1], row[2]))
+            if out.tell() >= KML_CHUNK_BYTES:
+                yield drainBuffer(out)
+            row = nextRow
+        out.write("        </Folder>\n")
+        yield drainBuffer(out)
 
-        # special case -- if we have a position exactly matching utcDt
-        if afterPos.timestamp == utcDt:
-            return POSITION_MODEL.get().getInterpolatedPosition(utcDt, 1, afterPos, 0, afterPos)
+    def getInterpolatedPosition(self, utcDt):
+        return self.getInterpolatedPositions([utcDt])[0]
 
-        # get closest position before utcDt
-        beforePositions = positions.filter(timestamp__lt=utcDt).order_by('-timestamp')
-        if beforePositions.count():
-            beforePos = beforePositions[0]
-        else:
-            return None
-        beforeDelta = timeDeltaTotalSeconds(utcDt - beforePos.timestamp)
-        delta = beforeDelta + afterDelta
+    def getCoarsePosition(self, utcDt):
+        """
+        Rough position at utcDt from the minute rollups, without reading
+        past positions.  See positionRollup.getCoarsePosition.
+        """
+        return positionRollup.getCoarsePosition(self, utcDt)
 
-        if delta > settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS:
+    def getInterpolatedPositions(self, utcDts):
+        """
+        Interpolate the track at each of a list of UTC datetimes, in any
+        order.  Returns a list in the same order, with None where there is
+        no position to interpolate from.  Positions come from the shared
+        position cache if it is enabled.  Otherwise the datetimes are split
+        into runs no more than twice GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS
+        apart, and each run reads the (pk, timestamp, float fields) rows
+        within GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS of it in one query, so
+        the gaps between scattered datetimes are never read.
+        """
+        if not utcDts:
+            return []
+        if positionCache.isEnabled():
+            reader = positionCache.TrackPositionReader(self)
+            return self.interpolateBrackets(utcDts, [reader.getBracketingPositions(utcDt) for utcDt in utcDts])
+
+        model = PAST_POSITION_MODEL.get()
+        fields = positionCache.getCachedFields(model)
+        maxDelta = datetime.timedelta(seconds=settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS)
+        runs = []
+        for i in sorted(xrange(len(utcDts)), key=lambda i: utcDts[i]):
+            if runs and utcDts[i] - utcDts[runs[-1][-1]] <= 2 * maxDelta:
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+
+        brackets = [None] * len(utcDts)
+        for run in runs:
+            rows = list(model.objects
+                        .filter(track_id=self.pk,
+                                timestamp__gte=utcDts[run[0]] - maxDelta,
+                                timestamp__lte=utcDts[run[-1]] + maxDelta)
+                        .order_by('timestamp')
+                        .values_list('pk', 'timestamp', *fields))
+            times = [row[1] for row in rows]
+            positions = {}
+            for i in run:
+                afterIndex = bisect.bisect_left(times, utcDts[i])
+                brackets[i] = (self.getRowPosition(model, fields, rows, afterIndex - 1, positions),
+                               self.getRowPosition(model, fields, rows, afterIndex, positions))
+        return self.interpolateBrackets(utcDts, brackets)
+
+    def getRowPosition(self, model, fields, rows, index, positions):
+        """
+        Unsaved past position of rows[index], a (pk, timestamp, fields...)
+        row, or None if index is out of range.  Positions are built once
+        and kept in the positions dictionary.
+        """
+        if index < 0 or index >= len(rows):
             return None
+        if index not in positions:
+            row = rows[index]
+            position = model(pk=row[0], track_id=self.pk, timestamp=row[1])
+            for name, value in zip(fields, row[2:]):
+                setattr(position, name, value)
+            positions[index] = position
+        return positions[index]
+
+    def findBracket(self, utcDt, positions, times):
+        """
+        Return (the last position before utcDt, the first position at or
+        after it) from a list of positions in timestamp order, where times
+        holds their timestamps.  Either can be None.
+        """
+        afterIndex = bisect.bisect_left(times, utcDt)
+        beforePos = positions[afterIndex - 1] if afterIndex > 0 else None
+        afterPos = positions[afterIndex] if afterIndex < len(positions) else None
+        return beforePos, afterPos
 
-        # interpolate
-        beforeWeight = afterDelta / delta
-        afterWeight = beforeDelta / delta
-        return POSITION_MODEL.get().getInterpolatedPosition(utcDt, beforeWeight, beforePos, afterWeight, afterPos)
+    def interpolateBetween(self, utcDt, positions, times):
+        """
+        Interpolate at utcDt from a list of positions in timestamp order,
+        where times holds their timestamps.
+        """
+        return self.interpolateBrackets([utcDt], [self.findBracket(utcDt, positions, times)])[0]
+
+    def interpolateBrackets(self, utcDts, brackets):
+        """
+        Interpolate at each utcDt between its bracketing positions, as
+        returned by findBracket.  All the interpolation is done with one
+        call to the position model's getInterpolatedPositions.
+        """
+        results = [None] * len(utcDts)
+        indices = []
+        args = ([], [], [], [], [])
+        for i, (utcDt, (beforePos, afterPos)) in enumerate(zip(utcDts, brackets)):
+            if afterPos is None:
+                continue
+            if afterPos.timestamp == utcDt:
+                # special case -- if we have a position exactly matching utcDt
+                weights = (1, afterPos, 0, afterPos)
+            elif beforePos is None:
+                continue
+            else:
+                afterDelta = timeDeltaTotalSeconds(afterPos.timestamp - utcDt)
+                beforeDelta = timeDeltaTotalSeconds(utcDt - beforePos.timestamp)
+                delta = beforeDelta + afterDelta
+                if delta > settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS:
+                    continue
+                weights = (afterDelta / delta, beforePos, beforeDelta / delta, afterPos)
+            indices.append(i)
+            for arg, value in zip(args, (utcDt,) + weights):
+                arg.append(value)
+
+        for i, result in zip(indices, POSITION_MODEL.get().getInterpolatedPositions(*args)):
+            results[i] = result
+        return results
 
     @classmethod
     def cls_type(cls):
@@ -558,13 +877,19 @@ class AbstractTrack(SearchableModel, UuidModel, HasVehicle, HasFlight):
             return self.iconStyle.scale
         return 1
 
-    def buildTimeCoords(self, downsample=False):
+    def buildTimeCoords(self, downsample=False, tolerance=None):
 
         currentPositions = self.getPositions(downsample)
         if currentPositions.count() < 2:
             return
         if self.coordGroups:
             return
+        if tolerance:
+            # simplified to within tolerance meters, see simplify.getSimplifiedTrack
+            for times, rows in simplify.getSimplifiedTrack(self, tolerance, currentPositions):
+                self.timesGroups.append(times)
+                self.coordGroups.append(rows)
+            return
         coords = []
         times = []
 
@@ -602,7 +927,7 @@ class AbstractTrack(SearchableModel, UuidModel, HasVehicle, HasFlight):
             return self.timesGroups
         return None
 
-    def toMapDict(self, downsample=False):
+    def toMapDict(self, downsample=False, tolerance=None):
         result = super(AbstractTrack, self).toMapDict()
         result['coords_array_order'] = PAST_POSITION_MODEL.get().coords_array_order()
         if 'vehicle' in result:
@@ -610,7 +935,7 @@ class AbstractTrack(SearchableModel, UuidModel, HasVehicle, HasFlight):
                 result['vehicle'] = self.vehicle.name
             else:
                 del result['vehicle']
-        self.buildTimeCoords(downsample)
+        self.buildTimeCoords(downsample, tolerance)
         if self.timesGroups:
             result['times'] = self.timesGroups
 
@@ -753,22 +1078,44 @@ class AbstractResourcePosition(SearchableModel, TrackMixin):
         return 'timestamp'
 
     def saveCurrent(self):
-        # if there is an existing entry for this track, overwrite
-        oldCpos = self.__class__.objects.filter(track=self.track)
-
-        if len(oldCpos) > 1:
-            logging.warning('more than one position for track %s',
-                            self.track)
-        new_instance = False
-        if oldCpos:
-            oldCposPk = oldCpos[0].pk
-        else:
-            new_instance = True
-            oldCposPk = None
-        self.pk = oldCposPk
+        """
+        Store this as the current position for its track, replacing the
+        previous one.  The current position model has a unique constraint on
+        track, so replacing is a single UPDATE; we only insert when there was
+        nothing to update.  As before, broadcast() is called when an existing
+        current position is replaced, not when the first one is created.
+        The proximity index of this process is updated either way.
+        """
+        cls = self.__class__
+        values = dict((f.attname, getattr(self, f.attname))
+                      for f in cls._meta.concrete_fields if not f.primary_key)
+        if cls.objects.filter(track=self.track).update(**values):
+            self.broadcastReplaced()
+            proximity.updateCurrentPosition(self)
+            return
 
-        self.save()
-        if not new_instance:
+        try:
+            with transaction.atomic():
+                self.pk = None
+                self.save(force_insert=True)
+        except IntegrityError:
+            # another process created the current position for this track first
+            cls.objects.filter(track=self.track).update(**values)
+            self.broadcastReplaced()
+        proximity.updateCurrentPosition(self)
+
+    def shouldBroadcast(self):
+        """ True if broadcast() publishes anything, which it only does through redis """
+        return settings.XGDS_CORE_REDIS
+
+    def broadcastReplaced(self):
+        """
+        Broadcast a current position that saveCurrent stored with an
+        UPDATE.  The UPDATE does not return the primary key, which the
+        broadcast carries, so it is read back only when broadcasting.
+        """
+        if self.shouldBroadcast():
+            self.pk = getCurrentPositionPk(self.__class__, self.track_id)
             self.broadcast()
 
     def getHeading(self):
@@ -789,15 +1136,59 @@ class AbstractResourcePosition(SearchableModel, TrackMixin):
 
     @classmethod
     def getInterpolatedPosition(cls, utcDt, beforeWeight, beforePos, afterWeight, afterPos):
-        if afterPos.getDistance(beforePos) > settings.GEOCAM_TRACK_INTERPOLATE_MAX_METERS:
-            return None
+        return cls.getInterpolatedPositions([utcDt], [beforeWeight], [beforePos], [afterWeight], [afterPos])[0]
 
-        result = cls()
-        result.track = beforePos.track
-        result.timestamp = utcDt
-        result.latitude = cls.interp(beforeWeight, beforePos.latitude, afterWeight, afterPos.latitude)
-        result.longitude = cls.interp(beforeWeight, beforePos.longitude, afterWeight, afterPos.longitude)
-        return result
+    @classmethod
+    def getInterpolatedFields(cls):
+        """
+        Names of the fields interpolated between positions besides latitude
+        and longitude: all the float fields.  Angles are interpolated along
+        the shorter arc, see geocamTrack.orientation.
+        """
+        return [f.attname for f in cls._meta.concrete_fields
+                if isinstance(f, models.FloatField) and f.attname not in ('latitude', 'longitude')]
+
+    @classmethod
+    def interpolateArrays(cls, afterWeights, before, after):
+        """
+        Vectorized interpolation of field values.  before and after map
+        field names to float arrays, with NaN for missing values, and
+        afterWeights is the array of weights of the after values.
+        Override to change how a model interpolates.
+        """
+        return orientation.interpolateFields(afterWeights, before, after)
+
+    @classmethod
+    def getInterpolatedPositions(cls, utcDts, beforeWeights, beforePositions, afterWeights, afterPositions):
+        """
+        Batch version of getInterpolatedPosition: one unsaved position per
+        utcDt, or None where the bracketing positions are more than
+        GEOCAM_TRACK_INTERPOLATE_MAX_METERS apart.
+        """
+        if not utcDts:
+            return []
+        fields = ['latitude', 'longitude'] + cls.getInterpolatedFields()
+        before = dict((name, toFloatArray([getattr(pos, name, None) for pos in beforePositions]))
+                      for name in fields)
+        after = dict((name, toFloatArray([getattr(pos, name, None) for pos in afterPositions]))
+                     for name in fields)
+        close = (distanceMeters(before['longitude'], before['latitude'], after['longitude'], after['latitude']) <=
+                 settings.GEOCAM_TRACK_INTERPOLATE_MAX_METERS)
+        values = cls.interpolateArrays(np.asarray(afterWeights, dtype=float), before, after)
+
+        results = []
+        for i, utcDt in enumerate(utcDts):
+            if not close[i]:
+                results.append(None)
+                continue
+            result = cls()
+            result.track_id = beforePositions[i].track_id
+            result.timestamp = utcDt
+            for name in fields:
+                value = values[name][i]
+                setattr(result, name, None if np.isnan(value) else float(value))
+            results.append(result)
+        return results
 
     def writeCoordinatesKml(self, out):
         out.write('%.6f,%.6f,0\n' % (self.longitude, self.latitude))
@@ -936,31 +1327,27 @@ class HeadingMixin(models.Model):
 
     @classmethod
     def interpHeading(cls, beforeWeight, beforeHeading, afterWeight, afterHeading):
-        h1 = cls.interp(beforeWeight, beforeHeading, afterWeight, afterHeading)
-        if h1 is None:
+        """ Interpolate heading along the shorter arc, in GEOCAM_TRACK_HEADING_UNITS """
+        if beforeHeading is None or afterHeading is None:
             return None
+        return float(orientation.interpolateAngles(afterWeight / (beforeWeight + afterWeight),
+                                                   beforeHeading, afterHeading))
 
-        # there are two intervals between beforeHeading and
-        # afterHeading on the orientation circle.  their midpoints
-        # are h1 and h2.  we want the midpoint of the shorter interval.
-        if (min(abs(h1 - beforeHeading),
-                abs(h1 - afterHeading)) < 90):
-            return h1
-        else:
-            h2 = h1 + 180
-            if h2 > 360:
-                h2 -= 360
-            return h2
+    class Meta:
+        abstract = True
 
-    @classmethod
-    def getInterpolatedPosition(cls, utcDt, beforeWeight, beforePos, afterWeight, afterPos):
-        result = (super(HeadingMixin, cls)
-                  .getInterpolatedPosition(utcDt,
-                                           beforeWeight, beforePos,
-                                           afterWeight, afterPos))
-        if result is not None:
-            result.heading = cls.interpHeading(beforeWeight, beforePos.heading, afterWeight, afterPos.heading)
-        return result
+
+class CellMixin(models.Model):
+    """
+    Adds the spatial grid cell of the position, for bounding box searches.
+    See geocamTrack.spatialIndex.  Bulk inserts through
+    positionIngest.storePastPositions fill it in too.
+    """
+    cell = models.BigIntegerField(null=True, blank=True)
+
+    def save(self, *args, **kwargs):
+        self.cell = spatialIndex.getCell(self.latitude, self.longitude)
+        super(CellMixin, self).save(*args, **kwargs)
 
     class Meta:
         abstract = True
@@ -1029,6 +1416,10 @@ class DepthMixin(models.Model):
 
 class ResourcePosition(AltitudeResourcePosition, TrackMixin, BroadcastMixin):
 
+    class Meta(AltitudeResourcePosition.Meta):
+        # one current position per track, see saveCurrent
+        unique_together = (('track',),)
+
     @classmethod
     def coords_array_order(cls):
         """
@@ -1055,7 +1446,13 @@ class ResourcePosition(AltitudeResourcePosition, TrackMixin, BroadcastMixin):
         return ['lat', 'lon', 'alt', 'head']
 
 
-class PastResourcePosition(AltitudeResourcePosition, TrackMixin):
+class PastResourcePosition(AltitudeResourcePosition, TrackMixin, CellMixin):
+
+    class Meta(AltitudeResourcePosition.Meta):
+        # a fix is stored once, see positionIngest.storePastPositions
+        unique_together = (('track', 'timestamp'),)
+        # bounding box and time searches, see spatialIndex
+        index_together = (('cell', 'timestamp'),)
 
     @classmethod
     def getSearchFormFields(cls):
@@ -1092,6 +1489,10 @@ class PastResourcePosition(AltitudeResourcePosition, TrackMixin):
 
 class ResourcePose(AbstractResourcePosition, AltitudeMixin, YPRMixin, TrackMixin, BroadcastMixin):
 
+    class Meta(AbstractResourcePosition.Meta):
+        # one current position per track, see saveCurrent
+        unique_together = (('track',),)
+
     @classmethod
     def coords_array_order(cls):
         """
@@ -1117,7 +1518,13 @@ class ResourcePose(AbstractResourcePosition, AltitudeMixin, YPRMixin, TrackMixin
         return ['lat', 'lon', 'alt', 'yaw', 'pitch', 'roll']
 
 
-class PastResourcePose(AbstractResourcePosition, AltitudeMixin, YPRMixin, TrackMixin):
+class PastResourcePose(AbstractResourcePosition, AltitudeMixin, YPRMixin, TrackMixin, CellMixin):
+
+    class Meta(AbstractResourcePosition.Meta):
+        # a fix is stored once, see positionIngest.storePastPositions
+        unique_together = (('track', 'timestamp'),)
+        # bounding box and time searches, see spatialIndex
+        index_together = (('cell', 'timestamp'),)
 
     @classmethod
     def getSearchFormFields(cls):
@@ -1154,6 +1561,10 @@ class PastResourcePose(AbstractResourcePosition, AltitudeMixin, YPRMixin, TrackM
 
 class ResourcePoseDepth(AbstractResourcePosition, AltitudeMixin, YPRMixin, TrackMixin, DepthMixin, BroadcastMixin):
 
+    class Meta(AbstractResourcePosition.Meta):
+        # one current position per track, see saveCurrent
+        unique_together = (('track',),)
+
     @classmethod
     def coords_array_order(cls):
         """
@@ -1183,7 +1594,13 @@ class ResourcePoseDepth(AbstractResourcePosition, AltitudeMixin, YPRMixin, Track
         return settings.GEOCAM_TRACK_CURRENT_POSITION_SSE_TYPE.lower()
 
 
-class PastResourcePoseDepth(AbstractResourcePosition, AltitudeMixin, YPRMixin, TrackMixin, DepthMixin):
+class PastResourcePoseDepth(AbstractResourcePosition, AltitudeMixin, YPRMixin, TrackMixin, DepthMixin, CellMixin):
+
+    class Meta(AbstractResourcePosition.Meta):
+        # a fix is stored once, see positionIngest.storePastPositions
+        unique_together = (('track', 'timestamp'),)
+        # bounding box and time searches, see spatialIndex
+        index_together = (('cell', 'timestamp'),)
 
     @classmethod
     def getSearchFormFields(cls):
@@ -1218,6 +1635,33 @@ class PastResourcePoseDepth(AbstractResourcePosition, AltitudeMixin, YPRMixin, T
         return settings.GEOCAM_TRACK_PAST_POSITION_SSE_TYPE.lower()
 
 
+class TrackMinuteRollup(models.Model):
+    """
+    Summary of the past positions of a track in one minute (UTC), kept
+    up to date by geocamTrack.positionRollup when GEOCAM_TRACK_POSITION_ROLLUP is set.
+    """
+    track = models.ForeignKey(settings.GEOCAM_TRACK_TRACK_MODEL, related_name='minuteRollups')
+    minute = models.DateTimeField(db_index=True)
+    firstTimestamp = models.DateTimeField()
+    lastTimestamp = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    minLatitude = models.FloatField()
+    maxLatitude = models.FloatField()
+    minLongitude = models.FloatField()
+    maxLongitude = models.FloatField()
+    firstLatitude = models.FloatField()
+    firstLongitude = models.FloatField()
+    lastLatitude = models.FloatField()
+    lastLongitude = models.FloatField()
+
+    class Meta:
+        unique_together = (('track', 'minute'),)
+        ordering = ['track', 'minute']
+
+    def __unicode__(self):
+        return '%s %s %d positions' % (self.track_id, self.minute, self.count)
+
+
 PAST_POSITION_FIELD = lambda: models.ForeignKey(PastResourcePosition,
                                                 related_name='%(app_label)s_%(class)s_related',
                                                 blank=True, null=True)
@@ -1328,3 +1772,14 @@ class Centroid():
     </Polygon>
 </Placemark>
 """)
+
+
+@receiver([post_save, post_delete])
+def invalidateCachedPositions(sender, instance, **kwargs):
+    """
+    Keep the shared position cache and the minute rollups current when
+    past positions are saved or deleted one at a time
+    """
+    if sender is PAST_POSITION_MODEL.get():
+        invalidateTimes([(instance.track_id, instance.timestamp)])
+        positionRollup.updateRollups([(instance.track_id, instance.timestamp)])
@@ -0,0 +1,137 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Vectorized interpolation of position fields, including orientation.
+
+Angles are in GEOCAM_TRACK_HEADING_UNITS.  A heading on its own is
+interpolated along the shorter arc of the circle; heading and yaw come
+out in [0, full circle), pitch and roll stay signed, in (-half, half].  When yaw, pitch and
+roll are all known, the orientation is interpolated as a rotation:
+converted to quaternions (yaw about z, then pitch about y, then roll
+about x), interpolated with slerp, and converted back, so a pose turning
+through the vertical does not spin around the long way.
+
+Everything works on arrays, so interpolating thousands of poses is one
+call to interpolateFields().
+"""
+
+import numpy as np
+
+from geocamTrack.arrayMath import getFullCircle
+
+# fields that hold angles
+ANGLE_FIELDS = ('heading', 'yaw', 'pitch', 'roll')
+# angles that are signed rather than in [0, full circle)
+SIGNED_ANGLE_FIELDS = ('pitch', 'roll')
+YPR_FIELDS = ('yaw', 'pitch', 'roll')
+
+# below this angle between two rotations, slerp falls back to linear interpolation
+SLERP_EPSILON = 1e-6
+
+
+def interpolateLinear(w, v0, v1):
+    return v0 + w * (v1 - v0)
+
+
+def interpolateAngles(w, a0, a1, units=None, signed=False):
+    """
+    Interpolate angles a0 to a1 by weight w (0 gives a0, 1 gives a1)
+    along the shorter arc.  Results are in [0, full circle), or in
+    (-half circle, half circle] if signed.
+    """
+    fullCircle = getFullCircle(units)
+    a0 = np.asarray(a0, dtype=float)
+    diff = np.mod(np.asarray(a1, dtype=float) - a0 + fullCircle / 2, fullCircle) - fullCircle / 2
+    if signed:
+        return fullCircle / 2 - np.mod(fullCircle / 2 - (a0 + w * diff), fullCircle)
+    return np.mod(a0 + w * diff, fullCircle)
+
+
+def yprToQuaternions(yaw, pitch, roll):
+    """ Quaternions (w, x, y, z), as an N x 4 array, for yaw, pitch and roll in radians """
+    cy, sy = np.cos(yaw / 2), np.sin(yaw / 2)
+    cp, sp = np.cos(pitch / 2), np.sin(pitch / 2)
+    cr, sr = np.cos(roll / 2), np.sin(roll / 2)
+    return np.column_stack((cr * cp * cy + sr * sp * sy,
+                            sr * cp * cy - cr * sp * sy,
+                            cr * sp * cy + sr * cp * sy,
+                            cr * cp * sy - sr * sp * cy))
+
+
+def quaternionsToYpr(q):
+    """ (yaw, pitch, roll) arrays in radians for an N x 4 array of quaternions """
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x), -1, 1))
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    return yaw, pitch, roll
+
+
+def slerp(w, q0, q1):
+    """ Spherical linear interpolation between rows of two N x 4 quaternion arrays """
+    dot = np.sum(q0 * q1, axis=1)
+    # q and -q are the same rotation; take the shorter way around
+    q1 = np.where((dot < 0)[:, None], -q1, q1)
+    dot = np.clip(np.abs(dot), 0, 1)
+    theta = np.arccos(dot)
+    sinTheta = np.sin(theta)
+    near = sinTheta < SLERP_EPSILON
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s0 = np.where(near, 1 - w, np.sin((1 - w) * theta) / sinTheta)
+        s1 = np.where(near, w, np.sin(w * theta) / sinTheta)
+    q = s0[:, None] * q0 + s1[:, None] * q1
+    return q / np.linalg.norm(q, axis=1)[:, None]
+
+
+def interpolateYpr(w, before, after, units=None):
+    """
+    Interpolate yaw, pitch and roll as rotations.  before and after are
+    dictionaries of arrays with 'yaw', 'pitch' and 'roll'.  Returns
+    (yaw, pitch, roll) arrays, NaN wherever one of the six inputs is NaN.
+    """
+    toRadians = 2 * np.pi / getFullCircle(units)
+    q0 = yprToQuaternions(*[before[name] * toRadians for name in YPR_FIELDS])
+    q1 = yprToQuaternions(*[after[name] * toRadians for name in YPR_FIELDS])
+    yaw, pitch, roll = quaternionsToYpr(slerp(w, q0, q1))
+    fullCircle = getFullCircle(units)
+    return np.mod(yaw / toRadians, fullCircle), pitch / toRadians, roll / toRadians
+
+
+def interpolateFields(w, before, after, units=None):
+    """
+    Interpolate position fields.
+    :param w: array of weights of the after values, 0 gives before and 1 gives after
+    :param before: dictionary of field name to float array, NaN where a value is missing
+    :param after: dictionary with the same field names
+    :param units: angle units, defaults to GEOCAM_TRACK_HEADING_UNITS
+    :return: dictionary of field name to interpolated array; NaN where either input is missing
+    """
+    w = np.asarray(w, dtype=float)
+    result = {}
+    for name in before:
+        if name in ANGLE_FIELDS:
+            result[name] = interpolateAngles(w, before[name], after[name], units,
+                                             signed=name in SIGNED_ANGLE_FIELDS)
+        else:
+            result[name] = interpolateLinear(w, before[name], after[name])
+
+    if all(name in before for name in YPR_FIELDS) and len(w):
+        known = np.ones(len(w), dtype=bool)
+        for name in YPR_FIELDS:
+            known &= ~np.isnan(before[name]) & ~np.isnan(after[name])
+        if known.any():
+            ypr = interpolateYpr(w[known],
+                                 dict((name, before[name][known]) for name in YPR_FIELDS),
+                                 dict((name, after[name][known]) for name in YPR_FIELDS),
+                                 units)
+            for name, values in zip(YPR_FIELDS, ypr):
+                result[name][known] = values
+
+    # keep end values exactly as stored
+    for name in result:
+        result[name] = np.where(w == 0, before[name], np.where(w == 1, after[name], result[name]))
+    return result
@@ -0,0 +1,335 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Process-wide cache of past positions, shared across requests.
+
+Positions are cached per track in time buckets of
+GEOCAM_TRACK_POSITION_CACHE_BUCKET_SECONDS.  A bucket is stored as NumPy
+arrays (primary key, timestamp in microseconds, and every float field of
+the past position model) rather than model instances, and buckets are
+evicted least recently used first once they take more than
+GEOCAM_TRACK_POSITION_CACHE_BYTES.  Setting that to 0, the default,
+disables the cache.
+
+Every bucket, and the time bounds of every track, has a version number
+kept in the Django cache.  Storing, changing or deleting past positions
+bumps the versions they touch (see invalidateTimes), and a cached bucket
+is only used while its version is current.  That only works if every
+process that stores positions sees the same versions, so the cache stays
+disabled unless the default Django cache backend is shared between
+processes, such as memcached; see hasSharedCache.
+
+Lookups go through a TrackPositionReader, which checks each version
+once, so it should live for one request or one batch of lookups.
+"""
+
+import datetime
+import random
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pytz
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import FloatField, Min, Max
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.arrayMath import toFloatArray
+
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROS = 1000000
+VERSION_KEY_PREFIX = 'geocamTrack.positionCache'
+
+# rough fixed cost of a cache entry beyond its arrays
+ENTRY_OVERHEAD_BYTES = 512
+
+# cache backends that keep their versions per process, or not at all
+UNSHARED_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',
+                           'django.core.cache.backends.dummy.DummyCache')
+
+cacheG = None
+cacheLockG = threading.Lock()
+
+
+def hasSharedCache():
+    """ True if the default Django cache is shared between processes, so version numbers can be trusted """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    return backend is not None and backend not in UNSHARED_CACHE_BACKENDS
+
+
+def isEnabled():
+    return settings.GEOCAM_TRACK_POSITION_CACHE_BYTES > 0 and hasSharedCache()
+
+
+def toMicros(dt):
+    """ Microseconds since the epoch for a naive UTC or aware datetime """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * MICROS + delta.microseconds
+
+
+def fromMicros(micros, aware=False):
+    dt = EPOCH + datetime.timedelta(microseconds=int(micros))
+    if aware:
+        dt = pytz.utc.localize(dt)
+    return dt
+
+
+def getBucketMicros():
+    return int(settings.GEOCAM_TRACK_POSITION_CACHE_BUCKET_SECONDS * MICROS)
+
+
+def getBucket(micros):
+    return micros // getBucketMicros()
+
+
+def getVersionKey(trackId, bucket=None):
+    """ Version key for a bucket of a track, or for its time bounds if bucket is None """
+    if bucket is None:
+        return '%s.%s.bounds' % (VERSION_KEY_PREFIX, trackId)
+    return '%s.%s.%s' % (VERSION_KEY_PREFIX, trackId, bucket)
+
+
+def newVersion():
+    # start from a random number, so a version key that was evicted from
+    # the Django cache does not come back with a version still cached here
+    return random.randint(1, 2 ** 30)
+
+
+def getVersion(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, newVersion(), None)
+        version = cache.get(key)
+    return version
+
+
+def getVersions(keys):
+    """ getVersion of many keys, with one round trip to the cache once they all exist """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if versions.get(key) is None:
+            versions[key] = getVersion(key)
+    return versions
+
+
+def bumpVersions(keys):
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, newVersion(), None)
+
+
+def invalidateTimes(trackTimes):
+    """
+    Mark cached positions stale after past positions are stored, changed
+    or deleted.  Versions are bumped even when the position cache is
+    disabled, since other data derived from past positions, such as
+    simplified lines and KML fragments, is cached under them.
+    :param trackTimes: iterable of (track id, timestamp) of the affected positions
+    """
+    keys = set()
+    for trackId, timestamp in trackTimes:
+        if trackId is None or timestamp is None:
+            continue
+        keys.add(getVersionKey(trackId))
+        keys.add(getVersionKey(trackId, getBucket(toMicros(timestamp))))
+    bumpVersions(keys)
+
+
+def getCachedFields(model):
+    """ The fields cached for each position: all float fields """
+    return [f.attname for f in model._meta.concrete_fields if isinstance(f, FloatField)]
+
+
+class PositionWindow(object):
+    """
+    The positions of one track in one time bucket, as arrays in timestamp order.
+    """
+    def __init__(self, rows, fields):
+        rows = list(rows)
+        self.pk = np.array([row[0] for row in rows], dtype=np.int64)
+        self.micros = np.array([toMicros(row[1]) for row in rows], dtype=np.int64)
+        self.arrays = dict((name, toFloatArray([row[i + 2] for row in rows]))
+                           for i, name in enumerate(fields))
+        self.nbytes = (ENTRY_OVERHEAD_BYTES + self.pk.nbytes + self.micros.nbytes +
+                       sum(a.nbytes for a in self.arrays.itervalues()))
+
+    def __len__(self):
+        return len(self.micros)
+
+
+class PositionCache(object):
+    """
+    Least recently used cache of versioned entries, bounded by bytes.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self.nbytes -= entry[2]
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, value, nbytes):
+        if nbytes > self.maxBytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self.entries[key] = (version, value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxBytes:
+                _key, (_version, _value, evictedBytes) = self.entries.popitem(last=False)
+                self.nbytes -= evictedBytes
+
+    def getStats(self):
+        with self.lock:
+            return dict(entries=len(self.entries),
+                        bytes=self.nbytes,
+                        maxBytes=self.maxBytes,
+                        hits=self.hits,
+                        misses=self.misses)
+
+
+def getPositionCache():
+    global cacheG
+    with cacheLockG:
+        if cacheG is None:
+            cacheG = PositionCache(settings.GEOCAM_TRACK_POSITION_CACHE_BYTES)
+        return cacheG
+
+
+class TrackPositionReader(object):
+    """
+    Read the past positions of a track through the shared cache.
+    Positions it returns are unsaved model instances with the primary
+    key, track, timestamp and float fields filled in.
+    """
+    def __init__(self, track):
+        self.track = track
+        self.model = PAST_POSITION_MODEL.get()
+        self.fields = getCachedFields(self.model)
+        self.cache = getPositionCache()
+        self.aware = settings.USE_TZ
+        self.windows = {}
+        self.bounds = None
+        self.boundsLoaded = False
+
+    def getBounds(self):
+        """ (first, last) timestamp of the track in microseconds, or None if it has no positions """
+        if not self.boundsLoaded:
+            key = getVersionKey(self.track.pk)
+            version = getVersion(key)
+            bounds = self.cache.get(key, version)
+            if bounds is None:
+                result = (self.model.objects
+                          .filter(track_id=self.track.pk)
+                          .aggregate(first=Min('timestamp'), last=Max('timestamp')))
+                if result['first'] is None:
+                    bounds = ()
+                else:
+                    bounds = (toMicros(result['first']), toMicros(result['last']))
+                self.cache.put(key, version, bounds, ENTRY_OVERHEAD_BYTES)
+            self.bounds = bounds or None
+            self.boundsLoaded = True
+        return self.bounds
+
+    def getWindow(self, bucket):
+        if bucket not in self.windows:
+            key = getVersionKey(self.track.pk, bucket)
+            version = getVersion(key)
+            window = self.cache.get(key, version)
+            if window is None:
+                bucketMicros = getBucketMicros()
+                rows = (self.model.objects
+                        .filter(track_id=self.track.pk,
+                                timestamp__gte=fromMicros(bucket * bucketMicros, self.aware),
+                                timestamp__lt=fromMicros((bucket + 1) * bucketMicros, self.aware))
+                        .order_by('timestamp')
+                        .values_list('pk', 'timestamp', *self.fields))
+                window = PositionWindow(rows, self.fields)
+                self.cache.put(key, version, window, window.nbytes)
+            self.windows[bucket] = window
+        return self.windows[bucket]
+
+    def getPosition(self, window, i):
+        position = self.model(pk=int(window.pk[i]),
+                              timestamp=fromMicros(window.micros[i], self.aware))
+        position.track = self.track
+        for name in self.fields:
+            value = window.arrays[name][i]
+            setattr(position, name, None if np.isnan(value) else float(value))
+        return position
+
+    def getBracketingPositions(self, utcDt, maxSeconds=None):
+        """
+        Return (the last position before utcDt, the first position at or
+        after it).  Either is None if there is no such position within
+        maxSeconds, which defaults to GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS.
+        """
+        bounds = self.getBounds()
+        if bounds is None:
+            return None, None
+        if maxSeconds is None:
+            maxSeconds = settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS
+        t = toMicros(utcDt)
+        limit = int(maxSeconds * MICROS)
+        bucketMicros = getBucketMicros()
+        first = getBucket(t)
+
+        before = None
+        lower = max(t - limit, bounds[0])
+        bucket = first
+        while before is None and (bucket + 1) * bucketMicros > lower:
+            window = self.getWindow(bucket)
+            if bucket == first:
+                i = np.searchsorted(window.micros, t, side='left') - 1
+            else:
+                i = len(window) - 1
+            if i >= 0 and window.micros[i] >= lower:
+                before = self.getPosition(window, i)
+            elif i >= 0:
+                break
+            bucket -= 1
+
+        after = None
+        upper = min(t + limit, bounds[1])
+        bucket = first
+        while after is None and bucket * bucketMicros <= upper:
+            window = self.getWindow(bucket)
+            if bucket == first:
+                i = np.searchsorted(window.micros, t, side='left')
+            else:
+                i = 0
+            if i < len(window) and window.micros[i] <= upper:
+                after = self.getPosition(window, i)
+            elif i < len(window):
+                break
+            bucket += 1
+
+        return before, after
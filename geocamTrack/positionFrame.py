@@ -0,0 +1,95 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Compact binary position frames, for vehicles that send high-rate
+telemetry straight to the trackListener management command instead of
+posting JSON to the web server.
+
+A frame is FRAME_SIZE bytes, all fields in network (big-endian) order:
+
+  vehicle id        uint32
+  timestamp         int64, milliseconds since the epoch (UTC)
+  latitude          float64, degrees
+  longitude         float64, degrees
+  altitude          float32, meters, NaN if unknown
+  heading           float32, GEOCAM_TRACK_HEADING_UNITS, NaN if unknown
+
+A UDP datagram holds one or more whole frames.  A TCP stream is just
+frames back to back.
+"""
+
+import datetime
+import struct
+
+import numpy as np
+
+FRAME_FORMAT = '!Iqddff'
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+
+FRAME_DTYPE = np.dtype([('vehicle', '>u4'),
+                        ('timestamp', '>i8'),
+                        ('latitude', '>f8'),
+                        ('longitude', '>f8'),
+                        ('altitude', '>f4'),
+                        ('heading', '>f4')])
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def packFrame(vehicleId, timestamp, latitude, longitude, altitude=None, heading=None):
+    """
+    Encode one position.  timestamp is a naive UTC datetime.
+    """
+    delta = timestamp - EPOCH
+    millis = (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+    return struct.pack(FRAME_FORMAT,
+                       vehicleId,
+                       millis,
+                       latitude,
+                       longitude,
+                       float('nan') if altitude is None else altitude,
+                       float('nan') if heading is None else heading)
+
+
+def splitFrames(data):
+    """
+    Split a buffer into the whole frames it holds and the leftover bytes.
+    """
+    end = len(data) - len(data) % FRAME_SIZE
+    return data[:end], data[end:]
+
+
+def decodeFrames(data):
+    """
+    Decode a buffer of whole frames in one pass.  Returns a list of
+    (vehicle id, position field values) pairs, in frame order.  Field
+    values are the ones positionIngest.ingestPositions() expects.
+    """
+    frames = np.frombuffer(data, dtype=FRAME_DTYPE)
+    if len(frames) == 0:
+        return []
+
+    vehicles = frames['vehicle'].tolist()
+    millis = frames['timestamp'].tolist()
+    latitudes = frames['latitude'].tolist()
+    longitudes = frames['longitude'].tolist()
+    altitudes = frames['altitude'].astype(float)
+    headings = frames['heading'].astype(float)
+    altitudes = np.where(np.isnan(altitudes), None, altitudes).tolist()
+    headings = np.where(np.isnan(headings), None, headings).tolist()
+
+    result = []
+    for i in xrange(len(frames)):
+        attrs = dict(timestamp=EPOCH + datetime.timedelta(milliseconds=millis[i]),
+                     latitude=latitudes[i],
+                     longitude=longitudes[i])
+        if altitudes[i] is not None:
+            attrs['altitude'] = altitudes[i]
+        if headings[i] is not None:
+            attrs['heading'] = headings[i]
+        result.append((vehicles[i], attrs))
+    return result
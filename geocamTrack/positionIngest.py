@@ -0,0 +1,302 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Storage path for incoming positions.
+
+Positions arrive as GeoJSON Features whose id is the vehicle id.  They
+are grouped by track so that each track gets one bulk insert of its
+historical positions and one update of its current position, no matter
+how many positions were in the batch.
+"""
+
+import json
+from collections import OrderedDict
+
+import iso8601
+import pytz
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction, DatabaseError, IntegrityError
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.trackUtil import bulk_update_rows
+from geocamTrack.positionCache import invalidateTimes
+from geocamTrack.positionRollup import updateRollups
+from geocamTrack.spatialIndex import setCells
+from geocamTrack.positionQueue import getPositionQueue, QueueFullError
+from geocamTrack.compression import compressPositions
+
+TRACK_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_TRACK_MODEL)
+POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_POSITION_MODEL)
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+VEHICLE_MODEL = LazyGetModelByName(settings.XGDS_CORE_VEHICLE_MODEL)
+ACTIVE_FLIGHT_MODEL = LazyGetModelByName(settings.XGDS_CORE_ACTIVE_FLIGHT_MODEL)
+
+
+class IngestError(Exception):
+    pass
+
+
+def parseFeatures(body):
+    """
+    Parse a request body holding a GeoJSON FeatureCollection, a single
+    Feature, a list of Features, or newline-delimited Features.
+    Raises ValueError if the body is malformed.
+    """
+    try:
+        parsed = json.loads(body)
+    except ValueError:
+        # newline-delimited features
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+    if isinstance(parsed, list):
+        return parsed
+    if isinstance(parsed, dict):
+        if parsed.get('type') == 'FeatureCollection':
+            return parsed.get('features', [])
+        return [parsed]
+    raise ValueError('expected a GeoJSON Feature or FeatureCollection')
+
+
+def getFeatureProperties(featureDict):
+    """
+    The properties of a GeoJSON Feature.  Raises ValueError if the
+    feature or its properties are not JSON objects.
+    """
+    if not isinstance(featureDict, dict):
+        raise ValueError('expected a GeoJSON Feature object')
+    properties = featureDict.get('properties') or {}
+    if not isinstance(properties, dict):
+        raise ValueError('expected an object for the properties of a Feature')
+    return properties
+
+
+def getFeatureAttrs(featureDict):
+    """
+    Convert a GeoJSON Feature into a dictionary of position field values.
+    Timestamps are stored as naive UTC.
+    """
+    properties = getFeatureProperties(featureDict)
+    coordinates = featureDict['geometry']['coordinates']
+    timestamp = iso8601.parse_date(properties['timestamp'])
+    attrs = dict(timestamp=timestamp.astimezone(pytz.utc).replace(tzinfo=None),
+                 longitude=float(coordinates[0]),
+                 latitude=float(coordinates[1]))
+    if len(coordinates) >= 3 and coordinates[2] is not None:
+        attrs['altitude'] = float(coordinates[2])
+    if properties.get('heading') is not None:
+        attrs['heading'] = float(properties['heading'])
+    return attrs
+
+
+def buildPosition(model, track, attrs):
+    """
+    Construct an unsaved position of the given model, ignoring values
+    the model has no field for.  Heading goes through setHeading so pose
+    models store it as yaw.
+    """
+    fieldNames = set(f.attname for f in model._meta.concrete_fields)
+    position = model(track=track)
+    for key, value in attrs.iteritems():
+        if key == 'heading' and hasattr(position, 'setHeading'):
+            position.setHeading(value)
+        elif key in fieldNames:
+            setattr(position, key, value)
+    return position
+
+
+def getTrackForVehicle(vehicle, trackName=None):
+    """
+    Find the track positions for this vehicle should be stored in.  An
+    explicit track name wins, otherwise use the track of the vehicle's
+    active flight.
+    """
+    if trackName:
+        from geocamTrack.trackUtil import get_or_create_track
+        return get_or_create_track(trackName, vehicle)
+
+    for activeFlight in ACTIVE_FLIGHT_MODEL.get().objects.filter(flight__vehicle=vehicle):
+        try:
+            track = activeFlight.flight.track
+        except ObjectDoesNotExist:
+            track = None
+        if track:
+            return track
+    raise IngestError('no active track for vehicle %s' % vehicle.name)
+
+
+def getTimestampKey(timestamp):
+    """ Naive UTC version of a timestamp, so stored and incoming timestamps compare equal """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def getStoredKeys(model, positions):
+    """
+    Find the stored rows that have the same (track, timestamp) as any of
+    the positions, with one query.  Returns a dictionary of
+    (track id, timestamp) to primary key.
+    """
+    rows = (model.objects
+            .filter(track_id__in=set(pos.track_id for pos in positions),
+                    timestamp__in=set(pos.timestamp for pos in positions))
+            .values_list('pk', 'track_id', 'timestamp'))
+    return dict(((trackId, getTimestampKey(timestamp)), pk) for pk, trackId, timestamp in rows)
+
+
+def storePastPositionBatch(model, positions, update=False):
+    """
+    Store one batch of past positions with unique (track, timestamp).
+    Returns the positions that were inserted.
+    """
+    fieldNames = [f.attname for f in model._meta.concrete_fields if not f.primary_key]
+    for attempt in (0, 1):
+        try:
+            with transaction.atomic():
+                stored = getStoredKeys(model, positions)
+                newPositions = []
+                valuesByPk = {}
+                for pos in positions:
+                    pk = stored.get((pos.track_id, getTimestampKey(pos.timestamp)))
+                    if pk is None:
+                        newPositions.append(pos)
+                    elif update:
+                        valuesByPk[pk] = dict((name, getattr(pos, name)) for name in fieldNames)
+                model.objects.bulk_create(newPositions)
+                bulk_update_rows(model, valuesByPk)
+            return newPositions
+        except IntegrityError:
+            # another writer stored some of the same fixes since we looked
+            if attempt:
+                raise
+
+
+def storePastPositions(positions, update=False):
+    """
+    Bulk insert unsaved past positions.  All positions are written in one
+    transaction, in chunks of GEOCAM_TRACK_INGEST_BATCH_SIZE.
+
+    Past positions are unique on (track, timestamp), so positions that are
+    already stored are skipped and replaying a batch is harmless.  If
+    update is True, the stored rows are overwritten with the new values
+    instead.  Each chunk costs one query for the stored keys, one insert
+    and, when updating, one update.  Returns the inserted positions.
+    """
+    if not positions:
+        return []
+    model = positions[0].__class__
+
+    # if a batch repeats a fix, the last one wins
+    unique = OrderedDict()
+    for pos in positions:
+        unique[(pos.track_id, getTimestampKey(pos.timestamp))] = pos
+    positions = unique.values()
+    setCells(positions)
+
+    batchSize = settings.GEOCAM_TRACK_INGEST_BATCH_SIZE
+    inserted = []
+    with transaction.atomic():
+        for start in xrange(0, len(positions), batchSize):
+            inserted.extend(storePastPositionBatch(model, positions[start:start + batchSize], update))
+        updateRollups(unique.iterkeys())
+    invalidateTimes(unique.iterkeys())
+    return inserted
+
+
+def storePositions(track, positionAttrs):
+    """
+    Store a batch of positions for one track: one bulk insert of the
+    historical positions and one update of the current position, using
+    the latest position in the batch.  If compression is configured for
+    the track's vehicle, only the historical positions it keeps are stored.
+    """
+    if not positionAttrs:
+        return
+    pastModel = PAST_POSITION_MODEL.get()
+    storePastPositions([buildPosition(pastModel, track, attrs)
+                        for attrs in compressPositions(track, positionAttrs)])
+
+    latest = max(positionAttrs, key=lambda attrs: attrs['timestamp'])
+    buildPosition(POSITION_MODEL.get(), track, latest).saveCurrent()
+
+
+def getVehicleId(featureDict):
+    vehicleId = featureDict['id']
+    try:
+        return int(vehicleId)
+    except (TypeError, ValueError):
+        return vehicleId
+
+
+def ingestFeatures(features):
+    """
+    Store a list of GeoJSON Features, possibly for many vehicles.
+    Returns one status dictionary per feature, in input order.
+    """
+    statuses = [None] * len(features)
+    indices = []
+    entries = []
+    for i, feature in enumerate(features):
+        try:
+            entries.append((getVehicleId(feature),
+                            getFeatureProperties(feature).get('track'),
+                            getFeatureAttrs(feature)))
+            indices.append(i)
+        except (KeyError, IndexError, TypeError, ValueError, iso8601.ParseError) as e:
+            statuses[i] = dict(status='error', message=str(e))
+
+    for i, status in zip(indices, ingestPositions(entries)):
+        statuses[i] = status
+    return statuses
+
+
+def ingestPositions(entries):
+    """
+    Store positions for many vehicles.  entries is a list of (vehicle id,
+    track name or None, position field values) tuples.  Positions are
+    grouped by track and each track is stored with storePositions, or
+    queued if GEOCAM_TRACK_WRITE_BEHIND is set.  Returns one status
+    dictionary per entry, in input order.
+    """
+    statuses = [None] * len(entries)
+    vehicles = VEHICLE_MODEL.get().objects.in_bulk(list(set(vehicleId for vehicleId, _name, _attrs in entries)))
+
+    tracks = {}
+    batches = OrderedDict()
+    for i, (vehicleId, trackName, attrs) in enumerate(entries):
+        try:
+            vehicle = vehicles.get(vehicleId)
+            if vehicle is None:
+                raise IngestError('unknown vehicle %s' % vehicleId)
+            key = (vehicle.pk, trackName)
+            if key not in tracks:
+                tracks[key] = getTrackForVehicle(vehicle, trackName)
+            track = tracks[key]
+            batches.setdefault(track.pk, (track, []))[1].append((i, attrs))
+        except IngestError as e:
+            statuses[i] = dict(status='error', message=str(e))
+
+    for track, items in batches.itervalues():
+        attrsList = [attrs for _i, attrs in items]
+        try:
+            if settings.GEOCAM_TRACK_WRITE_BEHIND:
+                getPositionQueue().putMany(track, attrsList)
+                status = dict(status='queued', track=track.name)
+            else:
+                storePositions(track, attrsList)
+                status = dict(status='ok', track=track.name)
+        except DatabaseError as e:
+            status = dict(status='error', message=str(e))
+        except QueueFullError as e:
+            status = dict(status='error', message=str(e), retry=True)
+        for i, _attrs in items:
+            statuses[i] = dict(status)
+
+    return statuses
@@ -0,0 +1,216 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+The PositionQueue class is an optional in-process write-behind buffer
+for incoming positions.
+
+When GEOCAM_TRACK_WRITE_BEHIND is enabled, the ingest path puts
+positions on the queue and returns immediately.  A background flusher
+thread drains the queue and stores the positions in bulk, either when
+GEOCAM_TRACK_WRITE_BEHIND_BATCH_SIZE positions are waiting or when
+GEOCAM_TRACK_WRITE_BEHIND_FLUSH_SECONDS have passed, whichever comes
+first.  This decouples ingest latency from database commit latency
+under bursty load.
+
+There is a single flusher thread and positions are grouped by track
+in arrival order, so positions for a track are always stored in the
+order they were queued.
+
+The queue is bounded by GEOCAM_TRACK_WRITE_BEHIND_MAX_DEPTH.  When there
+is no room for a batch, putMany() blocks for up to
+GEOCAM_TRACK_WRITE_BEHIND_PUT_TIMEOUT_SECONDS and then raises
+QueueFullError without queueing any of it, so callers can tell clients
+to back off and resend the whole batch.
+
+Anything still queued is flushed when the process exits.  Positions
+still in the queue are lost if the process is killed.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import Queue
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection, close_old_connections
+
+queueG = None
+queueLockG = threading.Lock()
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class PositionQueue(object):
+    def __init__(self,
+                 maxDepth=settings.GEOCAM_TRACK_WRITE_BEHIND_MAX_DEPTH,
+                 batchSize=settings.GEOCAM_TRACK_WRITE_BEHIND_BATCH_SIZE,
+                 flushSeconds=settings.GEOCAM_TRACK_WRITE_BEHIND_FLUSH_SECONDS,
+                 putTimeoutSeconds=settings.GEOCAM_TRACK_WRITE_BEHIND_PUT_TIMEOUT_SECONDS):
+        self.maxDepth = maxDepth
+        self.batchSize = batchSize
+        self.flushSeconds = flushSeconds
+        self.putTimeoutSeconds = putTimeoutSeconds
+        # bounded by maxDepth in putMany, which needs room for a whole batch
+        self.queue = Queue.Queue()
+        self.space = threading.Condition(threading.Lock())
+        self.stopping = threading.Event()
+        self.thread = None
+
+        self.statsLock = threading.Lock()
+        self.flushCount = 0
+        self.flushedPositions = 0
+        self.failedPositions = 0
+        self.lastFlushSize = 0
+        self.lastFlushSeconds = None
+        self.maxFlushSeconds = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='geocamTrackPositionQueue')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        """
+        Stop the flusher thread after it has stored everything queued so far.
+        """
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def put(self, track, attrs):
+        """
+        Queue one position for the track.  attrs are position field
+        values, as returned by positionIngest.getFeatureAttrs().
+        """
+        self.putMany(track, [attrs])
+
+    def putMany(self, track, attrsList):
+        """
+        Queue positions for the track, all or none: if there is no room
+        for all of them within putTimeoutSeconds, none are queued and
+        QueueFullError is raised.
+        """
+        if self.stopping.is_set():
+            raise QueueFullError('position queue is shutting down')
+        if len(attrsList) > self.maxDepth:
+            raise QueueFullError('batch of %d positions is larger than the position queue (%d)'
+                                 % (len(attrsList), self.maxDepth))
+        deadline = None
+        if self.putTimeoutSeconds is not None:
+            deadline = time.time() + self.putTimeoutSeconds
+        with self.space:
+            while self.queue.qsize() + len(attrsList) > self.maxDepth:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise QueueFullError('position queue is full (%d positions waiting)' % self.maxDepth)
+                self.space.wait(timeout)
+            for attrs in attrsList:
+                self.queue.put((track, attrs))
+
+    def getDepth(self):
+        return self.queue.qsize()
+
+    def getStats(self):
+        with self.statsLock:
+            return dict(enabled=True,
+                        depth=self.getDepth(),
+                        maxDepth=self.maxDepth,
+                        flushCount=self.flushCount,
+                        flushedPositions=self.flushedPositions,
+                        failedPositions=self.failedPositions,
+                        lastFlushSize=self.lastFlushSize,
+                        lastFlushSeconds=self.lastFlushSeconds,
+                        maxFlushSeconds=self.maxFlushSeconds)
+
+    def getBatch(self):
+        """
+        Wait until either batchSize positions are queued or flushSeconds
+        have passed since the first one arrived, and return them.
+        """
+        batch = []
+        deadline = None
+        while len(batch) < self.batchSize:
+            if deadline is None:
+                timeout = self.flushSeconds
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                if batch or self.stopping.is_set():
+                    break
+                continue
+            with self.space:
+                self.space.notify_all()
+            if deadline is None:
+                deadline = time.time() + self.flushSeconds
+        return batch
+
+    def flush(self, batch):
+        from geocamTrack.positionIngest import storePositions
+
+        tracks = OrderedDict()
+        for track, attrs in batch:
+            tracks.setdefault(track.pk, (track, []))[1].append(attrs)
+
+        startTime = time.time()
+        failed = 0
+        close_old_connections()
+        for track, attrsList in tracks.itervalues():
+            try:
+                storePositions(track, attrsList)
+            except Exception:  # pylint: disable=W0703
+                logging.exception('could not store %d queued positions for track %s',
+                                  len(attrsList), track.name)
+                failed += len(attrsList)
+        elapsed = time.time() - startTime
+
+        with self.statsLock:
+            self.flushCount += 1
+            self.flushedPositions += len(batch) - failed
+            self.failedPositions += failed
+            self.lastFlushSize = len(batch)
+            self.lastFlushSeconds = elapsed
+            self.maxFlushSeconds = max(self.maxFlushSeconds, elapsed)
+
+    def run(self):
+        try:
+            while not (self.stopping.is_set() and self.queue.empty()):
+                batch = self.getBatch()
+                if batch:
+                    self.flush(batch)
+        finally:
+            connection.close()
+
+
+def getPositionQueue():
+    """
+    Return the process-wide position queue, starting it on first use.
+    """
+    global queueG
+    with queueLockG:
+        if queueG is None:
+            queueG = PositionQueue()
+            queueG.start()
+        return queueG
+
+
+def getPositionQueueStats():
+    if not settings.GEOCAM_TRACK_WRITE_BEHIND:
+        return dict(enabled=False)
+    return getPositionQueue().getStats()
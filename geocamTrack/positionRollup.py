@@ -0,0 +1,289 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Per-minute summary of the past positions of each track.
+
+For every track and every minute (UTC) with positions, a
+TrackMinuteRollup row holds the first and last timestamp, the number of
+positions, their bounding box and the first and last latitude and
+longitude.  That is enough to answer which days have data, how many
+positions a day has, whether a track was reporting at some time, and
+roughly where it was, without reading the past position table, which has
+up to one row per second per track.
+
+Rollups are kept up to date when GEOCAM_TRACK_POSITION_ROLLUP is set:
+storePastPositions() and single saves and deletes call updateRollups()
+with the positions they touched, and each touched minute is summarized
+again from the positions stored in it, so changed and deleted positions
+are handled the same way as new ones.  The rebuildPositionRollup command
+rebuilds everything from scratch.
+"""
+
+import datetime
+import itertools
+from collections import defaultdict
+
+import pytz
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Sum
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.positionCache import toMicros, fromMicros
+from geocamTrack.timeAlign import getTimeRuns
+from geocamTrack.trackUtil import bulk_update_rows
+
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+ROLLUP_MODEL = LazyGetModelByName('geocamTrack.TrackMinuteRollup')
+
+MINUTE_MICROS = 60 * 1000000
+
+
+def isEnabled():
+    return settings.GEOCAM_TRACK_POSITION_ROLLUP
+
+
+def getMinuteMicros(timestamp):
+    """ Start of the minute of a timestamp, in microseconds since the epoch """
+    micros = toMicros(timestamp)
+    return micros - micros % MINUTE_MICROS
+
+
+def getMinute(timestamp):
+    """ Start of the minute of a timestamp, as stored in TrackMinuteRollup.minute """
+    return fromMicros(getMinuteMicros(timestamp), settings.USE_TZ)
+
+
+def iterMinuteSummaries(rows):
+    """
+    Summarize (timestamp, latitude, longitude) rows, in timestamp order.
+    Yields (minute in microseconds, dictionary of rollup field values)
+    for each minute with rows, in order.
+    """
+    minute = None
+    summary = None
+    for timestamp, latitude, longitude in rows:
+        rowMinute = getMinuteMicros(timestamp)
+        if rowMinute != minute:
+            if summary is not None:
+                yield minute, summary
+            minute = rowMinute
+            summary = dict(firstTimestamp=timestamp,
+                           lastTimestamp=timestamp,
+                           count=1,
+                           minLatitude=latitude,
+                           maxLatitude=latitude,
+                           minLongitude=longitude,
+                           maxLongitude=longitude,
+                           firstLatitude=latitude,
+                           firstLongitude=longitude,
+                           lastLatitude=latitude,
+                           lastLongitude=longitude)
+            continue
+        summary['lastTimestamp'] = timestamp
+        summary['count'] += 1
+        summary['minLatitude'] = min(summary['minLatitude'], latitude)
+        summary['maxLatitude'] = max(summary['maxLatitude'], latitude)
+        summary['minLongitude'] = min(summary['minLongitude'], longitude)
+        summary['maxLongitude'] = max(summary['maxLongitude'], longitude)
+        summary['lastLatitude'] = latitude
+        summary['lastLongitude'] = longitude
+    if summary is not None:
+        yield minute, summary
+
+
+def getPositionRows(trackId, start, end):
+    """ (timestamp, latitude, longitude) of a track's positions in [start, end), in timestamp order """
+    return (PAST_POSITION_MODEL.get().objects
+            .filter(track_id=trackId, timestamp__gte=start, timestamp__lt=end)
+            .order_by('timestamp')
+            .values_list('timestamp', 'latitude', 'longitude'))
+
+
+def writeRollups(trackId, minutes, summaries):
+    """
+    Store the summaries of the given minutes of a track, and delete the
+    rollups of minutes that no longer have positions.
+    """
+    model = ROLLUP_MODEL.get()
+    aware = settings.USE_TZ
+    for attempt in (0, 1):
+        try:
+            with transaction.atomic():
+                stored = dict((toMicros(minute), pk) for pk, minute in
+                               (model.objects
+                                .filter(track_id=trackId,
+                                        minute__in=[fromMicros(m, aware) for m in minutes])
+                                .values_list('pk', 'minute')))
+                newRollups = []
+                valuesByPk = {}
+                emptyPks = []
+                for minute in minutes:
+                    summary = summaries.get(minute)
+                    pk = stored.get(minute)
+                    if summary is None:
+                        if pk is not None:
+                            emptyPks.append(pk)
+                    elif pk is None:
+                        newRollups.append(model(track_id=trackId, minute=fromMicros(minute, aware), **summary))
+                    else:
+                        valuesByPk[pk] = summary
+                if emptyPks:
+                    model.objects.filter(pk__in=emptyPks).delete()
+                bulk_update_rows(model, valuesByPk)
+                model.objects.bulk_create(newRollups)
+            return
+        except IntegrityError:
+            # another writer created some of the same minutes since we looked
+            if attempt:
+                raise
+
+
+def updateRollups(trackTimes):
+    """
+    Summarize again the minutes touched by stored, changed or deleted past positions.
+    :param trackTimes: iterable of (track id, timestamp) of the affected positions
+    """
+    if not isEnabled():
+        return
+    minutesByTrack = defaultdict(set)
+    for trackId, timestamp in trackTimes:
+        if trackId is None or timestamp is None:
+            continue
+        minutesByTrack[trackId].add(getMinuteMicros(timestamp))
+
+    aware = settings.USE_TZ
+    for trackId, minutes in minutesByTrack.iteritems():
+        minutes = sorted(minutes)
+        summaries = {}
+        # one query per run of consecutive minutes
+        for start, end in getTimeRuns(minutes, MINUTE_MICROS):
+            rows = getPositionRows(trackId,
+                                   fromMicros(minutes[start], aware),
+                                   fromMicros(minutes[end - 1] + MINUTE_MICROS, aware))
+            summaries.update(iterMinuteSummaries(rows))
+        writeRollups(trackId, minutes, summaries)
+
+
+def rebuildRollups(trackId, batchSize=None):
+    """
+    Replace all the rollups of a track with ones summarized from its
+    past positions, streamed in timestamp order.  Returns the number of
+    rollups written.
+    """
+    if batchSize is None:
+        batchSize = settings.GEOCAM_TRACK_INGEST_BATCH_SIZE
+    model = ROLLUP_MODEL.get()
+    aware = settings.USE_TZ
+    rows = (PAST_POSITION_MODEL.get().objects
+            .filter(track_id=trackId)
+            .order_by('timestamp')
+            .values_list('timestamp', 'latitude', 'longitude'))
+    summaries = iterMinuteSummaries(rows.iterator())
+    count = 0
+    with transaction.atomic():
+        model.objects.filter(track_id=trackId).delete()
+        while True:
+            batch = [model(track_id=trackId, minute=fromMicros(minute, aware), **summary)
+                     for minute, summary in itertools.islice(summaries, batchSize)]
+            if not batch:
+                break
+            model.objects.bulk_create(batch)
+            count += len(batch)
+    return count
+
+
+def getDates(timeZone=None):
+    """
+    Sorted list of the dates, in timeZone (default GEOCAM_TRACK_OPS_TIME_ZONE),
+    that have positions.  Costs one indexed query per date.
+    """
+    tz = pytz.timezone(timeZone or settings.GEOCAM_TRACK_OPS_TIME_ZONE)
+    model = ROLLUP_MODEL.get()
+    dates = []
+    nextMinute = None
+    while True:
+        query = model.objects.order_by('minute')
+        if nextMinute is not None:
+            query = query.filter(minute__gte=nextMinute)
+        minute = query.values_list('minute', flat=True).first()
+        if minute is None:
+            return dates
+        day = fromMicros(toMicros(minute), aware=True).astimezone(tz).date()
+        dates.append(day)
+        # skip to the start of the next day
+        dayEnd = tz.localize(datetime.datetime.combine(day + datetime.timedelta(1), datetime.time()))
+        nextMinute = fromMicros(toMicros(dayEnd), settings.USE_TZ)
+
+
+def getRollups(start, end, track=None, endExclusive=False):
+    """
+    Rollups of the minutes that overlap [start, end], or [start, end) if
+    endExclusive, optionally for one track
+    """
+    rollups = ROLLUP_MODEL.get().objects.filter(minute__gte=getMinute(start))
+    if endExclusive:
+        rollups = rollups.filter(minute__lt=end)
+    else:
+        rollups = rollups.filter(minute__lte=end)
+    if track is not None:
+        rollups = rollups.filter(track=track)
+    return rollups
+
+
+def getPositionCount(start, end, track=None):
+    """
+    Number of positions in the minutes that overlap [start, end), such as
+    a day from midnight to the next midnight.  Exact when start and end
+    fall on whole minutes.
+    """
+    return getRollups(start, end, track, endExclusive=True).aggregate(count=Sum('count'))['count'] or 0
+
+
+def getTrackIds(start, end):
+    """ Set of ids of the tracks with positions in the minutes that overlap [start, end) """
+    return set(getRollups(start, end, endExclusive=True).values_list('track_id', flat=True).distinct())
+
+
+def hasPositions(track, start, end):
+    """ True if the track has a position between start and end, inclusive """
+    return (getRollups(start, end, track)
+            .filter(lastTimestamp__gte=start, firstTimestamp__lte=end)
+            .exists())
+
+
+def getCoarsePosition(track, utcDt, maxSeconds=None):
+    """
+    Rough position of a track at utcDt: an unsaved past position with
+    latitude and longitude interpolated between the nearest first or
+    last position of a minute on either side, or None if those are more
+    than maxSeconds (default GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS) apart.
+    Costs two queries.
+    """
+    if maxSeconds is None:
+        maxSeconds = settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS
+    rollups = ROLLUP_MODEL.get().objects.filter(track=track)
+    minute = getMinute(utcDt)
+    rows = itertools.chain(rollups.filter(minute__lt=minute).order_by('-minute')[:1],
+                           rollups.filter(minute__gte=minute).order_by('minute')[:2])
+    points = []
+    for row in rows:
+        points.append((toMicros(row.firstTimestamp), row.firstLatitude, row.firstLongitude))
+        points.append((toMicros(row.lastTimestamp), row.lastLatitude, row.lastLongitude))
+
+    t = toMicros(utcDt)
+    before = max([p for p in points if p[0] <= t] or [None])
+    after = min([p for p in points if p[0] >= t] or [None])
+    if before is None or after is None or after[0] - before[0] > maxSeconds * 1000000:
+        return None
+    w = float(t - before[0]) / (after[0] - before[0]) if after[0] > before[0] else 0.0
+    return PAST_POSITION_MODEL.get()(track=track,
+                                     timestamp=utcDt,
+                                     latitude=before[1] + w * (after[1] - before[1]),
+                                     longitude=before[2] + w * (after[2] - before[2]))
@@ -0,0 +1,248 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+In-memory spatial index of current vehicle positions, for questions like
+"which vehicles are within N meters of this one" asked every second.
+
+The index keeps the latest position of each track in a grid of cells
+GEOCAM_TRACK_PROXIMITY_CELL_METERS on a side (measured in latitude), so a
+radius query only measures the distance to positions in the cells the
+circle overlaps, and k nearest queries grow the radius until they have
+enough.  saveCurrent() updates the index of the process it runs in;
+other processes, such as web servers answering proximity.json, call
+refresh() to reload current positions from the database at most every
+GEOCAM_TRACK_PROXIMITY_REFRESH_SECONDS.
+
+Whenever a position is updated, the pairs it forms with positions
+within GEOCAM_TRACK_PROXIMITY_THRESHOLD_METERS are compared with the
+previous update, and the proximityChanged signal is sent for each pair
+that came within the threshold (close=True) or left it (close=False).
+Connect a receiver to it to raise alarms.  Only saveCurrent() sends it:
+refresh() keeps the pairs of its process up to date without sending
+it, so each crossing is reported once, by the process that stored the
+position, however many processes refresh.
+"""
+
+import datetime
+import math
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils import timezone
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.arrayMath import distanceMeters, EARTH_RADIUS_METERS, DEG2RAD
+
+POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_POSITION_MODEL)
+
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * DEG2RAD
+
+# sent with sender=ProximityIndex when a pair of tracks crosses GEOCAM_TRACK_PROXIMITY_THRESHOLD_METERS
+proximityChanged = Signal(providing_args=['trackIds', 'distance', 'close'])
+
+indexG = None
+indexLockG = threading.Lock()
+
+
+def isEnabled():
+    return settings.GEOCAM_TRACK_PROXIMITY
+
+
+def wrapLongitude(lon):
+    return (np.asarray(lon) + 180.0) % 360.0 - 180.0
+
+
+def getDistances(lat, lon, lats, lons):
+    """ Distances in meters from a point to arrays of points, taking the short way across the antimeridian """
+    lons = lon + wrapLongitude(np.asarray(lons, dtype=float) - lon)
+    return distanceMeters(lon, lat, lons, np.asarray(lats, dtype=float))
+
+
+class ProximityIndex(object):
+    """
+    Latest position of each track, in a grid of cells.  Safe to use from
+    several threads.
+    """
+    def __init__(self, cellMeters, thresholdMeters):
+        self.cellMeters = float(cellMeters)
+        self.cellDegrees = self.cellMeters / METERS_PER_DEGREE
+        self.columns = int(math.ceil(360.0 / self.cellDegrees))
+        self.thresholdMeters = thresholdMeters
+        self.positions = {}
+        self.cells = defaultdict(set)
+        self.cellOf = {}
+        self.closeTo = defaultdict(set)
+        self.lock = threading.RLock()
+        self.refreshTime = None
+
+    def getCell(self, lat, lon):
+        return (int(math.floor(lat / self.cellDegrees)),
+                int(math.floor((lon + 180.0) / self.cellDegrees)) % self.columns)
+
+    def getCandidates(self, lat, lon, radius):
+        """ Track ids in the cells a circle overlaps """
+        latSpan = radius / METERS_PER_DEGREE
+        cosLat = math.cos(min(abs(lat) + latSpan, 90.0) * DEG2RAD)
+        row0, col0 = self.getCell(lat - latSpan, lon)
+        row1, _col = self.getCell(lat + latSpan, lon)
+        if cosLat < 1e-6 or latSpan / cosLat >= 180.0:
+            colSpan = self.columns
+        else:
+            colSpan = int(math.ceil(latSpan / cosLat / self.cellDegrees)) + 1
+        cellCount = (row1 - row0 + 1) * min(2 * colSpan + 1, self.columns)
+        if cellCount > len(self.cells):
+            # fewer occupied cells than cells in the circle
+            return [trackId
+                    for (row, col), trackIds in self.cells.iteritems()
+                    if row0 <= row <= row1 and (colSpan >= self.columns or
+                                                min((col - col0) % self.columns, (col0 - col) % self.columns) <= colSpan)
+                    for trackId in trackIds]
+        candidates = []
+        for row in xrange(row0, row1 + 1):
+            for col in xrange(col0 - colSpan, col0 + colSpan + 1):
+                candidates.extend(self.cells.get((row, col % self.columns), ()))
+        return candidates
+
+    def queryRadius(self, lat, lon, radius, exclude=None):
+        """
+        Positions within radius meters of a point, nearest first, as a list of
+        (distance, track id, position) where position is (name, latitude, longitude, timestamp).
+        """
+        with self.lock:
+            candidates = [trackId for trackId in set(self.getCandidates(lat, lon, radius)) if trackId != exclude]
+            if not candidates:
+                return []
+            positions = [self.positions[trackId] for trackId in candidates]
+            distances = getDistances(lat, lon, [p[1] for p in positions], [p[2] for p in positions])
+        result = [(float(d), trackId, position)
+                  for d, trackId, position in zip(distances, candidates, positions)
+                  if d <= radius]
+        result.sort()
+        return result
+
+    def queryNearest(self, lat, lon, k, exclude=None):
+        """ The k positions nearest to a point, in the form queryRadius returns """
+        radius = self.cellMeters
+        while True:
+            result = self.queryRadius(lat, lon, radius, exclude)
+            if len(result) >= k or radius > math.pi * EARTH_RADIUS_METERS:
+                return result[:k]
+            radius *= 2
+
+    def getClosePairs(self, radius):
+        """ Pairs of tracks within radius meters of each other, as (distance, track id, track id) """
+        with self.lock:
+            positions = self.positions.items()
+        pairs = []
+        for trackId, (_name, lat, lon, _timestamp) in positions:
+            for distance, other, _position in self.queryRadius(lat, lon, radius, exclude=trackId):
+                if trackId < other:
+                    pairs.append((distance, trackId, other))
+        pairs.sort()
+        return pairs
+
+    def update(self, trackId, name, lat, lon, timestamp, notify=True):
+        """
+        Move a track to a new position, and send proximityChanged for pairs
+        that crossed the threshold unless notify is False.
+        """
+        if lat is None or lon is None:
+            return
+        with self.lock:
+            self.discard(trackId)
+            self.positions[trackId] = (name, lat, lon, timestamp)
+            cell = self.getCell(lat, lon)
+            self.cells[cell].add(trackId)
+            self.cellOf[trackId] = cell
+
+            changes = []
+            if self.thresholdMeters:
+                near = dict((other, distance) for distance, other, _position
+                            in self.queryRadius(lat, lon, self.thresholdMeters, exclude=trackId))
+                before = self.closeTo[trackId]
+                for other in set(near) - before:
+                    self.closeTo[other].add(trackId)
+                    changes.append((other, near[other], True))
+                for other in before - set(near):
+                    self.closeTo[other].discard(trackId)
+                    position = self.positions.get(other)
+                    distance = None
+                    if position is not None:
+                        distance = float(getDistances(lat, lon, [position[1]], [position[2]])[0])
+                    changes.append((other, distance, False))
+                self.closeTo[trackId] = set(near)
+
+        if not notify:
+            return
+        for other, distance, close in changes:
+            proximityChanged.send(sender=ProximityIndex,
+                                  trackIds=(trackId, other),
+                                  distance=distance,
+                                  close=close)
+
+    def discard(self, trackId):
+        with self.lock:
+            cell = self.cellOf.pop(trackId, None)
+            if cell is not None:
+                self.cells[cell].discard(trackId)
+                if not self.cells[cell]:
+                    del self.cells[cell]
+            self.positions.pop(trackId, None)
+
+    def remove(self, trackId):
+        """ Forget a track, without sending proximityChanged for the pairs it was in """
+        with self.lock:
+            self.discard(trackId)
+            for other in self.closeTo.pop(trackId, ()):
+                self.closeTo[other].discard(trackId)
+
+    def refresh(self, force=False):
+        """
+        Reload current positions updated in the last GEOCAM_TRACK_PROXIMITY_MAX_AGE_SECONDS
+        from the database, if the last refresh was more than GEOCAM_TRACK_PROXIMITY_REFRESH_SECONDS ago.
+        proximityChanged is not sent; the process that saved the positions sent it.
+        """
+        if (not force and self.refreshTime is not None and
+                time.time() - self.refreshTime < settings.GEOCAM_TRACK_PROXIMITY_REFRESH_SECONDS):
+            return
+        self.refreshTime = time.time()
+        if settings.USE_TZ:
+            now = timezone.now()
+        else:
+            now = datetime.datetime.utcnow()
+        rows = (POSITION_MODEL.get().objects
+                .filter(timestamp__gte=now - datetime.timedelta(seconds=settings.GEOCAM_TRACK_PROXIMITY_MAX_AGE_SECONDS))
+                .values_list('track_id', 'track__name', 'latitude', 'longitude', 'timestamp'))
+        current = set()
+        for trackId, name, lat, lon, timestamp in rows:
+            current.add(trackId)
+            if self.positions.get(trackId) != (name, lat, lon, timestamp):
+                self.update(trackId, name, lat, lon, timestamp, notify=False)
+        for trackId in set(self.positions) - current:
+            self.remove(trackId)
+
+
+def getProximityIndex():
+    global indexG
+    with indexLockG:
+        if indexG is None:
+            indexG = ProximityIndex(settings.GEOCAM_TRACK_PROXIMITY_CELL_METERS,
+                                    settings.GEOCAM_TRACK_PROXIMITY_THRESHOLD_METERS)
+        return indexG
+
+
+def updateCurrentPosition(position):
+    """ Called by saveCurrent to put a track's new current position in the index """
+    if isEnabled() and position.track_id is not None:
+        getProximityIndex().update(position.track_id, position.track.name,
+                                   position.latitude, position.longitude, position.timestamp)
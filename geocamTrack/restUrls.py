@@ -20,6 +20,15 @@ urlpatterns = [url(r'^vehiclePositions.json$', views.getVehiclePositionsJson,{})
                url(r'^track/(?P<trackName>[\w-]+)$', views.getTrackKml,{},'geocamTrack_trackKml'),
                url(r'^track/([^\./]+\.csv)$', views.getTrackCsv,{},'geocamTrack_trackCsv'),
                url(r'^animated/track/(?P<trackName>[\w\d\s-]+)$', views.getAnimatedTrackKml,{},'geocamTrack_trackKml_animated'),
+               # the same KML compressed as KMZ, see kmlStream.compressedKmlPage
+               url(r'^liveMap.kmz$', views.getKmlNetworkLink,{}),
+               url(r'^latest.kmz$', views.getKmlLatest,{}),
+               url(r'^tracks.kmz$', views.getCurrentPosKml,{},'geocamTrack_tracks_kmz'),
+               url(r'^recent/tracks.kmz$', views.getRecentTracksKml,{},'geocamTrack_recentTracks_kmz'),
+               url(r'^cached/tracks.kmz$', views.getCachedTracksKml,{},'geocamTrack_cachedTracks_kmz'),
+               url(r'^trackIndex.kmz$', views.getTrackIndexKml,{},'geocamTrack_trackIndex_kmz'),
+               url(r'^track/(?P<trackName>[\w-]+)\.kmz$', views.getTrackKml,{},'geocamTrack_trackKml_kmz'),
+               url(r'^animated/track/(?P<trackName>[\w\d\s-]+)\.kmz$', views.getAnimatedTrackKml,{},'geocamTrack_trackKml_animated_kmz'),
                url(r'^mapJsonTrack/(?P<uuid>[\w-]+)$', views.mapJsonTrack, {'downsample': False}, 'geocamTrack_mapJsonTrack'),
                url(r'^mapJsonTrack/downsample/(?P<uuid>[\w-]+)$', views.mapJsonTrack, {'downsample': True}, 'geocamTrack_mapJsonTrack_downsample'),
                url(r'^mapJsonPosition/(?P<id>[\d]+)$', views.mapJsonPosition, {}, 'geocamTrack_mapJsonPosition'),
@@ -0,0 +1,166 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Level-of-detail simplification of track lines.
+
+A track with hundreds of thousands of positions draws the same line at
+any practical zoom level as one with a few thousand well chosen ones.
+simplifyLine() picks them with the Douglas-Peucker algorithm: a point is
+kept only if leaving it out would move the line by more than a tolerance
+in meters.  Segments split at GEOCAM_TRACK_START_NEW_LINE_DISTANCE_METERS
+are simplified separately, so breaks in the line stay where they were.
+
+getSimplifiedTrack() caches the result in the Django cache per track,
+tolerance and positions query, under the track's position version (see
+positionCache.invalidateTimes), so it is computed again only after the
+track's positions change.
+"""
+
+import hashlib
+
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import cache
+
+from geocamTrack.arrayMath import diffMeters, distanceMeters, toFloatArray
+from geocamTrack.positionCache import getVersion, getVersionKey
+
+CACHE_KEY_PREFIX = 'geocamTrack.simplify'
+
+
+def toLocalMeters(lonLat):
+    """ N x 2 longitude, latitude array to east, north meters from its mean point """
+    east, north = diffMeters(np.mean(lonLat[:, 0]), np.mean(lonLat[:, 1]), lonLat[:, 0], lonLat[:, 1])
+    return np.column_stack((east, north))
+
+
+def getSegmentDistances(points, a, b):
+    """ Distances from each row of points to the segment from a to b """
+    ab = b - a
+    length2 = np.dot(ab, ab)
+    if length2 == 0:
+        return np.hypot(points[:, 0] - a[0], points[:, 1] - a[1])
+    t = np.clip(np.dot(points - a, ab) / length2, 0, 1)
+    nearest = a + t[:, None] * ab
+    return np.hypot(points[:, 0] - nearest[:, 0], points[:, 1] - nearest[:, 1])
+
+
+def simplifyLine(lonLat, toleranceMeters):
+    """
+    Douglas-Peucker simplification of a line.
+    :param lonLat: N x 2 array of longitude, latitude
+    :return: sorted array of the indices of the points to keep, always including the first and last
+    """
+    n = len(lonLat)
+    if n < 3:
+        return np.arange(n)
+    xy = toLocalMeters(lonLat)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = getSegmentDistances(xy[first + 1:last], xy[first], xy[last])
+        i = int(np.argmax(distances))
+        if distances[i] > toleranceMeters:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.nonzero(keep)[0]
+
+
+def splitSegments(lonLat, breakDist):
+    """ (start, end) index ranges of the parts of a line split where consecutive points are more than breakDist apart """
+    n = len(lonLat)
+    if breakDist is None or n < 2:
+        return [(0, n)]
+    dist = distanceMeters(lonLat[:-1, 0], lonLat[:-1, 1], lonLat[1:, 0], lonLat[1:, 1])
+    starts = [0] + (np.nonzero(dist > breakDist)[0] + 1).tolist() + [n]
+    return zip(starts[:-1], starts[1:])
+
+
+def readTrack(positions, fields):
+    """ Timestamps and an N x len(fields) float array, NaN for None, of a queryset in one pass """
+    times = []
+    values = []
+    for row in positions.values_list('timestamp', *fields).iterator():
+        times.append(row[0])
+        values.append(row[1:])
+    columns = [toFloatArray([v[i] for v in values]) for i in xrange(len(fields))]
+    if columns:
+        return times, np.column_stack(columns)
+    return times, np.zeros((0, 0))
+
+
+def simplifyTrack(times, values, fields, toleranceMeters, breakDist):
+    """
+    Simplify each segment of a track.  Returns a list of (times,
+    coordinate rows) per segment, with each row a list of values in the
+    order of fields and None for missing values.
+    """
+    if not times:
+        return []
+    lonLat = values[:, [fields.index('longitude'), fields.index('latitude')]]
+    segments = []
+    for start, end in splitSegments(lonLat, breakDist):
+        keep = start + simplifyLine(lonLat[start:end], toleranceMeters)
+        rows = [[None if np.isnan(v) else float(v) for v in values[i]] for i in keep]
+        segments.append(([times[i] for i in keep], rows))
+    return segments
+
+
+def getLonLatArray(rows, fields):
+    """ N x 2 longitude, latitude array of coordinate rows in the order of fields """
+    lon = fields.index('longitude')
+    lat = fields.index('latitude')
+    return np.array([(row[lon], row[lat]) for row in rows], dtype=float)
+
+
+def getCacheKey(track, toleranceMeters, positions):
+    """ Cache key of a simplified line, changing whenever the track's positions do """
+    version = getVersion(getVersionKey(track.pk))
+    query = hashlib.md5(str(positions.query)).hexdigest()
+    return '%s.%s.%s.%s.%s' % (CACHE_KEY_PREFIX, track.pk, float(toleranceMeters), query, version)
+
+
+def getSimplifiedTrack(track, toleranceMeters, positions=None, useCache=True):
+    """
+    Simplified line of a queryset of a track's past positions, all of them
+    by default.  Returns a list of segments as simplifyTrack does, with
+    coordinate rows in the order of the model's coords_array_order().
+    """
+    if positions is None:
+        positions = track.getPositions()
+    fields = list(positions.model.coords_array_order())
+    key = None
+    if useCache:
+        key = getCacheKey(track, toleranceMeters, positions)
+        segments = cache.get(key)
+        if segments is not None:
+            return segments
+
+    times, values = readTrack(positions, fields)
+    segments = simplifyTrack(times, values, fields, toleranceMeters,
+                             settings.GEOCAM_TRACK_START_NEW_LINE_DISTANCE_METERS)
+    if key is not None:
+        cache.set(key, segments, settings.GEOCAM_TRACK_SIMPLIFY_CACHE_SECONDS)
+    return segments
+
+
+def getTolerance(request):
+    """ The tolerance query parameter in meters, or None if it is missing, not a number or not positive """
+    try:
+        tolerance = float(request.GET.get('tolerance', ''))
+    except ValueError:
+        return None
+    if tolerance > 0:
+        return tolerance
+    return None
@@ -0,0 +1,161 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Grid cell index for bounding box searches over past positions.
+
+Separate indexes on latitude and longitude can only narrow a bounding
+box search down to a band of the globe.  Instead, the globe is divided
+into a latitude/longitude grid of GEOCAM_TRACK_SPATIAL_CELL_DEGREES
+cells, numbered row by row from the south-west corner, and each past
+position stores the number of its cell (see CellMixin).  With an index
+on (cell, timestamp), a bounding box and time range becomes a set of
+index range scans, one per cell, and only the positions in those cells
+and times are read.
+
+If GEOCAM_TRACK_SPATIAL_CELL_DEGREES changes, run
+manage.py populatePositionCells --all to renumber the stored positions.
+"""
+
+import math
+
+from django.conf import settings
+from django.db.models import Q
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.arrayMath import datetimeToEpoch
+
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+
+
+def getGridSize():
+    """ (rows, columns) of the grid """
+    degrees = settings.GEOCAM_TRACK_SPATIAL_CELL_DEGREES
+    return int(math.ceil(180.0 / degrees)), int(math.ceil(360.0 / degrees))
+
+
+def getRow(latitude):
+    rows, _columns = getGridSize()
+    row = int(math.floor((latitude + 90.0) / settings.GEOCAM_TRACK_SPATIAL_CELL_DEGREES))
+    return min(max(row, 0), rows - 1)
+
+
+def getColumn(longitude):
+    _rows, columns = getGridSize()
+    column = int(math.floor((longitude + 180.0) / settings.GEOCAM_TRACK_SPATIAL_CELL_DEGREES))
+    return min(max(column, 0), columns - 1)
+
+
+def getCell(latitude, longitude):
+    """ Number of the grid cell containing a point, or None if either coordinate is missing """
+    if latitude is None or longitude is None:
+        return None
+    _rows, columns = getGridSize()
+    return getRow(latitude) * columns + getColumn(longitude)
+
+
+def hasCells(model):
+    return any(f.attname == 'cell' for f in model._meta.concrete_fields)
+
+
+def setCells(positions):
+    """ Fill in the cell of unsaved positions, for models that have one """
+    if positions and hasCells(positions[0].__class__):
+        for pos in positions:
+            pos.cell = getCell(pos.latitude, pos.longitude)
+
+
+def getLongitudeRanges(west, east):
+    """ A bounding box that crosses the antimeridian (west > east) covers two longitude ranges """
+    if west <= east:
+        return [(west, east)]
+    return [(west, 180.0), (-180.0, east)]
+
+
+def getCellRanges(west, south, east, north):
+    """
+    Cells covering a bounding box, as a list of (first, last) ranges of
+    consecutive cell numbers: one per grid row and longitude range.
+    """
+    _rows, columns = getGridSize()
+    ranges = []
+    for row in xrange(getRow(south), getRow(north) + 1):
+        for lonMin, lonMax in getLongitudeRanges(west, east):
+            ranges.append((row * columns + getColumn(lonMin), row * columns + getColumn(lonMax)))
+    return ranges
+
+
+def getBboxFilter(west, south, east, north, model=None):
+    """
+    Q matching positions inside a bounding box, in degrees.  For a model
+    with cells this selects by cell first: each cell number when there are
+    at most GEOCAM_TRACK_SPATIAL_MAX_CELLS of them, or ranges of cells
+    otherwise.  Positions are then checked against the exact box.
+    """
+    if model is None:
+        model = PAST_POSITION_MODEL.get()
+    exact = Q()
+    for lonMin, lonMax in getLongitudeRanges(west, east):
+        exact |= Q(longitude__gte=lonMin, longitude__lte=lonMax)
+    exact &= Q(latitude__gte=south, latitude__lte=north)
+    if not hasCells(model):
+        return exact
+
+    ranges = getCellRanges(west, south, east, north)
+    if sum(last - first + 1 for first, last in ranges) <= settings.GEOCAM_TRACK_SPATIAL_MAX_CELLS:
+        cells = Q(cell__in=[cell for first, last in ranges for cell in xrange(first, last + 1)])
+    else:
+        cells = Q()
+        for first, last in ranges:
+            cells |= Q(cell__gte=first, cell__lte=last)
+    return cells & exact
+
+
+def getPositionsInBbox(west, south, east, north, start, end, positions=None):
+    """ Past positions inside a bounding box with timestamps between start and end, inclusive """
+    if positions is None:
+        positions = PAST_POSITION_MODEL.get().objects.all()
+    return (positions
+            .filter(getBboxFilter(west, south, east, north, positions.model))
+            .filter(timestamp__gte=start, timestamp__lte=end))
+
+
+def getTimeSpans(rows, gapSeconds):
+    """
+    Group (track id, timestamp) rows, ordered by track and timestamp, into
+    spans of positions no more than gapSeconds apart.  Returns a list of
+    dictionaries with the track id, start, end and count of each span.
+    """
+    spans = []
+    span = None
+    lastEpoch = None
+    for trackId, timestamp in rows:
+        epoch = datetimeToEpoch(timestamp)
+        if span is None or trackId != span['track'] or epoch - lastEpoch > gapSeconds:
+            span = dict(track=trackId, start=timestamp, end=timestamp, count=0)
+            spans.append(span)
+        span['end'] = timestamp
+        span['count'] += 1
+        lastEpoch = epoch
+    return spans
+
+
+def findTrackSpans(west, south, east, north, start, end, gapSeconds=None, positions=None):
+    """
+    Which tracks passed through a bounding box between start and end, and
+    when.  Returns spans as getTimeSpans does, breaking a track's span
+    wherever it was out of the box, or not reporting, for more than
+    gapSeconds (default GEOCAM_TRACK_SPATIAL_SPAN_GAP_SECONDS).  Matching
+    positions are streamed, never held in memory.
+    """
+    if gapSeconds is None:
+        gapSeconds = settings.GEOCAM_TRACK_SPATIAL_SPAN_GAP_SECONDS
+    # order by track id: ordering by track sorts by its name, which interleaves same-named tracks
+    rows = (getPositionsInBbox(west, south, east, north, start, end, positions)
+            .order_by('track_id', 'timestamp')
+            .values_list('track_id', 'timestamp'))
+    return getTimeSpans(rows.iterator(), gapSeconds)
@@ -11,9 +11,30 @@ Test geocamTrack.
 import os
 import logging
 import tempfile
+import datetime
+import gzip
+import zipfile
+from StringIO import StringIO
 
-from django.test import TransactionTestCase
+import numpy as np
+import pytz
+
+from django.test import TransactionTestCase, SimpleTestCase, override_settings
 from django.core.urlresolvers import reverse
+from django.db import DatabaseError
+
+from xgds_core.importer import csvImporter
+
+from geocamTrack import positionIngest, positionFrame, positionCache, positionRollup, orientation, spatialIndex, proximity, \
+    kmlStream, kmlBlocks, models, simplify, positionQueue
+from geocamTrack.gpxImporter import iterGpxTracks
+from geocamTrack.importer.trackCsvImporter import TrackCsvImporter
+from geocamTrack.filter import FancyPositionFilter
+from geocamTrack.compression import TrackCompressor
+from geocamTrack.fastPosition import ArrayFastPosition
+from geocamTrack.management.commands.trackListener import PositionListener
+from geocamTrack.utils import getCloser
+from geocamTrack.timeAlign import mergeClosest, getTimeRuns
 
 try:
     import pykml
@@ -27,24 +48,37 @@ class TestGeocamTrackViews(TransactionTestCase):
     def assertKmlValid(self, response):
         self.assertEqual(response.status_code, 200)
         self.assert_(response['Content-Type'].startswith('application/vnd.google-earth.kml+xml'))
+        if response.streaming:
+            content = ''.join(response.streaming_content)
+        else:
+            content = response.content
         if 0 and pykml:
             # real validation against KML schema -- disabled for now because it seems to reject
             # some valid kml files.
-            doc = kmlparser.fromstring(response.content)
+            doc = kmlparser.fromstring(content)
             schema = kmlparser.Schema("kml22gx.xsd")
             try:
                 schema.assertValid(doc)
             except lxml.etree.DocumentInvalid:
                 fd, path = tempfile.mkstemp('-TestGeocamTrackViews.kml')
                 with os.fdopen(fd, 'w') as f:
-                    f.write(response.content)
+                    f.write(content)
                 logging.warning('kml contents written to %s for debugging', path)
                 raise
         else:
             # superficial check that it looks like KML
-            self.assert_(response.content.startswith('<?xml'))
-            self.assert_('<kml' in response.content)
-            self.assert_('</kml>' in response.content)
+            self.assert_(content.startswith('<?xml'))
+            self.assert_('<kml' in content)
+            self.assert_('</kml>' in content)
+
+    def test_cachedTracksAreCached(self):
+        first = self.client.get(reverse('geocamTrack_cachedTracks'))
+        self.assertTrue(first.streaming)
+        content = ''.join(first.streaming_content)
+        # once streamed in full, the response comes from the cache
+        second = self.client.get(reverse('geocamTrack_cachedTracks'))
+        self.assertFalse(second.streaming)
+        self.assertEqual(second.content, content)
 
     def test_index(self):
         response = self.client.get(reverse('geocamTrack_index'))
@@ -66,13 +100,698 @@ class TestGeocamTrackViews(TransactionTestCase):
         response = self.client.get(reverse('geocamTrack_trackIndex'))
         self.assertKmlValid(response)
 
+    def test_tracksKmz(self):
+        response = self.client.get(reverse('geocamTrack_tracks_kmz'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], kmlStream.KMZ_CONTENT_TYPE)
+        kmz = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        self.assertEqual(kmz.namelist(), ['doc.kml'])
+        self.assert_('</kml>' in kmz.read('doc.kml'))
+
+    def test_tracksGzip(self):
+        response = self.client.get(reverse('geocamTrack_tracks'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gzip.GzipFile(fileobj=StringIO(''.join(response.streaming_content))).read()
+        self.assert_('</kml>' in content)
+
     def test_csvTrackIndex(self):
         response = self.client.get(reverse('geocamTrack_csvTrackIndex'))
         self.assertEqual(response.status_code, 200)
 
+    def test_postPositionsMalformed(self):
+        response = self.client.post(reverse('geocamTrack_postPositions'),
+                                    'not json',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_ingestStatus(self):
+        response = self.client.get(reverse('geocamTrack_ingestStatus'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_proximityAmbiguousTrack(self):
+        for _ in xrange(2):
+            positionIngest.TRACK_MODEL.get().objects.create(name='proximityTest')
+        response = self.client.get(reverse('geocamTrack_proximity'), {'track': 'proximityTest', 'k': 1})
+        self.assertEqual(response.status_code, 400)
+
     # this test won't work until we have a test fixture
     #def test_trackCsv(self):
     #    response = self.client.get(reverse('geocamTrack_trackCsv',
     #                                       args=['test.csv']),
     #                               {'track': 'test'})
     #    self.assertEqual(response.status_code, 200)
+
+
+class TestPositionIngest(SimpleTestCase):
+    def test_parseFeatures(self):
+        feature = '{"type": "Feature", "id": 1, "geometry": {"type": "Point", "coordinates": [-122.1, 37.4]}}'
+        collection = '{"type": "FeatureCollection", "features": [%s, %s]}' % (feature, feature)
+        self.assertEqual(len(positionIngest.parseFeatures(feature)), 1)
+        self.assertEqual(len(positionIngest.parseFeatures(collection)), 2)
+        self.assertEqual(len(positionIngest.parseFeatures(feature + '\n' + feature + '\n')), 2)
+
+    def test_getFeatureAttrs(self):
+        attrs = positionIngest.getFeatureAttrs({'id': 1,
+                                                'geometry': {'coordinates': [-122.1, 37.4, 10]},
+                                                'properties': {'timestamp': '2016-01-01T01:00:00-01:00',
+                                                               'heading': 1.5}})
+        self.assertEqual(attrs['timestamp'].hour, 2)
+        self.assertEqual(attrs['altitude'], 10)
+        self.assertEqual(attrs['heading'], 1.5)
+
+    def test_ingestFeaturesMalformed(self):
+        geometry = {'coordinates': [-122.1, 37.4]}
+        statuses = positionIngest.ingestFeatures([{'id': 1, 'geometry': geometry, 'properties': ['timestamp']},
+                                                  'not a feature'])
+        # each malformed feature gets its own error status
+        self.assertEqual([status['status'] for status in statuses], ['error', 'error'])
+
+    def test_getTimestampKey(self):
+        naive = datetime.datetime(2016, 1, 1, 2, 0, 0, 500)
+        aware = pytz.timezone('Etc/GMT+1').localize(datetime.datetime(2016, 1, 1, 1, 0, 0, 500))
+        self.assertEqual(positionIngest.getTimestampKey(naive), naive)
+        self.assertEqual(positionIngest.getTimestampKey(aware), naive)
+
+
+GPX_TWO_SEGMENTS = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+  <trk>
+    <name>test</name>
+    <trkseg>
+      <trkpt lat="37.1" lon="-122.1"><ele>1.0</ele><time>2016-01-01T00:00:00Z</time></trkpt>
+      <trkpt lat="37.2" lon="-122.2"><ele>2.0</ele><time>2016-01-01T00:00:01Z</time></trkpt>
+    </trkseg>
+    <trkseg>
+      <trkpt lat="37.3" lon="-122.3"><time>2016-01-01T00:00:02Z</time></trkpt>
+    </trkseg>
+  </trk>
+</gpx>
+"""
+
+
+class TestGpxImporter(SimpleTestCase):
+    def test_iterGpxTracks(self):
+        events = list(iterGpxTracks(StringIO(GPX_TWO_SEGMENTS)))
+        self.assertEqual(events[0], ('track', 'test'))
+        points = [value for kind, value in events if kind == 'point']
+        self.assertEqual(len(points), 3)
+        self.assertEqual(points[2]['lat'], 37.3)
+        self.assertEqual(points[2]['ele'], None)
+        self.assertEqual(points[1]['time'].second, 1)
+
+
+class FakePosition(object):
+    def __init__(self, trackId, longitude, latitude, timestamp, heading=None):
+        self.track_id = trackId
+        self.longitude = longitude
+        self.latitude = latitude
+        self.timestamp = timestamp
+        self.heading = heading
+
+
+class TestPositionFilter(SimpleTestCase):
+    def test_addManyMatchesAdd(self):
+        start = datetime.datetime(2016, 1, 1)
+        # two tracks heading north, about 1.1 meters between positions
+        positions = [FakePosition(trackId, -122.0 + trackId, 37.0 + i * 1e-5, start + datetime.timedelta(seconds=i))
+                     for i in xrange(100)
+                     for trackId in (1, 2)]
+        accepted = []
+        positionFilter = FancyPositionFilter(seconds=30, batchCallback=accepted.extend)
+        positionFilter.previousPositions = {1: None, 2: None}
+        positionFilter.add_many(positions)
+
+        expected = []
+        for trackId in (1, 2):
+            prev = None
+            for pos in positions:
+                if pos.track_id == trackId and (prev is None or
+                                                (pos.timestamp - prev.timestamp).total_seconds() > 30):
+                    expected.append(pos)
+                    prev = pos
+        self.assertEqual(accepted, expected)
+        self.assertEqual(len(accepted), 8)
+
+
+class TestTrackCompressor(SimpleTestCase):
+    def test_straightLine(self):
+        start = datetime.datetime(2016, 1, 1)
+        # heading north at about 1.1 meters per second
+        fixes = [dict(timestamp=start + datetime.timedelta(seconds=i),
+                      latitude=37.0 + i * 1e-5,
+                      longitude=-122.0)
+                 for i in xrange(200)]
+        compressor = TrackCompressor(meters=0.5)
+        stored = []
+        for fix in fixes:
+            stored.extend(compressor.add(fix))
+        stored.extend(compressor.flush())
+
+        self.assertEqual(stored[0], fixes[0])
+        self.assertEqual(stored[-1], fixes[-1])
+        # stored fixes are only as far apart as interpolation allows
+        self.assertTrue(len(stored) < len(fixes) / 5)
+        for before, after in zip(stored, stored[1:]):
+            self.assertTrue((after['latitude'] - before['latitude']) * 111000 < 20.01)
+
+        # a sharp turn is kept
+        turn = dict(timestamp=start + datetime.timedelta(seconds=200),
+                    latitude=37.002,
+                    longitude=-121.9999)
+        back = dict(timestamp=start + datetime.timedelta(seconds=201),
+                    latitude=37.00201,
+                    longitude=-122.0)
+        self.assertEqual(compressor.add(turn), [])
+        self.assertEqual(compressor.add(back), [turn])
+
+
+class TestPositionFrame(SimpleTestCase):
+    def test_roundTrip(self):
+        timestamp = datetime.datetime(2016, 1, 1, 12, 30, 15, 250000)
+        data = (positionFrame.packFrame(7, timestamp, 37.5, -122.25, 12.5, 90.0) +
+                positionFrame.packFrame(8, timestamp, 37.5, -122.25))
+        frames, extra = positionFrame.splitFrames(data + data[:10])
+        self.assertEqual(extra, data[:10])
+        self.assertEqual(positionFrame.decodeFrames(frames),
+                         [(7, dict(timestamp=timestamp, latitude=37.5, longitude=-122.25,
+                                   altitude=12.5, heading=90.0)),
+                          (8, dict(timestamp=timestamp, latitude=37.5, longitude=-122.25))])
+
+
+
+class TestPositionListener(SimpleTestCase):
+    def setUp(self):
+        self.originalIngest = positionIngest.ingestPositions
+
+    def tearDown(self):
+        positionIngest.ingestPositions = self.originalIngest
+
+    def test_flushKeepsFramesOnDatabaseError(self):
+        def failIngest(entries):
+            raise DatabaseError('database is down')
+
+        listener = PositionListener('localhost')
+        frame = dict(timestamp=datetime.datetime(2016, 1, 1), latitude=37.5, longitude=-122.25)
+        listener.pending = [(7, frame)]
+        positionIngest.ingestPositions = failIngest
+        listener.flush()
+        self.assertEqual(listener.pending, [(7, frame)])
+        self.assertNotEqual(listener.retryTime, None)
+
+        positionIngest.ingestPositions = lambda entries: [dict(status='ok') for _entry in entries]
+        listener.flush()
+        self.assertEqual((listener.pending, listener.storedCount, listener.retryTime), ([], 1, None))
+
+class TestArrayFastPosition(SimpleTestCase):
+    def test_getInterpolatedPositions(self):
+        start = datetime.datetime(2016, 1, 1)
+        fastPosition = ArrayFastPosition.__new__(ArrayFastPosition)
+        fastPosition.model = positionIngest.PAST_POSITION_MODEL.get()
+        fastPosition.fields = ['latitude', 'longitude', 'altitude']
+        fastPosition.setRows([(start, 37.0, -122.0, 0.0),
+                              (start + datetime.timedelta(seconds=10), 37.0001, -122.0, 10.0),
+                              (start + datetime.timedelta(seconds=20), 37.0002, -122.0, None),
+                              # too far from the previous position to interpolate
+                              (start + datetime.timedelta(seconds=30), 37.1, -122.0, 0.0)])
+        queries = [start + datetime.timedelta(seconds=s) for s in (15, -1, 5, 10, 25, 30, 31)]
+        result = fastPosition.getInterpolatedPositions(queries)
+        self.assertEqual(result['valid'].tolist(), [True, False, True, True, False, True, False])
+        self.assertAlmostEqual(result['latitude'][0], 37.00015)
+        self.assertTrue(np.isnan(result['altitude'][0]))
+        self.assertAlmostEqual(result['altitude'][2], 5.0)
+        self.assertAlmostEqual(result['altitude'][3], 10.0)
+        self.assertAlmostEqual(result['latitude'][5], 37.1)
+
+    def test_getInterpolatedPositionList(self):
+        start = datetime.datetime(2016, 1, 1)
+        fastPosition = ArrayFastPosition.__new__(ArrayFastPosition)
+        fastPosition.track = None
+        fastPosition.model = positionIngest.PAST_POSITION_MODEL.get()
+        fastPosition.fields = ['latitude', 'longitude']
+        fastPosition.setRows([(start, 37.0, -122.0),
+                              (start + datetime.timedelta(seconds=10), 37.0001, -122.0)])
+        queries = [start + datetime.timedelta(seconds=s) for s in (5, 20, 0)]
+        positions = fastPosition.getInterpolatedPositionList(queries)
+        self.assertEqual(positions[1], None)
+        self.assertEqual([p.timestamp for p in (positions[0], positions[2])], [queries[0], queries[2]])
+        self.assertAlmostEqual(positions[0].latitude, 37.00005)
+        self.assertEqual(positions[2].latitude, 37.0)
+
+
+class TestSaveCurrent(TransactionTestCase):
+    @override_settings(XGDS_CORE_REDIS=True)
+    def test_broadcastOnlyOnReplace(self):
+        track = positionIngest.TRACK_MODEL.get().objects.create(name='saveCurrentTest')
+        model = positionIngest.POSITION_MODEL.get()
+        broadcasts = []
+
+        def saveCurrent(latitude):
+            pos = model(track=track, timestamp=datetime.datetime(2016, 1, 1), latitude=latitude, longitude=-122.0)
+            pos.broadcast = lambda: broadcasts.append(pos.pk)
+            pos.saveCurrent()
+            return pos
+
+        first = saveCurrent(37.0)
+        self.assertEqual(broadcasts, [])
+        saveCurrent(37.1)
+        self.assertEqual(broadcasts, [first.pk])
+        self.assertEqual(model.objects.get(track=track).latitude, 37.1)
+
+        # a row created again gets a new pk, which replacing it reports
+        model.objects.filter(track=track).delete()
+        third = saveCurrent(37.2)
+        saveCurrent(37.3)
+        self.assertEqual(broadcasts, [first.pk, third.pk])
+
+    @override_settings(XGDS_CORE_REDIS=False, GEOCAM_TRACK_PROXIMITY=False)
+    def test_replaceIsOneQuery(self):
+        track = positionIngest.TRACK_MODEL.get().objects.create(name='saveCurrentQueryTest')
+        model = positionIngest.POSITION_MODEL.get()
+        model(track=track, timestamp=datetime.datetime(2016, 1, 1), latitude=37.0, longitude=-122.0).saveCurrent()
+        pos = model(track=track, timestamp=datetime.datetime(2016, 1, 1, 0, 1), latitude=37.1, longitude=-122.0)
+        # without broadcasting there is no need to read the primary key back
+        with self.assertNumQueries(1):
+            pos.saveCurrent()
+        self.assertEqual(model.objects.get(track=track).latitude, 37.1)
+
+
+class TestTrackCsvImport(TransactionTestCase):
+    def setUp(self):
+        self.baseArgs = None
+
+        def baseInit(importer, yaml_file_path, csv_file_path, vehicle_name, flight_name, timezone_name,
+                     defaults, force, replace):
+            # stands in for the base importer, which reads the yaml configuration and the csv file
+            self.baseArgs = (force, replace)
+            importer.config = {'defaults': {}}
+            importer.flight = flight_name
+            importer.vehicle = None
+
+        self.originalInit = csvImporter.CsvImporter.__dict__['__init__']
+        csvImporter.CsvImporter.__init__ = baseInit
+
+    def tearDown(self):
+        csvImporter.CsvImporter.__init__ = self.originalInit
+
+    def makeImporter(self, **kwargs):
+        return TrackCsvImporter('track.yaml', 'track.csv', flight_name='csvImportTestFlight',
+                                track_name='csvImportTest', **kwargs)
+
+    def test_importTwiceStoresOnce(self):
+        track = positionIngest.TRACK_MODEL.get().objects.create(name='csvImportTest')
+        model = positionIngest.PAST_POSITION_MODEL.get()
+        start = datetime.datetime(2016, 1, 1)
+        rows = [dict(track_id=track.id, timestamp=start + datetime.timedelta(seconds=i),
+                     latitude=37.0, longitude=-122.0)
+                for i in xrange(4)]
+        importer = self.makeImporter()
+        # the base class gets the flags as given
+        self.assertEqual(self.baseArgs, (False, False))
+        self.assertEqual(importer.config['defaults']['track_id'], track.id)
+        importer.update_stored_data(model, rows[:3])
+        # a rerun that overlaps the stored rows
+        importer.update_stored_data(model, [dict(row, latitude=38.0) for row in rows[1:]])
+        self.assertEqual(model.objects.filter(track=track).count(), 4)
+        # stored rows are skipped, not overwritten
+        self.assertEqual(model.objects.get(track=track, timestamp=rows[1]['timestamp']).latitude, 37.0)
+
+        # forcing a reimport overwrites them
+        importer = self.makeImporter(force=True)
+        self.assertEqual(self.baseArgs, (True, False))
+        importer.update_stored_data(model, [dict(row, latitude=38.0) for row in rows[1:]])
+        self.assertEqual(model.objects.filter(track=track).count(), 4)
+        self.assertEqual(model.objects.get(track=track, timestamp=rows[1]['timestamp']).latitude, 38.0)
+
+
+class TestTrackInterpolation(SimpleTestCase):
+    def test_interpolateBetween(self):
+        start = datetime.datetime(2016, 1, 1)
+        track = positionIngest.TRACK_MODEL.get()(name='test')
+        pastModel = positionIngest.PAST_POSITION_MODEL.get()
+        positions = [pastModel(track=track, timestamp=start + datetime.timedelta(seconds=10 * i),
+                               latitude=37.0 + 1e-4 * i, longitude=-122.0)
+                     for i in xrange(3)]
+        times = [pos.timestamp for pos in positions]
+
+        queries = [start + datetime.timedelta(seconds=s) for s in (15, -1, 10, 21)]
+        results = [track.interpolateBetween(utcDt, positions, times) for utcDt in queries]
+        self.assertAlmostEqual(results[0].latitude, 37.00015)
+        self.assertEqual(results[0].timestamp, queries[0])
+        self.assertEqual(results[1], None)
+        self.assertAlmostEqual(results[2].latitude, 37.0001)
+        self.assertEqual(results[3], None)
+
+
+
+@override_settings(GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS=60, GEOCAM_TRACK_POSITION_CACHE_BYTES=0)
+class TestTrackInterpolatedPositions(TransactionTestCase):
+    def test_oneQueryPerRun(self):
+        track = positionIngest.TRACK_MODEL.get().objects.create(name='interpolatedPositionsTest')
+        model = positionIngest.PAST_POSITION_MODEL.get()
+        start = datetime.datetime(2016, 1, 1)
+        later = start + datetime.timedelta(1)
+        for t0 in (start, later):
+            for i in xrange(3):
+                model.objects.create(track=track, timestamp=t0 + datetime.timedelta(seconds=10 * i),
+                                     latitude=37.0 + 1e-4 * i, longitude=-122.0)
+        queries = [later + datetime.timedelta(seconds=5), start + datetime.timedelta(seconds=15),
+                   start + datetime.timedelta(seconds=5)]
+        # the day between the two runs is not read
+        with self.assertNumQueries(2):
+            results = track.getInterpolatedPositions(queries)
+        self.assertEqual([r.timestamp for r in results], queries)
+        self.assertAlmostEqual(results[0].latitude, 37.00005)
+        self.assertAlmostEqual(results[1].latitude, 37.00015)
+        self.assertEqual(results[2].track_id, track.id)
+
+
+class TestClosestPosition(SimpleTestCase):
+    def test_getCloser(self):
+        timestamp = datetime.datetime(2016, 1, 1, 0, 0, 10)
+        before = FakePosition(1, -122.0, 37.0, timestamp - datetime.timedelta(seconds=3))
+        after = FakePosition(1, -122.0, 37.0, timestamp + datetime.timedelta(seconds=2))
+        tie = FakePosition(1, -122.0, 37.0, timestamp + datetime.timedelta(seconds=3))
+        self.assertEqual(getCloser(timestamp, before, after), after)
+        self.assertEqual(getCloser(timestamp, before, tie), before)
+        self.assertEqual(getCloser(timestamp, None, after), after)
+        self.assertEqual(getCloser(timestamp, None, None), None)
+
+
+class TestTimeAlign(SimpleTestCase):
+    def test_mergeClosest(self):
+        rows = [('a', 10.0), ('b', 20.0), ('c', 100.0)]
+        self.assertEqual(mergeClosest([0.0, 9.0, 15.0, 16.0, 20.0, 60.0, 95.0, 200.0], rows, 6),
+                         [None, 'a', 'a', 'b', 'b', None, 'c', None])
+
+    def test_getTimeRuns(self):
+        self.assertEqual(getTimeRuns([0, 1, 2, 10, 11, 30], 5), [(0, 3), (3, 5), (5, 6)])
+        self.assertEqual(getTimeRuns([], 5), [])
+
+
+class TestPositionCache(SimpleTestCase):
+    def test_evictsLeastRecentlyUsed(self):
+        cache = positionCache.PositionCache(maxBytes=250)
+        cache.put('a', 1, 'A', 100)
+        cache.put('b', 1, 'B', 100)
+        self.assertEqual(cache.get('a', 1), 'A')
+        cache.put('c', 1, 'C', 100)
+        self.assertEqual(cache.get('b', 1), None)
+        self.assertEqual(cache.get('a', 1), 'A')
+        # a stale version is a miss
+        self.assertEqual(cache.get('c', 2), None)
+        self.assertEqual(cache.getStats()['bytes'], 100)
+
+    def test_micros(self):
+        dt = datetime.datetime(2016, 1, 1, 12, 0, 0, 123457)
+        self.assertEqual(positionCache.fromMicros(positionCache.toMicros(dt)), dt)
+        self.assertEqual(positionCache.toMicros(pytz.utc.localize(dt)), positionCache.toMicros(dt))
+
+    @override_settings(GEOCAM_TRACK_POSITION_CACHE_BYTES=1024)
+    def test_disabledWithoutSharedCache(self):
+        for backend, enabled in (('django.core.cache.backends.locmem.LocMemCache', False),
+                                 ('django.core.cache.backends.dummy.DummyCache', False),
+                                 ('django.core.cache.backends.memcached.MemcachedCache', True)):
+            with self.settings(CACHES={'default': {'BACKEND': backend}}):
+                self.assertEqual(positionCache.isEnabled(), enabled)
+
+
+class TestPositionRollup(SimpleTestCase):
+    def test_iterMinuteSummaries(self):
+        t0 = datetime.datetime(2016, 1, 1, 12, 0, 10)
+        rows = [(t0, 37.0, -122.0),
+                (t0 + datetime.timedelta(seconds=20), 37.2, -122.3),
+                (t0 + datetime.timedelta(seconds=40), 37.1, -122.1),
+                (t0 + datetime.timedelta(seconds=60), 38.0, -121.0)]
+        summaries = list(positionRollup.iterMinuteSummaries(rows))
+        self.assertEqual([minute for minute, _summary in summaries],
+                         [positionRollup.getMinuteMicros(datetime.datetime(2016, 1, 1, 12, 0)),
+                          positionRollup.getMinuteMicros(datetime.datetime(2016, 1, 1, 12, 1))])
+        first = summaries[0][1]
+        self.assertEqual(first['count'], 3)
+        self.assertEqual(first['firstTimestamp'], t0)
+        self.assertEqual(first['lastTimestamp'], rows[2][0])
+        self.assertEqual((first['minLatitude'], first['maxLatitude']), (37.0, 37.2))
+        self.assertEqual((first['minLongitude'], first['maxLongitude']), (-122.3, -122.0))
+        self.assertEqual((first['lastLatitude'], first['lastLongitude']), (37.1, -122.1))
+        self.assertEqual(summaries[1][1]['count'], 1)
+
+    def test_getMinuteMicros(self):
+        dt = datetime.datetime(2016, 1, 1, 12, 34, 56, 789)
+        self.assertEqual(positionRollup.getMinuteMicros(dt),
+                         positionCache.toMicros(datetime.datetime(2016, 1, 1, 12, 34)))
+
+
+class TestPositionRollupDays(TransactionTestCase):
+    def test_dayExcludesNextMidnight(self):
+        track = positionIngest.TRACK_MODEL.get().objects.create(name='rollupDayTest')
+        day = datetime.datetime(2016, 1, 1)
+        nextDay = day + datetime.timedelta(1)
+        for minute, count in ((day + datetime.timedelta(hours=12), 3), (nextDay, 5)):
+            positionRollup.ROLLUP_MODEL.get().objects.create(
+                track=track, minute=minute, firstTimestamp=minute, lastTimestamp=minute, count=count,
+                minLatitude=37.0, maxLatitude=37.0, minLongitude=-122.0, maxLongitude=-122.0,
+                firstLatitude=37.0, firstLongitude=-122.0, lastLatitude=37.0, lastLongitude=-122.0)
+        # the rollup of the next day's first minute belongs to the next day
+        self.assertEqual(positionRollup.getPositionCount(day, nextDay), 3)
+        self.assertEqual(positionRollup.getPositionCount(nextDay, nextDay + datetime.timedelta(1)), 5)
+        self.assertEqual(positionRollup.getTrackIds(day - datetime.timedelta(1), day), set())
+        self.assertEqual(positionRollup.getTrackIds(day, nextDay), set([track.id]))
+
+
+@override_settings(GEOCAM_TRACK_SPATIAL_CELL_DEGREES=1.0)
+class TestSpatialIndex(SimpleTestCase):
+    def test_getCell(self):
+        self.assertEqual(spatialIndex.getGridSize(), (180, 360))
+        self.assertEqual(spatialIndex.getCell(-90, -180), 0)
+        self.assertEqual(spatialIndex.getCell(37.5, -122.5), 127 * 360 + 57)
+        # the north pole and the antimeridian fall in the last row and column
+        self.assertEqual(spatialIndex.getCell(90, 180), 180 * 360 - 1)
+        self.assertEqual(spatialIndex.getCell(None, 10), None)
+
+    def test_getCellRanges(self):
+        self.assertEqual(spatialIndex.getCellRanges(-122.5, 37.2, -121.5, 38.5),
+                         [(127 * 360 + 57, 127 * 360 + 58), (128 * 360 + 57, 128 * 360 + 58)])
+        # a box across the antimeridian covers both ends of each row
+        self.assertEqual(spatialIndex.getCellRanges(179.5, 0.5, -179.5, 0.5),
+                         [(90 * 360 + 359, 90 * 360 + 359), (90 * 360, 90 * 360)])
+
+    def test_getTimeSpans(self):
+        t0 = datetime.datetime(2016, 1, 1, 12, 0, 0)
+        rows = [(1, t0),
+                (1, t0 + datetime.timedelta(seconds=30)),
+                (1, t0 + datetime.timedelta(seconds=600)),
+                (2, t0 + datetime.timedelta(seconds=10))]
+        spans = spatialIndex.getTimeSpans(rows, 60)
+        self.assertEqual([(span['track'], span['start'], span['end'], span['count']) for span in spans],
+                         [(1, t0, t0 + datetime.timedelta(seconds=30), 2),
+                          (1, t0 + datetime.timedelta(seconds=600), t0 + datetime.timedelta(seconds=600), 1),
+                          (2, t0 + datetime.timedelta(seconds=10), t0 + datetime.timedelta(seconds=10), 1)])
+
+
+class TestTrackSpans(TransactionTestCase):
+    def test_sameNamedTracks(self):
+        trackModel = positionIngest.TRACK_MODEL.get()
+        model = positionIngest.PAST_POSITION_MODEL.get()
+        tracks = [trackModel.objects.create(name='GPX track 1') for _ in xrange(2)]
+        t0 = datetime.datetime(2016, 1, 1, 12, 0, 0)
+        for i in xrange(4):
+            model.objects.create(track=tracks[i % 2], timestamp=t0 + datetime.timedelta(seconds=10 * i),
+                                 latitude=37.5, longitude=-122.5)
+        spans = spatialIndex.findTrackSpans(-123, 37, -122, 38, t0, t0 + datetime.timedelta(1))
+        # positions of tracks with the same name are not interleaved
+        self.assertEqual(sorted((span['track'], span['count']) for span in spans),
+                         [(tracks[0].id, 2), (tracks[1].id, 2)])
+
+
+class TestProximityIndex(SimpleTestCase):
+    def setUp(self):
+        self.index = proximity.ProximityIndex(cellMeters=100, thresholdMeters=50)
+        self.events = []
+        proximity.proximityChanged.connect(self.recordEvent)
+
+    def tearDown(self):
+        proximity.proximityChanged.disconnect(self.recordEvent)
+
+    def recordEvent(self, sender, trackIds, distance, close, **kwargs):
+        self.events.append((trackIds, close))
+
+    def test_queries(self):
+        t = datetime.datetime(2016, 1, 1)
+        metersPerDegree = proximity.METERS_PER_DEGREE
+        self.index.update(1, 'a', 0.0, 0.0, t)
+        self.index.update(2, 'b', 30.0 / metersPerDegree, 0.0, t)
+        self.index.update(3, 'c', 0.0, 1000.0 / metersPerDegree, t)
+        self.index.update(4, 'd', 0.0, 179.9999, t)
+        self.assertEqual([trackId for _d, trackId, _p in self.index.queryRadius(0.0, 0.0, 100)], [1, 2])
+        self.assertEqual([trackId for _d, trackId, _p in self.index.queryNearest(0.0, 0.0, 3)], [1, 2, 3])
+        self.assertEqual([(a, b) for _d, a, b in self.index.getClosePairs(50)], [(1, 2)])
+        # neighbors across the antimeridian
+        self.assertEqual([trackId for _d, trackId, _p in self.index.queryRadius(0.0, -179.9999, 100)], [4])
+
+    def test_thresholdEvents(self):
+        t = datetime.datetime(2016, 1, 1)
+        metersPerDegree = proximity.METERS_PER_DEGREE
+        self.index.update(1, 'a', 0.0, 0.0, t)
+        self.index.update(2, 'b', 0.0, 200.0 / metersPerDegree, t)
+        self.assertEqual(self.events, [])
+        self.index.update(2, 'b', 0.0, 40.0 / metersPerDegree, t)
+        self.assertEqual(self.events, [((2, 1), True)])
+        self.index.update(1, 'a', 0.0, -100.0 / metersPerDegree, t)
+        self.assertEqual(self.events, [((2, 1), True), ((1, 2), False)])
+
+    def test_updateWithoutNotify(self):
+        t = datetime.datetime(2016, 1, 1)
+        metersPerDegree = proximity.METERS_PER_DEGREE
+        self.index.update(1, 'a', 0.0, 0.0, t)
+        # as refresh() does: pairs are tracked, but only the saving process reports them
+        self.index.update(2, 'b', 0.0, 40.0 / metersPerDegree, t, notify=False)
+        self.assertEqual(self.events, [])
+        self.index.update(2, 'b', 0.0, 200.0 / metersPerDegree, t)
+        self.assertEqual(self.events, [((2, 1), False)])
+
+
+class TestPositionQueue(SimpleTestCase):
+    def test_putManyIsAllOrNone(self):
+        queue = positionQueue.PositionQueue(maxDepth=3, batchSize=10, flushSeconds=1, putTimeoutSeconds=0)
+        queue.putMany(None, [{}, {}])
+        self.assertEqual(queue.getDepth(), 2)
+        # no room for both, so neither is queued
+        self.assertRaises(positionQueue.QueueFullError, queue.putMany, None, [{}, {}])
+        self.assertEqual(queue.getDepth(), 2)
+        queue.put(None, {})
+        self.assertEqual(queue.getDepth(), 3)
+
+
+class TestKmlStream(SimpleTestCase):
+    def test_drainBuffer(self):
+        buf = StringIO()
+        buf.write('abc')
+        self.assertEqual(kmlStream.drainBuffer(buf), 'abc')
+        buf.write('d')
+        self.assertEqual(kmlStream.drainBuffer(buf), 'd')
+
+    def test_iterTee(self):
+        stored = []
+        self.assertEqual(list(kmlStream.iterTee(iter(['ab', 'cd']), stored.append, 10)), ['ab', 'cd'])
+        self.assertEqual(stored, ['abcd'])
+        # too large to keep
+        self.assertEqual(list(kmlStream.iterTee(iter(['ab', 'cd']), stored.append, 3)), ['ab', 'cd'])
+        self.assertEqual(stored, ['abcd'])
+        # not sent in full
+        tee = kmlStream.iterTee(iter(['ab', 'cd']), stored.append, 10)
+        next(tee)
+        tee.close()
+        self.assertEqual(stored, ['abcd'])
+
+    def test_iterKmz(self):
+        text = ''.join('%.6f,%.6f,0\n' % (0.001 * i, 0.002 * i) for i in xrange(10000))
+        chunks = [text[i:i + 4096] for i in xrange(0, len(text), 4096)]
+        kmz = zipfile.ZipFile(StringIO(''.join(kmlStream.iterKmz(chunks))))
+        self.assertEqual(kmz.namelist(), [kmlStream.KMZ_DOC_NAME])
+        self.assertEqual(kmz.testzip(), None)
+        self.assertEqual(kmz.read(kmlStream.KMZ_DOC_NAME), text)
+
+
+class TestTrackKmlRows(SimpleTestCase):
+    def test_formatCoordinatesKml(self):
+        lonLat = np.array([(-122.0, 37.0), (-122.1234567, 37.5)])
+        self.assertEqual(models.formatCoordinatesKml(lonLat),
+                         '-122.000000,37.000000,0\n-122.123457,37.500000,0\n')
+
+    def test_getLineBreaks(self):
+        metersPerDegree = proximity.METERS_PER_DEGREE
+        lonLat = np.array([(0.0, 0.0), (0.0, 10.0 / metersPerDegree), (0.0, 500.0 / metersPerDegree)])
+        self.assertEqual(models.getLineBreaks(None, lonLat, 100), [2])
+        # the last coordinate of the previous chunk counts too
+        self.assertEqual(models.getLineBreaks(np.array([0.0, -1.0]), lonLat, 100), [0, 2])
+
+
+class TestKmlBlocks(SimpleTestCase):
+    def test_renderFragment(self):
+        metersPerDegree = proximity.METERS_PER_DEGREE
+        lonLat = np.array([(0.0, 0.0), (0.0, 10.0), (0.0, 500.0)]) / metersPerDegree
+        fragment = kmlBlocks.renderFragment(lonLat, 100)
+        self.assertEqual(fragment['count'], 3)
+        self.assertEqual(fragment['text'],
+                         models.formatCoordinatesKml(lonLat[:2]) + models.KML_LINE_BREAK +
+                         models.formatCoordinatesKml(lonLat[2:]))
+        self.assertEqual(kmlBlocks.renderFragment(lonLat[:0], 100)['count'], 0)
+
+    def test_iterFragmentText(self):
+        metersPerDegree = proximity.METERS_PER_DEGREE
+        lonLat = np.array([(0.0, 0.0), (0.0, 10.0), (0.0, 20.0), (0.0, 500.0)]) / metersPerDegree
+        fragments = [kmlBlocks.renderFragment(lonLat[:2], 100),
+                     kmlBlocks.EMPTY_FRAGMENT,
+                     kmlBlocks.renderFragment(lonLat[2:3], 100),
+                     kmlBlocks.renderFragment(lonLat[3:], 100)]
+        # the same text as rendering all positions at once
+        self.assertEqual(''.join(kmlBlocks.iterFragmentText(fragments, 100)),
+                         kmlBlocks.renderFragment(lonLat, 100)['text'])
+
+
+class TestSimplify(SimpleTestCase):
+    def test_simplifyLine(self):
+        metersPerDegree = proximity.METERS_PER_DEGREE
+        # a straight line with a 5 m wiggle and a 100 m corner
+        lonLat = np.array([(0.0, 0.0), (100.0, 5.0), (200.0, 0.0), (300.0, 0.0), (300.0, 100.0)]) / metersPerDegree
+        self.assertEqual(simplify.simplifyLine(lonLat, 10).tolist(), [0, 3, 4])
+        self.assertEqual(simplify.simplifyLine(lonLat, 1).tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(simplify.simplifyLine(lonLat[:2], 10).tolist(), [0, 1])
+
+    def test_simplifyTrack(self):
+        metersPerDegree = proximity.METERS_PER_DEGREE
+        t0 = datetime.datetime(2016, 1, 1)
+        times = [t0 + datetime.timedelta(seconds=i) for i in xrange(5)]
+        # the jump to the fourth position starts a new segment
+        values = np.array([(0.0, 0.0, np.nan), (1.0, 0.0, 2.0), (2.0, 0.0, 3.0),
+                           (1000.0, 0.0, 4.0), (1001.0, 0.0, 5.0)])
+        values[:, :2] /= metersPerDegree
+        segments = simplify.simplifyTrack(times, values, ['longitude', 'latitude', 'altitude'], 1, 100)
+        self.assertEqual([segmentTimes for segmentTimes, _rows in segments],
+                         [[times[0], times[2]], [times[3], times[4]]])
+        self.assertEqual(segments[0][1][0][2], None)
+        self.assertEqual(segments[1][1][1][2], 5.0)
+
+
+class TestOrientation(SimpleTestCase):
+    def test_interpolateAngles(self):
+        result = orientation.interpolateAngles(np.array([0.0, 0.5, 0.25]),
+                                               np.array([350.0, 350.0, 10.0]),
+                                               np.array([10.0, 10.0, 350.0]),
+                                               units='degrees')
+        np.testing.assert_allclose(result, [350.0, 0.0, 5.0], atol=1e-9)
+
+    def test_interpolateYpr(self):
+        w = np.array([0.5, 0.5])
+        before = dict(yaw=np.array([350.0, 0.0]), pitch=np.array([0.0, 10.0]), roll=np.array([0.0, 0.0]))
+        after = dict(yaw=np.array([10.0, 0.0]), pitch=np.array([0.0, 50.0]), roll=np.array([0.0, 0.0]))
+        yaw, pitch, roll = orientation.interpolateYpr(w, before, after, units='degrees')
+        # a pure yaw turn follows the shorter arc
+        self.assertAlmostEqual(min(yaw[0], 360 - yaw[0]), 0.0, places=6)
+        self.assertAlmostEqual(pitch[0], 0.0, places=6)
+        # so does a pure pitch turn
+        self.assertAlmostEqual(pitch[1], 30.0, places=6)
+        self.assertAlmostEqual(roll[1], 0.0, places=6)
+
+    def test_quaternionRoundTrip(self):
+        yaw, pitch, roll = np.array([0.5, 3.0]), np.array([0.2, -1.0]), np.array([-0.3, 2.5])
+        result = orientation.quaternionsToYpr(orientation.yprToQuaternions(yaw, pitch, roll))
+        np.testing.assert_allclose(result, [yaw, pitch, roll], atol=1e-9)
+
+    def test_interpolateFieldsKeepsEnds(self):
+        before = dict(yaw=np.array([-0.1]), pitch=np.array([0.2]), roll=np.array([0.3]), altitude=np.array([5.0]))
+        after = dict(yaw=np.array([0.1]), pitch=np.array([0.2]), roll=np.array([0.3]), altitude=np.array([7.0]))
+        result = orientation.interpolateFields(np.array([0.0]), before, after, units='radians')
+        self.assertEqual(result['yaw'][0], -0.1)
+        self.assertEqual(result['altitude'][0], 5.0)
+
+    def test_interpolateFieldsSignedPitchRoll(self):
+        # roll is missing, so pitch is interpolated on its own
+        before = dict(yaw=np.array([0.1]), pitch=np.array([-0.2]), roll=np.array([np.nan]))
+        after = dict(yaw=np.array([6.2]), pitch=np.array([-0.4]), roll=np.array([np.nan]))
+        result = orientation.interpolateFields(np.array([0.5]), before, after, units='radians')
+        self.assertAlmostEqual(result['pitch'][0], -0.3)
+        # yaw crosses zero the short way and stays in [0, 2 pi)
+        self.assertAlmostEqual(result['yaw'][0], np.mod(0.1 + 0.5 * (6.2 - 2 * np.pi - 0.1), 2 * np.pi))
+        self.assert_(np.isnan(result['roll'][0]))
@@ -0,0 +1,229 @@
+# __BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+# __END_LICENSE__
+
+"""
+Match many timestamps to positions in one pass.
+
+Looking positions up one timestamp at a time costs a query or two per
+timestamp.  When the timestamps are sorted, they can instead be merged
+against positions streamed in timestamp order, the way a merge join
+works: both sides are read once, and each timestamp is matched to the
+closest position next to it in the stream.
+
+backfillTrackedAssetPositions() uses this to fill in the position of
+every AbstractTrackedAsset of a model that has not been looked up yet,
+and alignRecords() does the same for any records with a track
+(TrackMixin) and a time field: an as-of join of the records against the
+positions of their tracks.
+"""
+
+import datetime
+import itertools
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from geocamUtil.loader import LazyGetModelByName
+
+from geocamTrack.arrayMath import datetimeToEpoch
+from geocamTrack.fastPosition import ArrayFastPosition
+from geocamTrack.trackUtil import bulk_update_rows
+
+PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
+
+
+def epochToDatetime(epoch):
+    """ Naive UTC datetime for epoch seconds """
+    return datetime.datetime.utcfromtimestamp(epoch)
+
+
+def mergeClosest(times, rows, maxSeconds):
+    """
+    Sorted-merge closest match.
+    :param times: epoch seconds, in increasing order
+    :param rows: iterable of (key, epoch seconds) in increasing time order
+    :param maxSeconds: the largest time difference that counts as a match
+    :return: for each time, the key of the closest row within maxSeconds or None.  The earlier row wins a tie.
+    """
+    result = []
+    rows = iter(rows)
+    before = None
+    after = next(rows, None)
+    for t in times:
+        # advance so before is the last row at or before t and after the first row after it
+        while after is not None and after[1] <= t:
+            before = after
+            after = next(rows, None)
+        best = None
+        if before is not None and t - before[1] <= maxSeconds:
+            best = before
+        if after is not None and after[1] - t <= maxSeconds:
+            if best is None or after[1] - t < t - best[1]:
+                best = after
+        result.append(best[0] if best is not None else None)
+    return result
+
+
+def getTimeRuns(times, gapSeconds):
+    """
+    Split sorted times into (start, end) index ranges, breaking wherever
+    consecutive times are more than gapSeconds apart.
+    """
+    runs = []
+    start = 0
+    for i in xrange(1, len(times) + 1):
+        if i == len(times) or times[i] - times[i - 1] > gapSeconds:
+            runs.append((start, i))
+            start = i
+    return runs
+
+
+def findClosestPositions(times, maxSeconds, positions=None):
+    """
+    Closest past position pk for each of a sorted list of epoch times.
+    Positions are streamed in timestamp order, one query per run of
+    times, so long gaps between the times are never read.
+    """
+    if positions is None:
+        positions = PAST_POSITION_MODEL.get().objects.all()
+    result = []
+    for start, end in getTimeRuns(times, 2 * maxSeconds):
+        run = times[start:end]
+        rows = (positions
+                .filter(timestamp__gte=epochToDatetime(run[0] - maxSeconds),
+                        timestamp__lte=epochToDatetime(run[-1] + maxSeconds))
+                .order_by('timestamp')
+                .values_list('pk', 'timestamp'))
+        result.extend(mergeClosest(run, ((pk, datetimeToEpoch(t)) for pk, t in rows.iterator()), maxSeconds))
+    return result
+
+
+def backfillTrackedAssetPositions(model, chunkSize=None, maxSeconds=None, progress=None):
+    """
+    Look up the position of every asset of an AbstractTrackedAsset model
+    that has not been looked up yet, with the same result as calling
+    getPosition() on each of them, except that assets without an event
+    time are marked as not found too, so they are not read again on the
+    next run.  Assets are read in chunks of
+    chunkSize in primary key order; each chunk is sorted by event time,
+    merged against the positions, and written with one bulk update, in
+    its own transaction.  Since only unresolved assets are read, an
+    interrupted backfill picks up where it left off when run again.
+    progress, if given, is called as progress(assetCount, seconds) after
+    each chunk.  Returns the number of assets resolved.
+    """
+    if chunkSize is None:
+        chunkSize = settings.GEOCAM_TRACK_INGEST_BATCH_SIZE
+    if maxSeconds is None:
+        maxSeconds = settings.GEOCAM_TRACK_CLOSEST_POSITION_MAX_DIFFERENCE_SECONDS
+    unresolved = (model.objects
+                  .filter(position__isnull=True, position_not_found__isnull=True)
+                  .order_by('pk'))
+
+    startTime = time.time()
+    count = 0
+    lastPk = None
+    while True:
+        query = unresolved
+        if lastPk is not None:
+            query = query.filter(pk__gt=lastPk)
+        assets = list(query[:chunkSize])
+        if not assets:
+            break
+        lastPk = assets[-1].pk
+
+        timed = []
+        valuesByPk = {}
+        for asset in assets:
+            eventTime = asset.getEventTime()
+            if eventTime:
+                timed.append((datetimeToEpoch(eventTime), asset.pk))
+            else:
+                # nothing to look up, now or on a later run
+                valuesByPk[asset.pk] = dict(position_id=None, position_not_found=True)
+        timed.sort()
+        positionPks = findClosestPositions([t for t, _pk in timed], maxSeconds)
+
+        for (_t, assetPk), positionPk in zip(timed, positionPks):
+            valuesByPk[assetPk] = dict(position_id=positionPk,
+                                       position_not_found=positionPk is None)
+        with transaction.atomic():
+            bulk_update_rows(model, valuesByPk)
+
+        count += len(valuesByPk)
+        if progress:
+            progress(count, time.time() - startTime)
+        else:
+            logging.info('resolved %d positions in %.1f seconds', count, time.time() - startTime)
+    return count
+
+
+ALIGN_MODES = ('nearest', 'interpolated')
+
+
+def alignBatch(track, records, times, timeField, mode, maxSeconds):
+    """ Positions for records of one track, sorted by their epoch times """
+    model = PAST_POSITION_MODEL.get()
+    if mode == 'nearest':
+        pks = findClosestPositions(times, maxSeconds, model.objects.filter(track_id=track.pk))
+        found = model.objects.in_bulk([pk for pk in pks if pk is not None])
+        return [found.get(pk) for pk in pks]
+
+    result = []
+    interpolateSeconds = settings.GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS
+    for start, end in getTimeRuns(times, 2 * interpolateSeconds):
+        utcDts = [getattr(record, timeField) for record in records[start:end]]
+        window = ArrayFastPosition(track, start=epochToDatetime(times[start]), end=epochToDatetime(times[end - 1]))
+        result.extend(window.getInterpolatedPositionList(utcDts))
+    return result
+
+
+def alignRecords(records, timeField, mode='nearest', maxSeconds=None, batchSize=None):
+    """
+    As-of join of records against the positions of their tracks.
+    :param records: queryset of a model with a track (TrackMixin)
+    :param timeField: name of the records' datetime field
+    :param mode: 'nearest' for the closest stored position within
+      maxSeconds (default GEOCAM_TRACK_CLOSEST_POSITION_MAX_DIFFERENCE_SECONDS),
+      or 'interpolated' for a position interpolated within
+      GEOCAM_TRACK_INTERPOLATE_MAX_SECONDS and GEOCAM_TRACK_INTERPOLATE_MAX_METERS
+    :return: generator of (record, position or None), grouped by track and
+      in time order within each track.  Records are streamed in batches of
+      batchSize, and each batch is merged against its track's positions in
+      one ordered pass per run of nearby times, so a track with N records
+      and K positions costs O(N + K).
+    """
+    if mode not in ALIGN_MODES:
+        raise ValueError('mode must be one of %s' % ', '.join(ALIGN_MODES))
+    if maxSeconds is None:
+        maxSeconds = settings.GEOCAM_TRACK_CLOSEST_POSITION_MAX_DIFFERENCE_SECONDS
+    if batchSize is None:
+        batchSize = settings.GEOCAM_TRACK_INGEST_BATCH_SIZE
+
+    # order by track id: ordering by track sorts by its name, which interleaves same-named tracks
+    records = (records
+               .select_related('track')
+               .order_by('track_id', timeField)
+               .iterator())
+    for trackId, group in itertools.groupby(records, lambda record: record.track_id):
+        while True:
+            batch = list(itertools.islice(group, batchSize))
+            if not batch:
+                break
+            timed = [record for record in batch if getattr(record, timeField) is not None]
+            if trackId is None or not timed:
+                for record in batch:
+                    yield record, None
+                continue
+            for record in batch:
+                if getattr(record, timeField) is None:
+                    yield record, None
+            times = [datetimeToEpoch(getattr(record, timeField)) for record in timed]
+            positions = alignBatch(timed[0].track, timed, times, timeField, mode, maxSeconds)
+            for record, position in zip(timed, positions):
+                yield record, position
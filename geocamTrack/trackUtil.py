@@ -7,6 +7,7 @@
 from uuid import uuid4
 
 from django.db import connection
+from django.db.models import Case, When, Value, F
 
 from geocamUtil.loader import LazyGetModelByName
 from django.conf import settings
@@ -20,6 +21,9 @@ LINE_STYLE_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_LINE_STYLE_MODEL)
 
 
 def getDatesWithPositionData():
+    if settings.GEOCAM_TRACK_POSITION_ROLLUP:
+        from geocamTrack.positionRollup import getDates
+        return getDates()
     try:
         cursor = connection.cursor()
         cursor.execute("SELECT DISTINCT DATE(CONVERT_TZ(timestamp, 'UTC', '%s')) FROM %s"
@@ -63,24 +67,22 @@ def get_icon_style(name):
     return icon_style
 
 
-def get_next_available_track_name(prefix, vehicle_name):
+def get_next_available_track_name(prefix, vehicle_name=None):
     """
-    Get the next available track name.  Right now the pattern
+    Get the next available track name.  Right now the pattern is prefix + letter + _vehicle_name,
+    ie 20160101A_Robot.  Existing names are read with one query rather than probed one at a time.
     :param prefix: the beginning of the track name.
-    :return:
+    :param vehicle_name: the name of the vehicle, can be None
+    :return: the first name in the pattern that is not taken
     """
+    suffix = ''
+    if vehicle_name:
+        suffix = '_' + vehicle_name
+    taken = set(TRACK_MODEL.get().objects.filter(name__startswith=prefix).values_list('name', flat=True))
     character = 'A'
-    tModel = TRACK_MODEL.get()
-    while True:
-        try:
-            name = prefix + character
-            if vehicle_name:
-                name = name + '_' + vehicle_name
-            tModel.objects.get(name)
-            character = getNextAlphabet(character)
-        except:
-            return prefix + character
-    return prefix + character  # should never happen
+    while prefix + character + suffix in taken:
+        character = getNextAlphabet(character)
+    return prefix + character + suffix
 
 
 def get_or_create_track(name, vehicle, flight=None, parameters={}, extras=''):
@@ -111,3 +113,24 @@ def get_or_create_track(name, vehicle, flight=None, parameters={}, extras=''):
     return track
 
 
+def bulk_update_rows(model, values_by_pk):
+    """
+    Update many rows with a single UPDATE statement, using a CASE on the primary key for each field.
+    :param model: the model class
+    :param values_by_pk: dictionary of primary key to a dictionary of field values for that row
+    :return: the number of rows updated
+    """
+    if not values_by_pk:
+        return 0
+    field_names = set()
+    for values in values_by_pk.itervalues():
+        field_names.update(values.iterkeys())
+
+    updates = {}
+    for name in field_names:
+        field = model._meta.get_field(name)
+        whens = [When(pk=pk, then=Value(values[name], output_field=field))
+                 for pk, values in values_by_pk.iteritems()
+                 if name in values]
+        updates[name] = Case(*whens, default=F(name), output_field=field)
+    return model.objects.filter(pk__in=values_by_pk.keys()).update(**updates)
@@ -11,6 +11,11 @@ from django.conf import settings
 
 urlpatterns = [url(r'^$', views.getIndex,{}, 'geocamTrack_index'),
                url(r'^post/$', views.postPosition,{'challenge': 'basic' }),
+               url(r'^post/batch/$', views.postPositions, {'challenge': 'basic'}, 'geocamTrack_postPositions'),
+               url(r'^ingest/status.json$', views.getIngestStatusJson, {}, 'geocamTrack_ingestStatus'),
+               url(r'^positions/bbox.json$', views.getTracksInBboxJson, {}, 'geocamTrack_tracksInBbox'),
+               url(r'^proximity.json$', views.getProximityJson, {}, 'geocamTrack_proximity'),
+               url(r'^align/(?P<appLabel>\w+)/(?P<modelName>\w+).csv$', views.getAlignedPositionsCsv, {}, 'geocamTrack_alignedPositionsCsv'),
                url(r'^csvTrackIndex/$', views.getCsvTrackIndex,{},'geocamTrack_csvTrackIndex'),
                url(r'^track/csv/(?P<trackName>[\w-]+)$', views.getTrackCsv,{},'geocamTrack_trackCsv_byname'),
                url(r'importTrack/$', views.importTrack, {}, 'geocamTrack_importTrack'),
@@ -4,7 +4,7 @@
 # All rights reserved.
 # __END_LICENSE__
 
-import math
+import bisect
 import datetime
 
 from django.core.exceptions import ObjectDoesNotExist
@@ -12,73 +12,119 @@ from django.conf import settings
 
 from geocamUtil.loader import LazyGetModelByName
 
+from geocamTrack import positionCache
+
 TRACK_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_TRACK_MODEL)
 PAST_POSITION_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_PAST_POSITION_MODEL)
 ICON_STYLE_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_ICON_STYLE_MODEL)
 LINE_STYLE_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_LINE_STYLE_MODEL)
 
 
+def getPositionQuerySet(track=None, vehicle=None):
+    """
+    Past positions for the track if given, otherwise for the vehicle if given, otherwise all of them.
+    """
+    positions = PAST_POSITION_MODEL.get().objects.all()
+    if track:
+        positions = positions.filter(track=track)
+    elif vehicle:
+        positions = positions.filter(track__vehicle=vehicle)
+    return positions
+
+
+def getCloser(timestamp, before, after):
+    """ Return whichever of before and after (either can be None) has a timestamp closer to timestamp """
+    if before is None or after is None:
+        return before or after
+    if after.timestamp - timestamp < timestamp - before.timestamp:
+        return after
+    return before
+
+
 def getClosestPosition(track=None, timestamp=None, max_time_difference_seconds=settings.GEOCAM_TRACK_CLOSEST_POSITION_MAX_DIFFERENCE_SECONDS, vehicle=None):
     """
     Look up the closest location, with a 1 minute default maximum difference.
     Track is optional but it will be a more efficient query if you limit it by track
     also if you have multiple tracks at the same time from different vehicles, you really need to pass in a track.
+    Runs at most two LIMIT 1 queries, for the closest positions at or before and after the timestamp.
     TODO this will not work for GenericTrack
     """
     if not timestamp:
         return None
-    foundPosition = None
+    positions = getPositionQuerySet(track, vehicle)
+    maxDelta = datetime.timedelta(seconds=max_time_difference_seconds)
 
-    try:
-        if not track:
-            foundPositions = PAST_POSITION_MODEL.get().objects.filter(timestamp=timestamp)
-        elif vehicle:
-            foundPositions = PAST_POSITION_MODEL.get().objects.filter(track__vehicle=vehicle, timestamp=timestamp)
-        else:
-            foundPositions = PAST_POSITION_MODEL.get().objects.filter(track=track, timestamp=timestamp)
-        # take the first one.
-        if foundPositions:
-            foundPosition = foundPositions[0]
-    except ObjectDoesNotExist:
-        pass
-
-    if not foundPosition:
-        tablename = PAST_POSITION_MODEL.get()._meta.db_table
-        query = "select * from " + tablename + ' pos'
-        operand = ' where'
-        if track:
-            query = query + " where " + "track_id = '" + str(track.pk) + "'"
-            operand = ' and'
-        elif vehicle:
-            query = query + ", " + TRACK_MODEL.get()._meta.db_table + " track"
-            query = query + " where"
-#             query = query + " pos.track_id is not null and"
-            query = query + " pos.track_id=track." + TRACK_MODEL.get()._meta.pk.name
-            query = query + " and track.vehicle_id = '" + str(vehicle.pk) + "'"
-            operand = ' and'
-            
-        # limit time to range
-        mintime = timestamp - datetime.timedelta(seconds=max_time_difference_seconds)
-        maxtime = timestamp + datetime.timedelta(seconds=max_time_difference_seconds)
-        query = query + operand + " pos.timestamp >= '" + mintime.strftime('%Y-%m-%d %H:%M:%S') + "' and pos.timestamp <= '" + maxtime.strftime('%Y-%m-%d %H:%M:%S') + "'"
-        query = query + " order by abs(timestampdiff(second, '" + timestamp.strftime('%Y-%m-%d %H:%M:%S') + "', timestamp)) limit 1;"
-        #print query
-        posAtTime = PAST_POSITION_MODEL.get().objects.raw(query)
-        posList = list(posAtTime)
-        if posList:
-            foundPosition = posAtTime[0]
-            if foundPosition and foundPosition.timestamp:
-                if (foundPosition.timestamp > timestamp):
-                    delta = (foundPosition.timestamp - timestamp)
-                else:
-                    delta = (timestamp - foundPosition.timestamp)
-                if math.fabs(delta.total_seconds()) > max_time_difference_seconds:
-                    foundPosition = None
-            else:
-                foundPosition = None
+    if track and positionCache.isEnabled():
+        # find the closest one in the shared position cache and load just that row
+        reader = positionCache.TrackPositionReader(track)
+        closest = getCloser(timestamp, *reader.getBracketingPositions(timestamp, max_time_difference_seconds))
+        if closest is None:
+            return None
+        return positions.filter(pk=closest.pk).first()
+
+    before = (positions
+              .filter(timestamp__lte=timestamp, timestamp__gte=timestamp - maxDelta)
+              .order_by('-timestamp')
+              .first())
+    if before and before.timestamp == timestamp:
+        return before
+    after = (positions
+             .filter(timestamp__gt=timestamp, timestamp__lte=timestamp + maxDelta)
+             .order_by('timestamp')
+             .first())
+    return getCloser(timestamp, before, after)
+
+
+def getClosestPositions(requests, max_time_difference_seconds=settings.GEOCAM_TRACK_CLOSEST_POSITION_MAX_DIFFERENCE_SECONDS):
+    """
+    Batch version of getClosestPosition.
+    :param requests: list of (track or vehicle or None, timestamp) pairs
+    :param max_time_difference_seconds: the maximum difference between a timestamp and its position
+    :return: the closest position or None for each pair, in the same order
+    Pairs are grouped by track or vehicle, and the timestamps of each group into runs that are no more than
+    two maximum differences apart.  Each run costs one query for the (pk, timestamp) of the positions in its
+    time range, and one more query loads all the positions found.
+    """
+    trackModel = TRACK_MODEL.get()
+    maxDelta = datetime.timedelta(seconds=max_time_difference_seconds)
+
+    groups = {}
+    for index, (key, timestamp) in enumerate(requests):
+        if timestamp:
+            groups.setdefault(key, []).append((timestamp, index))
+
+    found = [None] * len(requests)
+    for key, items in groups.iteritems():
+        if isinstance(key, trackModel):
+            positions = getPositionQuerySet(track=key)
         else:
-            foundPosition = None
-    return foundPosition
+            positions = getPositionQuerySet(vehicle=key)
+        items.sort()
+
+        runStart = 0
+        for i in xrange(1, len(items) + 1):
+            if i < len(items) and items[i][0] - items[i - 1][0] <= 2 * maxDelta:
+                continue
+            run = items[runStart:i]
+            runStart = i
+            rows = list(positions
+                        .filter(timestamp__gte=run[0][0] - maxDelta, timestamp__lte=run[-1][0] + maxDelta)
+                        .order_by('timestamp')
+                        .values_list('pk', 'timestamp'))
+            times = [t for _pk, t in rows]
+            for timestamp, index in run:
+                after = bisect.bisect_left(times, timestamp)
+                # the position at or before the timestamp wins a tie, as in getClosestPosition
+                if after < len(rows) and times[after] == timestamp:
+                    after += 1
+                candidates = [(abs((times[j] - timestamp).total_seconds()), j, rows[j][0])
+                              for j in (after - 1, after) if 0 <= j < len(rows)]
+                candidates = [c for c in candidates if c[0] <= max_time_difference_seconds]
+                if candidates:
+                    found[index] = min(candidates)[2]
+
+    byPk = PAST_POSITION_MODEL.get().objects.in_bulk([pk for pk in found if pk is not None])
+    return [byPk.get(pk) for pk in found]
 
 
 def get_or_create_track(track_name, vehicle=None, flight=None):
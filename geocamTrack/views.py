@@ -4,25 +4,25 @@
 # All rights reserved.
 # __END_LICENSE__
 from StringIO import StringIO
+import csv
+import itertools
 import json
 import datetime
 import time
 import calendar
 import urllib
 import math
-import xml.etree.cElementTree as et
-from dateutil.parser import parse as dateparser
 
-from django.views.decorators.cache import cache_page
-from django.http import HttpResponse, HttpResponseNotAllowed, Http404, HttpResponseBadRequest, JsonResponse
+from django.http import HttpResponse, HttpResponseNotAllowed, Http404, HttpResponseBadRequest, JsonResponse, \
+    StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.template import RequestContext
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.apps import apps
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.core.urlresolvers import reverse
 import pytz
-import iso8601
 
 from geocamUtil.TimeUtil import utcToTimeZone, timeZoneToUtc
 from geocamUtil import geomath
@@ -31,11 +31,16 @@ from geocamUtil.modelJson import modelsToJson, modelToJson
 from geocamUtil.datetimeJsonEncoder import DatetimeJsonEncoder
 from geocamUtil.KmlUtil import wrapKmlDjango, djangoResponse, wrapKml, buildNetworkLink
 from geocamUtil.loader import getClassByName
-from forms import ImportTrackForm
+from forms import ImportTrackForm, PositionBboxForm
 
-from geocamTrack.models import ResourcePosition, PastResourcePosition, Centroid, HeadingMixin
+from geocamTrack.models import Centroid, HeadingMixin, TrackMixin
 import geocamTrack.models
 from geocamTrack.avatar import renderAvatar
+from geocamTrack.kmlStream import getKmlResponse, iterWrappedKml, cacheStreamingPage, drainBuffer, \
+    compressedKmlPage, isKmzRequest
+from geocamTrack import positionIngest, positionRollup, spatialIndex, proximity, timeAlign, simplify, kmlBlocks
+from geocamTrack.gpxImporter import importGpxTracks
+from geocamTrack.positionQueue import getPositionQueueStats
 from django.conf import settings
 import traceback
 from trackUtil import getDatesWithPositionData
@@ -79,8 +84,12 @@ def getGeoJsonDictWithErrorHandling():
     return dict(result=result)
 
 
+@compressedKmlPage
 def getKmlNetworkLink(request, name=settings.GEOCAM_TRACK_FEED_NAME, interval=5):
-    url = request.build_absolute_uri(settings.SCRIPT_NAME + 'geocamTrack/rest/latest.kml')
+    if isKmzRequest(request):
+        url = request.build_absolute_uri(settings.SCRIPT_NAME + 'geocamTrack/rest/latest.kmz')
+    else:
+        url = request.build_absolute_uri(settings.SCRIPT_NAME + 'geocamTrack/rest/latest.kml')
     return djangoResponse(buildNetworkLink(url, name, interval))
 
 
@@ -93,6 +102,7 @@ def getKmlTrack(name, positions):
     return text
 
 
+@compressedKmlPage
 def getKmlLatest(request):
     text = getKmlTrack(settings.GEOCAM_TRACK_FEED_NAME,
                        POSITION_MODEL.get().objects.all())
@@ -121,30 +131,131 @@ def postPosition(request):
             return HttpResponse('Malformed request, expected positions as a GeoJSON Feature',
                                 status=400)
 
-        vehicle = VEHICLE_MODEL.get().objects.get(id=featureDict['id'])
-
-        # create or update ResourcePosition
-        coordinates = featureDict['geometry']['coordinates']
-        timestamp = iso8601.parse_date(properties['timestamp']).replace(tzinfo=None)
-        attrs = dict(timestamp=timestamp,
-                     longitude=coordinates[0],
-                     latitude=coordinates[1])
-        if len(coordinates) >= 3:
-            attrs['altitude'] = coordinates[2]
-        rp, created = ResourcePosition.objects.get_or_create(vehicle=vehicle,
-                                                             defaults=attrs)
-        if not created:
-            for field, val in attrs.iteritems():
-                setattr(rp, field, val)
-            rp.save()
-
-        # add a PastResourcePosition historical entry
-        PastResourcePosition(vehicle=vehicle, **attrs).save()
+        status = positionIngest.ingestFeatures([featureDict])[0]
+        if status.get('retry'):
+            return HttpResponse(status['message'], status=503)
+        if status['status'] == 'error':
+            return HttpResponseBadRequest(status['message'])
 
         return HttpResponse(dumps(dict(result='ok')),
                             content_type='application/json')
 
 
+def postPositions(request):
+    """
+    Store many positions, possibly for many vehicles, in one request.  The body is a
+    GeoJSON FeatureCollection or newline-delimited GeoJSON Features.  Returns a status
+    for each feature, in the order they were posted.
+    """
+    if request.method == 'GET':
+        return HttpResponseNotAllowed('Please post positions as a GeoJSON FeatureCollection.')
+    else:
+        try:
+            features = positionIngest.parseFeatures(request.body)
+        except ValueError:
+            return HttpResponse('Malformed request, expected positions as a GeoJSON FeatureCollection '
+                                'or newline-delimited GeoJSON Features',
+                                status=400)
+
+        statuses = positionIngest.ingestFeatures(features)
+        if any(status.get('retry') for status in statuses):
+            # the write-behind queue is full, ask the client to back off
+            httpStatus = 503
+        else:
+            httpStatus = 200
+        return HttpResponse(dumps(dict(result=statuses)),
+                            content_type='application/json',
+                            status=httpStatus)
+
+
+def getIngestStatusJson(request):
+    """
+    Report the depth and flush latency of the write-behind position queue.
+    """
+    return JsonResponse(getPositionQueueStats())
+
+
+def getTracksInBboxJson(request):
+    """
+    Which tracks passed through a bounding box during a time range, and
+    when.  Takes the fields of PositionBboxForm as GET parameters and
+    returns the tracks with the time spans they were in the box.
+    """
+    form = PositionBboxForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': dict((name, list(errors)) for name, errors in form.errors.iteritems())},
+                            status=400)
+    data = form.cleaned_data
+
+    positions = PAST_POSITION_MODEL.get().objects.all()
+    if data['track__vehicle']:
+        positions = positions.filter(track__vehicle=data['track__vehicle'])
+    spans = spatialIndex.findTrackSpans(data['west'], data['south'], data['east'], data['north'],
+                                        data['start'], data['end'], data['gap'], positions)
+
+    tracks = TRACK_MODEL.get().objects.in_bulk(set(span['track'] for span in spans))
+    result = []
+    for span in spans:
+        if not result or result[-1]['id'] != span['track']:
+            track = tracks.get(span['track'])
+            result.append(dict(id=span['track'],
+                               name=track.name if track else None,
+                               spans=[]))
+        result[-1]['spans'].append(dict(start=span['start'], end=span['end'], count=span['count']))
+    return JsonResponse({'tracks': result}, encoder=DatetimeJsonEncoder)
+
+
+def getProximityJson(request):
+    """
+    Query the proximity index of current positions.  GET parameters:
+    a center, either lat and lon or the name of a track, and either
+    radius (meters) for every position within it or k for the k nearest.
+    With pairs=1 and radius instead, returns every pair of tracks within
+    radius of each other.
+    """
+    if not proximity.isEnabled():
+        raise Http404('Proximity index is turned off')
+    index = proximity.getProximityIndex()
+    index.refresh()
+    try:
+        radius = float(request.GET['radius']) if 'radius' in request.GET else None
+        k = int(request.GET['k']) if 'k' in request.GET else None
+        if request.GET.get('pairs'):
+            if radius is None:
+                return HttpResponseBadRequest('pairs requires radius')
+            pairs = [dict(tracks=[index.positions[a][0], index.positions[b][0]], distance=distance)
+                     for distance, a, b in index.getClosePairs(radius)
+                     if a in index.positions and b in index.positions]
+            return JsonResponse({'pairs': pairs})
+
+        exclude = None
+        if 'track' in request.GET:
+            track = TRACK_MODEL.get().objects.get(name=request.GET['track'])
+            if track.pk not in index.positions:
+                return JsonResponse({'positions': []})
+            _name, lat, lon, _timestamp = index.positions[track.pk]
+            exclude = track.pk
+        else:
+            lat = float(request.GET['lat'])
+            lon = float(request.GET['lon'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('expected lat and lon or track, and radius or k')
+    except ObjectDoesNotExist:
+        raise Http404('No track named %s' % request.GET['track'])
+    except MultipleObjectsReturned:
+        return HttpResponseBadRequest('more than one track named %s' % request.GET['track'])
+
+    if k is not None:
+        found = index.queryNearest(lat, lon, k, exclude)
+    elif radius is not None:
+        found = index.queryRadius(lat, lon, radius, exclude)
+    else:
+        return HttpResponseBadRequest('expected radius or k')
+    positions = [dict(track=name, latitude=latitude, longitude=longitude, timestamp=timestamp, distance=distance)
+                 for distance, _trackId, (name, latitude, longitude, timestamp) in found]
+    return JsonResponse({'positions': positions}, encoder=DatetimeJsonEncoder)
+
+
 def getLiveMap(request):
     userData = {'loggedIn': False}
     if request.user.is_authenticated():
@@ -191,13 +302,16 @@ def writeTrackNetworkLink(out, name,
                           caching='cached',
                           refreshInterval=None,
                           visibility=0,
-                          openable=False):
+                          openable=False,
+                          kmz=False):
     if caching == 'current':
         urlName = 'geocamTrack_tracks'
     elif caching == 'recent':
         urlName = 'geocamTrack_recentTracks'
     elif caching == 'cached':
         urlName = 'geocamTrack_cachedTracks'
+    if kmz:
+        urlName += '_kmz'
     url = reverse(urlName)
     url = insertIntoPath(url)
 
@@ -258,7 +372,7 @@ def writeTrackNetworkLink(out, name,
            styleStr=styleStr))
 
 
-def writeTrackIndexForDay(out, track, isToday):
+def writeTrackIndexForDay(out, track, isToday, kmz=False):
     if isToday:
         out.write("""
     <Folder>
@@ -269,7 +383,8 @@ def writeTrackIndexForDay(out, track, isToday):
                               caching='current',
                               trackName=track.name,
                               showLine=0,
-                              refreshInterval=settings.GEOCAM_TRACK_CURRENT_POS_REFRESH_TIME_SECONDS)
+                              refreshInterval=settings.GEOCAM_TRACK_CURRENT_POS_REFRESH_TIME_SECONDS,
+                              kmz=kmz)
         writeTrackNetworkLink(out,
                               'Compass Rose',
                               caching='current',
@@ -277,21 +392,24 @@ def writeTrackIndexForDay(out, track, isToday):
                               showLine=0,
                               showIcon=0,
                               showCompass=1,
-                              refreshInterval=settings.GEOCAM_TRACK_CURRENT_POS_REFRESH_TIME_SECONDS)
+                              refreshInterval=settings.GEOCAM_TRACK_CURRENT_POS_REFRESH_TIME_SECONDS,
+                              kmz=kmz)
         writeTrackNetworkLink(out,
                               'Recent Tracks',
                               caching='recent',
                               trackName=track.name,
                               showIcon=0,
                               recent=settings.GEOCAM_TRACK_RECENT_TRACK_LENGTH_SECONDS,
-                              refreshInterval=settings.GEOCAM_TRACK_RECENT_TRACK_REFRESH_TIME_SECONDS)
+                              refreshInterval=settings.GEOCAM_TRACK_RECENT_TRACK_REFRESH_TIME_SECONDS,
+                              kmz=kmz)
         writeTrackNetworkLink(out,
                               'Old Tracks',
                               caching='cached',
                               trackName=track.name,
                               showIcon=0,
                               startTimeUtc=track.pastposition_set.first().timestamp,
-                              refreshInterval=settings.GEOCAM_TRACK_OLD_TRACK_REFRESH_TIME_SECONDS)
+                              refreshInterval=settings.GEOCAM_TRACK_OLD_TRACK_REFRESH_TIME_SECONDS,
+                              kmz=kmz)
         out.write("""
     </Folder>
 """)
@@ -303,7 +421,8 @@ def writeTrackIndexForDay(out, track, isToday):
                               showIcon=0,
                               startTimeUtc=track.pastposition_set.first().timestamp,
                               endTimeUtc=track.pastposition_set.last().timestamp,
-                              visibility=0)
+                              visibility=0,
+                              kmz=kmz)
 
 
 def getPositionCountForDay(day, track=None):
@@ -311,20 +430,27 @@ def getPositionCountForDay(day, track=None):
     startTimeUtc = defaultToUtcTime(dayStart)
     endTimeUtc = defaultToUtcTime(dayStart + datetime.timedelta(1))
 
+    if positionRollup.isEnabled():
+        return positionRollup.getPositionCount(startTimeUtc, endTimeUtc, track)
+
     positions = (PAST_POSITION_MODEL.get()
                  .objects.filter
                  (timestamp__gte=startTimeUtc,
-                  timestamp__lte=endTimeUtc))
+                  timestamp__lt=endTimeUtc))
     if track:
         positions = positions.filter(track=track)
     return positions.count()
 
 
+@compressedKmlPage
 def getTrackIndexKml(request):
     geocamTrack.models.latestRequestG = request
     #     dates = reversed(getDatesWithPositionData())
-    track_pk_dicts = PAST_POSITION_MODEL.get().objects.order_by('track').values('track').distinct()
-    track_pks = [t['track'] for t in track_pk_dicts]
+    if positionRollup.isEnabled():
+        track_pks = positionRollup.ROLLUP_MODEL.get().objects.order_by('track').values_list('track', flat=True).distinct()
+    else:
+        track_pk_dicts = PAST_POSITION_MODEL.get().objects.order_by('track').values('track').distinct()
+        track_pks = [t['track'] for t in track_pk_dicts]
     tracks = TRACK_MODEL.get().objects.filter(pk__in=track_pks).order_by('-name')
 
     today = datetime.datetime.now(pytz.timezone(settings.GEOCAM_TRACK_OPS_TIME_ZONE)).date()
@@ -343,6 +469,11 @@ def getTrackIndexKml(request):
         if prefix not in dates:
             dates.append(prefix)
 
+    return getKmlResponse(iterTrackIndexKml(todays_tracks, other_tracks, kmz=isKmzRequest(request)))
+
+
+def iterTrackIndexKml(todays_tracks, other_tracks, kmz=False):
+    """ Generate the track index KML, one chunk per track, with network links to KMZ if kmz is set """
     out = StringIO()
     out.write("""<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2"
@@ -361,7 +492,8 @@ def getTrackIndexKml(request):
         <name>Today</name>
     """)
         for track in todays_tracks:
-            writeTrackIndexForDay(out, track, True)
+            writeTrackIndexForDay(out, track, True, kmz)
+            yield drainBuffer(out)
         out.write("""
       </Folder>
     """)
@@ -385,7 +517,8 @@ def getTrackIndexKml(request):
         <name>%s</name>
     """ % lastday)
 
-            writeTrackIndexForDay(out, track, False)
+            writeTrackIndexForDay(out, track, False, kmz)
+            yield drainBuffer(out)
 
         out.write('</Folder>\n')
         out.write('</Folder>\n')
@@ -394,20 +527,23 @@ def getTrackIndexKml(request):
 </Document>
 </kml>
 """)
-    return HttpResponse(out.getvalue(), content_type='application/vnd.google-earth.kml+xml')
+    yield drainBuffer(out)
 
 
-@cache_page(0.9 * settings.GEOCAM_TRACK_CURRENT_POS_REFRESH_TIME_SECONDS)
+@cacheStreamingPage(0.9 * settings.GEOCAM_TRACK_CURRENT_POS_REFRESH_TIME_SECONDS)
+@compressedKmlPage
 def getCurrentPosKml(request):
     return getTracksKml(request)
 
 
-@cache_page(0.9 * settings.GEOCAM_TRACK_RECENT_TRACK_REFRESH_TIME_SECONDS)
+@cacheStreamingPage(0.9 * settings.GEOCAM_TRACK_RECENT_TRACK_REFRESH_TIME_SECONDS)
+@compressedKmlPage
 def getRecentTracksKml(request):
     return getTracksKml(request)
 
 
-@cache_page(0.9 * settings.GEOCAM_TRACK_OLD_TRACK_REFRESH_TIME_SECONDS)
+@cacheStreamingPage(0.9 * settings.GEOCAM_TRACK_OLD_TRACK_REFRESH_TIME_SECONDS)
+@compressedKmlPage
 def getCachedTracksKml(request):
     return getTracksKml(request)
 
@@ -415,12 +551,6 @@ def getCachedTracksKml(request):
 def getTracksKml(request, recent=True):
     geocamTrack.models.latestRequestG = request
 
-    out = StringIO()
-    out.write("""<?xml version="1.0" encoding="UTF-8"?>
-<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
-<Document>
-""")
-
     trackName = request.GET.get('track')
     if trackName:
         try:
@@ -449,15 +579,41 @@ def getTracksKml(request, recent=True):
     showLine = int(request.GET.get('line', 1))
     showIcon = int(request.GET.get('icon', 1))
     showCompass = int(request.GET.get('compass', 0))
+    tolerance = simplify.getTolerance(request)
+
+    return getKmlResponse(iterTracksKml(request, tracks, startTime, endTime, showLine, showIcon, showCompass,
+                                        tolerance, cacheSimplified=not recent))
+
+
+def iterTracksKml(request, tracks, startTime, endTime, showLine, showIcon, showCompass,
+                  tolerance=None, cacheSimplified=True):
+    """
+    Generate the KML of getTracksKml in chunks, reading positions as they
+    are needed.  Lines are simplified to within tolerance meters, if given;
+    the start of a recent window moves with every request, so its lines are
+    not worth caching.
+    """
+    out = StringIO()
+    out.write("""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2" xmlns:kml="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom">
+<Document>
+""")
+    yield drainBuffer(out)
 
     for track in tracks:
-        if showLine:
+        if showLine and tolerance is None and kmlBlocks.canUseBlocks():
+            # only the blocks with new positions are rendered
+            for chunk in kmlBlocks.iterTrackBlockKml(track, startTime, endTime, urlFn=request.build_absolute_uri):
+                yield chunk
+        elif showLine:
             pastPositions = track.getPositions()
             if startTime:
                 pastPositions = pastPositions.filter(timestamp__gte=startTime)
             if endTime:
                 pastPositions = pastPositions.filter(timestamp__lte=endTime)
-            track.writeTrackKml(out, positions=pastPositions, urlFn=request.build_absolute_uri)
+            for chunk in track.iterTrackKml(positions=pastPositions, urlFn=request.build_absolute_uri,
+                                            tolerance=tolerance, cacheSimplified=cacheSimplified):
+                yield chunk
 
         if showIcon or showCompass:
             currentPositions = track.getCurrentPositions()
@@ -474,12 +630,13 @@ def getTracksKml(request, recent=True):
 
                 if showCompass:
                     track.writeCompassKml(out, pos, urlFn=request.build_absolute_uri)
+                yield drainBuffer(out)
 
     out.write("""
 </Document>
 </kml>
 """)
-    return HttpResponse(out.getvalue(), content_type='application/vnd.google-earth.kml+xml')
+    yield drainBuffer(out)
 
 
 def getCsvTrackLink(day, trackName, startTimeUtc=None, endTimeUtc=None):
@@ -507,18 +664,23 @@ def getCsvTrackIndex(request):
         startTimeUtc = defaultToUtcTime(dayStart)
         endTimeUtc = defaultToUtcTime(dayStart + datetime.timedelta(1))
 
-        dayPoints = (PAST_POSITION_MODEL.get()
-                     .objects.filter
-                     (timestamp__gte=startTimeUtc,
-                      timestamp__lte=endTimeUtc))
-        if not dayPoints.count():
+        if positionRollup.isEnabled():
+            trackIds = positionRollup.getTrackIds(startTimeUtc, endTimeUtc)
+        else:
+            trackIds = set(PAST_POSITION_MODEL.get()
+                           .objects.filter
+                           (timestamp__gte=startTimeUtc,
+                            timestamp__lt=endTimeUtc)
+                           .order_by()
+                           .values_list('track_id', flat=True)
+                           .distinct())
+        if not trackIds:
             continue
 
         out.write('<li><span class="trackDate">%s</span> ' % day.strftime('%Y%m%d'))
 
         for track in tracks:
-            trackPoints = dayPoints.filter(track=track)
-            if trackPoints.count():
+            if track.pk in trackIds:
                 link = getCsvTrackLink(day, track.name, startTimeUtc, endTimeUtc)
                 out.write('<a class="trackLink" href="%s"><span>%s</span></a> '
                           % (link, track.name))
@@ -600,20 +762,18 @@ def getAnimatedTrackKml(request, trackName):
     return getTrackKml(request, trackName, animated=True)
 
 
+@compressedKmlPage
 def getTrackKml(request, trackName, animated=False):
     if not trackName:
         return HttpResponseBadRequest('track parameter is required')
     track = TRACK_MODEL.get().objects.get(name=trackName)
-    output = StringIO()
-    track.writeTrackKml(output, animated=animated)
-    text = output.getvalue()
-    output.close()
-
-    if text:
-        return djangoResponse(text)
-    else:
+    chunks = track.iterTrackKml(animated=animated, tolerance=simplify.getTolerance(request))
+    # the first chunk comes once the track is known to have positions
+    first = next(chunks, None)
+    if first is None:
         # handle error case
         return HttpResponseBadRequest("ERROR GETTING TRACK -- no positions")
+    return getKmlResponse(iterWrappedKml(itertools.chain([first], chunks)))
 
 
 # TODO implement and test
@@ -721,7 +881,8 @@ def mapJsonTrack(request, uuid, downsample=False):
     TRACK_MODEL = LazyGetModelByName(settings.GEOCAM_TRACK_TRACK_MODEL)
     try:
         track = TRACK_MODEL.get().objects.get(uuid=uuid)
-        json_data = json.dumps([track.toMapDict(downsample)], cls=DatetimeJsonEncoder)
+        json_data = json.dumps([track.toMapDict(downsample, simplify.getTolerance(request))],
+                               cls=DatetimeJsonEncoder)
         return HttpResponse(content=json_data,
                             content_type="application/json")
     except:
@@ -789,75 +950,9 @@ if False and settings.XGDS_SSE:
 
 #             yield
 
-def getGpxWaypointList(docroot, ns):
-    wptList = []
-    for wpt in docroot.findall("ns:wpt", ns):
-        if wpt.find("ns:time", ns) is not None:
-            time = dateparser(wpt.find("ns:time", ns).text)
-        else:
-            time = None
-        wptData = {"time": time,
-                   "name": wpt.find("ns:name", ns).text,
-                   "lat": float(wpt.attrib["lat"]),
-                   "lon": float(wpt.attrib["lon"]),
-                   "ele": float(wpt.find("ns:ele", ns).text),
-                   "desc": wpt.find("ns:desc", ns).text,
-                   "cmt": wpt.find("ns:cmt", ns).text,
-                   "markerAndColor": [s.strip() for s in wpt.find("ns:sym", ns).
-                       text.split(",")]}
-        wptList.append(wptData)
-
-    return wptList
-
-
-def getGpxTrackSet(docroot, ns):
-    trackCollection = []
-    for trk in docroot.findall("ns:trk", ns):
-        trackName = trk.find("ns:name", ns).text
-        trackSegPointList = trk.find("ns:trkseg", ns)
-        trackSegment = {"name": trackName}
-        trackSegPoints = []
-        foundTimeInTrackData = True
-        for point in trackSegPointList:
-            if point.find("ns:time", ns) is not None:
-                time = dateparser(point.find("ns:time", ns).text)
-                time = time.replace(tzinfo=None)
-            else:
-                foundTimeInTrackData = False
-                time = "<no time>"
-            trackPoint = {"lat": float(point.attrib["lat"]),
-                          "lon": float(point.attrib["lon"]),
-                          "ele": float(point.find("ns:ele", ns).text),
-                          "time": time}
-            trackSegPoints.append(trackPoint)
-        trackSegment["foundTimeInTrackData"] = foundTimeInTrackData
-        trackSegment["trackPoints"] = trackSegPoints
-        trackCollection.append(trackSegment)
-
-    return trackCollection
-
-
 def doImportGpxTrack(request, f, tz, vehicle):
     #TODO we are not using timezone here
-    gpxData = ''.join([chunk for chunk in f.chunks()])
-    root = et.fromstring(gpxData)
-    ns = {"ns": root.tag.split('}')[0].strip('{')}
-
-    trackSet = getGpxTrackSet(root, ns)
-    newTracksDB = []
-    for track in trackSet:
-        if track["foundTimeInTrackData"]:
-            newTrackDB = TRACK_MODEL.get().objects.create(name=track["name"],
-                                                          vehicle=vehicle)
-            newTracksDB.append(newTrackDB)
-            for point in track["trackPoints"]:
-                PAST_POSITION_MODEL.get().objects.create(track=newTrackDB,
-                                                         serverTimestamp=datetime.datetime.now(pytz.utc),
-                                                         timestamp=point["time"],
-                                                         latitude=point["lat"],
-                                                         longitude=point["lon"],
-                                                         altitude=point["ele"])
-    return newTracksDB
+    return importGpxTracks(f, vehicle)
 
 
 def importTrack(request):
@@ -891,4 +986,59 @@ def importTrack(request):
 
 def getSseActiveTracks(request):
     # Look up the active channels we are using for SSE
-    return JsonResponse(settings.XGDS_SSE_TRACK_CHANNELS, safe=False)
\ No newline at end of file
+    return JsonResponse(settings.XGDS_SSE_TRACK_CHANNELS, safe=False)
+
+
+class CsvEcho(object):
+    """ File-like object for csv.writer that hands each row back instead of storing it """
+    def write(self, value):
+        return value
+
+
+def getAlignedPositionsCsv(request, appLabel, modelName):
+    """
+    Export the position of each record of a TrackMixin model at its own
+    time, as CSV.  GET parameters: timeField (required), mode ('nearest'
+    or 'interpolated'), maxSeconds, and start and end in epoch seconds to
+    limit the records by timeField.  See timeAlign.alignRecords.
+    """
+    try:
+        model = apps.get_model(appLabel, modelName)
+    except LookupError:
+        raise Http404('No model %s.%s' % (appLabel, modelName))
+    if not issubclass(model, TrackMixin):
+        raise Http404('%s.%s has no track' % (appLabel, modelName))
+
+    timeField = request.GET.get('timeField')
+    if timeField not in [f.name for f in model._meta.concrete_fields]:
+        return HttpResponseBadRequest('timeField must be a field of %s.%s' % (appLabel, modelName))
+    mode = request.GET.get('mode', 'nearest')
+    if mode not in timeAlign.ALIGN_MODES:
+        return HttpResponseBadRequest('mode must be one of %s' % ', '.join(timeAlign.ALIGN_MODES))
+    try:
+        maxSeconds = float(request.GET['maxSeconds']) if 'maxSeconds' in request.GET else None
+        records = model.objects.all()
+        if request.GET.get('start'):
+            records = records.filter(**{timeField + '__gte': datetime.datetime.utcfromtimestamp(float(request.GET['start']))})
+        if request.GET.get('end'):
+            records = records.filter(**{timeField + '__lte': datetime.datetime.utcfromtimestamp(float(request.GET['end']))})
+    except ValueError:
+        return HttpResponseBadRequest('maxSeconds, start and end must be numbers')
+
+    fields = ['latitude', 'longitude'] + PAST_POSITION_MODEL.get().getInterpolatedFields()
+
+    def iterRows():
+        yield ['id', timeField, 'track', 'position id', 'position timestamp'] + fields
+        for record, position in timeAlign.alignRecords(records, timeField, mode, maxSeconds):
+            row = [record.pk, getattr(record, timeField), record.track.name if record.track_id else '']
+            if position is None:
+                row.extend([''] * (2 + len(fields)))
+            else:
+                row.extend([position.pk or '', position.timestamp] +
+                           ['' if getattr(position, name) is None else getattr(position, name) for name in fields])
+            yield row
+
+    writer = csv.writer(CsvEcho())
+    response = StreamingHttpResponse((writer.writerow(row) for row in iterRows()), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s_positions.csv' % modelName
+    return response